@@ -1,22 +1,57 @@
 import logging
-import pickle
 
+from django.conf.urls import url
 from django.contrib import admin, messages
+from django.contrib.admin.utils import unquote
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import PermissionDenied
 from django.core.mail import get_connection
-from django.db.models import Count
+from django.db.models import Count, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
+from django.http import Http404, StreamingHttpResponse
+from django.template.response import TemplateResponse
 from django.urls import reverse
 from django.utils.html import format_html
 from django.utils.translation import ugettext_lazy as _
 
-from .models import Bounce, Delivery, Email, Message
+from . import app_settings
+from .models import (Bounce, Delivery, Email, Event, Message,
+                     MessageMetadata)
+from .pagination import KeysetPaginationAdminMixin
+from .search import (BOUNCE_ID, MESSAGE_ID, POSTMARK_ID,
+                     SearchBackendAdminMixin)
+from .storage import iter_message_bytes
+from .timeline import InvalidCursor, get_timeline
 from .utils import ResendEmailMessage
 
 logger = logging.getLogger(__name__)
 
 
+def annotate_num_of_events(queryset):
+    """
+    Annotates emails with their numbers of bounces and deliveries, using a
+    subquery for each, so that the rows aren't multiplied by joins.
+    """
+
+    def count(model):
+        return Coalesce(Subquery(
+            model.objects.filter(email=OuterRef('pk'))
+                         .order_by()
+                         .values('email')
+                         .annotate(count=Count('id'))
+                         .values('count')
+        ), 0)
+
+    return queryset.annotate(num_of_bounces=count(Bounce),
+                             num_of_deliveries=count(Delivery))
+
+
 class ReadOnlyModelAdminMixin(object):
 
-    def has_add_permission(self, request):
+    def get_queryset(self, request):
+        return super().get_queryset(request).using(app_settings.READ_DATABASE)
+
+    def has_add_permission(self, request, obj=None):
         return False
 
     def has_delete_permission(self, request, obj=None):
@@ -24,10 +59,30 @@ class ReadOnlyModelAdminMixin(object):
 
     def get_actions(self, request):
         actions = super().get_actions(request)
-        del actions['delete_selected']
+        actions.pop('delete_selected', None)
         return actions
 
 
+class EmailLinkAdminMixin(object):
+    """
+    Links to the email of an object, which is loaded with the object.
+    """
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('email')
+
+    def email_with_link(self, obj):
+        if obj.email_id is None:
+            return None
+        return format_html(
+            '<a href="{}">{}</a>',
+            reverse('admin:django_postmark_utils_email_change',
+                    args=[str(obj.email_id)]),
+            obj.email,
+        )
+    email_with_link.short_description = _("email")
+
+
 class EmailInline(ReadOnlyModelAdminMixin, admin.TabularInline):
 
     model = Email
@@ -62,12 +117,15 @@ class EmailInline(ReadOnlyModelAdminMixin, admin.TabularInline):
         )
     email_id_with_link.short_description = _("email id")
 
+    def get_queryset(self, request):
+        return annotate_num_of_events(super().get_queryset(request))
+
     def num_of_bounces(self, obj):
-        return obj.bounces.count()
+        return obj.num_of_bounces
     num_of_bounces.short_description = _("bounces")
 
     def num_of_deliveries(self, obj):
-        return obj.deliveries.count()
+        return obj.num_of_deliveries
     num_of_deliveries.short_description = _("deliveries")
 
 
@@ -76,10 +134,16 @@ class MessageNumOfBouncesListFilter(admin.SimpleListFilter):
     title = _('number of bounces')
     parameter_name = 'num_of_bounces'
 
+    # Counts are grouped by the message ID only, so that other columns (such
+    # as the message object) aren't included in the grouping.
+    def bounce_counts(self, queryset):
+        return queryset.values('id')\
+                       .annotate(num_of_bounces=Count('emails__bounces'))
+
     def lookups(self, request, model_admin):
         qs = model_admin.get_queryset(request)
-        bounce_counts = [message.num_of_bounces for message in
-                         qs.annotate(num_of_bounces=Count('emails__bounces'))]
+        bounce_counts = self.bounce_counts(qs)\
+                            .values_list('num_of_bounces', flat=True)
         return ((str(count), str(count)) for count in set(bounce_counts))
 
     def queryset(self, request, queryset):
@@ -88,8 +152,9 @@ class MessageNumOfBouncesListFilter(admin.SimpleListFilter):
         except TypeError:
             pass
         else:
-            return queryset.annotate(num_of_bounces=Count('emails__bounces'))\
-                           .filter(num_of_bounces=value)
+            return queryset.filter(id__in=self.bounce_counts(queryset)
+                                              .filter(num_of_bounces=value)
+                                              .values('id'))
 
 
 class MessageNumOfDeliveriesListFilter(admin.SimpleListFilter):
@@ -97,11 +162,16 @@ class MessageNumOfDeliveriesListFilter(admin.SimpleListFilter):
     title = _('number of deliveries')
     parameter_name = 'num_of_deliveries'
 
+    # Counts are grouped by the message ID only, so that other columns (such
+    # as the message object) aren't included in the grouping.
+    def delivery_counts(self, queryset):
+        return queryset.values('id')\
+                       .annotate(num_of_deliveries=Count('emails__deliveries'))
+
     def lookups(self, request, model_admin):
         qs = model_admin.get_queryset(request)
-        delivery_counts = [message.num_of_deliveries for message in
-                           qs.annotate(
-                                num_of_deliveries=Count('emails__deliveries'))]
+        delivery_counts = self.delivery_counts(qs)\
+                              .values_list('num_of_deliveries', flat=True)
         return ((str(count), str(count)) for count in set(delivery_counts))
 
     def queryset(self, request, queryset):
@@ -110,15 +180,88 @@ class MessageNumOfDeliveriesListFilter(admin.SimpleListFilter):
         except TypeError:
             pass
         else:
-            return queryset.annotate(
-                                num_of_deliveries=Count('emails__deliveries'))\
-                           .filter(num_of_deliveries=value)
+            return queryset.filter(id__in=self.delivery_counts(queryset)
+                                              .filter(num_of_deliveries=value)
+                                              .values('id'))
+
+
+class TagListFilter(admin.AllValuesFieldListFilter):
+    """
+    Filters by message tag, listing up to "max_tags" tags, read from
+    "POSTMARK_UTILS_READ_DATABASE" (rather than those of the changelist's
+    objects), and only when displayed.
+    """
+
+    max_tags = 100
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Uses the index on the tag
+        self.lookup_choices = \
+            Message.objects.using(app_settings.READ_DATABASE)\
+                           .exclude(tag='')\
+                           .order_by('tag')\
+                           .values_list('tag', flat=True)\
+                           .distinct()[:self.max_tags]
+
+
+class MessageMetadataListFilter(admin.SimpleListFilter):
+    """
+    Filters messages by metadata key, listing up to "max_keys" keys. Messages
+    can also be filtered by a key and value, with a "metadata=<key>=<value>"
+    query string parameter, as the values aren't listed (there can be any
+    number of them).
+    """
+
+    title = _('metadata')
+    parameter_name = 'metadata'
+    max_keys = 100
+
+    def lookups(self, request, model_admin):
+        # Uses the index on the metadata key and value
+        keys = MessageMetadata.objects.using(app_settings.READ_DATABASE)\
+                                      .order_by('key')\
+                                      .values_list('key', flat=True)\
+                                      .distinct()
+        return ((key, key) for key in keys[:self.max_keys])
+
+    def queryset(self, request, queryset):
+        if not self.value():
+            return queryset
+        if '=' not in self.value():
+            return queryset.filter(metadata__key=self.value())
+        key, value = self.value().split('=', 1)
+        return queryset.filter(metadata__key=key, metadata__value=value)
+
+
+class MessageMetadataInline(ReadOnlyModelAdminMixin, admin.TabularInline):
+
+    model = MessageMetadata
+    fields = (
+        'key',
+        'value',
+    )
+    readonly_fields = (
+        'key',
+        'value',
+    )
+
+
+class MessageChangeList(ChangeList):
+
+    def get_queryset(self, request):
+        # Loads the emails of all the messages on the page, with their numbers
+        # of bounces and deliveries, in one query
+        return super().get_queryset(request).prefetch_related(Prefetch(
+            'emails', queryset=annotate_num_of_events(Email.objects.all())))
 
 
 @admin.register(Message)
-class MessageAdmin(ReadOnlyModelAdminMixin, admin.ModelAdmin):
+class MessageAdmin(SearchBackendAdminMixin, ReadOnlyModelAdminMixin,
+                   admin.ModelAdmin):
 
     inlines = (
+        MessageMetadataInline,
         EmailInline,
     )
     list_display = (
@@ -126,12 +269,16 @@ class MessageAdmin(ReadOnlyModelAdminMixin, admin.ModelAdmin):
         'subject',
         'from_email',
         'recepients',
+        'tag',
+        'has_message_obj',
         'latest_email_date',
         'num_of_emails',
         'num_of_bounces',
         'num_of_deliveries',
     )
     list_filter = (
+        ('tag', TagListFilter),
+        MessageMetadataListFilter,
         MessageNumOfBouncesListFilter,
         MessageNumOfDeliveriesListFilter,
     )
@@ -142,6 +289,13 @@ class MessageAdmin(ReadOnlyModelAdminMixin, admin.ModelAdmin):
         'to_emails',
         'cc_emails',
         'bcc_emails',
+        'tag',
+        'message_size',
+        'storage_policy',
+        'message_archived',
+        'retry_attempts',
+        'next_attempt_at',
+        'download_link',
     )
     search_fields = (
         'message_id',
@@ -152,6 +306,67 @@ class MessageAdmin(ReadOnlyModelAdminMixin, admin.ModelAdmin):
         'emails__email_id',
         'emails__delivery_email_id',
     )
+    exact_search_fields = {
+        MESSAGE_ID: ('message_id', 'emails__email_id'),
+        POSTMARK_ID: ('emails__delivery_email_id',),
+    }
+    text_search_fields = (
+        'subject',
+        'to_emails',
+        'cc_emails',
+        'bcc_emails',
+    )
+
+    def get_queryset(self, request):
+        # The message object is only needed for downloading, so is loaded
+        # separately then
+        return super().get_queryset(request).defer('message_obj')
+
+    def get_changelist(self, request, **kwargs):
+        return MessageChangeList
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            url(r'^(.+)/download/$',
+                self.admin_site.admin_view(self.download_view),
+                name='%s_%s_download' % info),
+        ] + super().get_urls()
+
+    def download_view(self, request, object_id):
+        """
+        Streams the message as an ".eml" file, rendered from the deserialised
+        message object a MIME part at a time.
+        """
+
+        obj = self.get_object(request, unquote(object_id))
+        if obj is None or not obj.has_message_obj:
+            raise Http404
+        if not self.has_view_or_change_permission(request, obj):
+            raise PermissionDenied
+        response = StreamingHttpResponse(
+            iter_message_bytes(obj.load_message_obj()),
+            content_type='message/rfc822')
+        response['Content-Disposition'] = \
+            'attachment; filename="message-{}.eml"'.format(obj.pk)
+        return response
+
+    def download_link(self, obj):
+        if not obj.has_message_obj:
+            return _("Not available, as the message body wasn't stored, or "
+                     "was removed by the retention policy")
+        return format_html(
+            '<a href="{}">{}</a>',
+            reverse('admin:django_postmark_utils_message_download',
+                    args=[str(obj.id)]),
+            _("Download .eml"),
+        )
+    download_link.short_description = _("download")
+
+    def has_message_obj(self, obj):
+        return obj.has_message_obj
+    has_message_obj.boolean = True
+    has_message_obj.short_description = _("body available")
 
     def recepients(self, obj):
         return ((obj.to_emails.split(',') if obj.to_emails else [])
@@ -159,22 +374,22 @@ class MessageAdmin(ReadOnlyModelAdminMixin, admin.ModelAdmin):
                 + (obj.bcc_emails.split(',') if obj.bcc_emails else []))
     recepients.short_description = _("recepients")
 
+    # The emails are prefetched by "MessageChangeList"
+
     def latest_email_date(self, obj):
-        return obj.emails.latest('date').date
+        return max((email.date for email in obj.emails.all()), default=None)
     latest_email_date.short_description = _("latest email")
 
     def num_of_emails(self, obj):
-        return obj.emails.count()
+        return len(obj.emails.all())
     num_of_emails.short_description = _("emails")
 
     def num_of_bounces(self, obj):
-        return [email.bounces__count for email in
-                obj.emails.annotate(Count('bounces'))]
+        return [email.num_of_bounces for email in obj.emails.all()]
     num_of_bounces.short_description = _("bounces")
 
     def num_of_deliveries(self, obj):
-        return [email.deliveries__count for email in
-                obj.emails.annotate(Count('deliveries'))]
+        return [email.num_of_deliveries for email in obj.emails.all()]
     num_of_deliveries.short_description = _("deliveries")
 
 
@@ -235,7 +450,8 @@ class DeliveryInline(ReadOnlyModelAdminMixin, admin.TabularInline):
 
 
 @admin.register(Email)
-class EmailAdmin(ReadOnlyModelAdminMixin, admin.ModelAdmin):
+class EmailAdmin(SearchBackendAdminMixin, KeysetPaginationAdminMixin,
+                 ReadOnlyModelAdminMixin, admin.ModelAdmin):
 
     actions = ['resend_emails']
     fields = (
@@ -248,6 +464,8 @@ class EmailAdmin(ReadOnlyModelAdminMixin, admin.ModelAdmin):
         'delivery_email_id',
         'delivery_error_code',
         'delivery_message',
+        'status',
+        'status_changed_at',
     )
     inlines = (
         BounceInline,
@@ -259,6 +477,7 @@ class EmailAdmin(ReadOnlyModelAdminMixin, admin.ModelAdmin):
         'sending_error',
         'delivery_email_id',
         'delivery_error_code',
+        'status',
         'num_of_bounces',
         'num_of_deliveries',
     )
@@ -266,6 +485,8 @@ class EmailAdmin(ReadOnlyModelAdminMixin, admin.ModelAdmin):
         'email_id',
     )
     list_filter = (
+        'status',
+        ('message__tag', TagListFilter),
         'delivery_error_code',
     )
     readonly_fields = (
@@ -278,19 +499,89 @@ class EmailAdmin(ReadOnlyModelAdminMixin, admin.ModelAdmin):
         'delivery_email_id',
         'delivery_error_code',
         'delivery_message',
+        'status',
+        'status_changed_at',
     )
     search_fields = (
         'message__message_id',
         'email_id',
         'delivery_email_id',
     )
+    exact_search_fields = {
+        MESSAGE_ID: ('message__message_id', 'email_id'),
+        POSTMARK_ID: ('delivery_email_id',),
+    }
+    text_search_fields = (
+        'subject',
+        'to_emails',
+        'cc_emails',
+        'bcc_emails',
+    )
+    text_search_relation = 'message'
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            url(r'^timeline/$',
+                self.admin_site.admin_view(self.timeline_view),
+                name='%s_%s_timeline' % info),
+        ] + super().get_urls()
+
+    def timeline_view(self, request):
+        """
+        Shows the sends, sending errors, bounces and deliveries of the emails
+        sent to an email address, newest first.
+        """
+
+        if not self.has_view_or_change_permission(request):
+            raise PermissionDenied
+        email_address = request.GET.get('address', '').strip()
+        timeline = None
+        status = 200
+        if email_address:
+            try:
+                timeline = get_timeline(email_address,
+                                        cursor=request.GET.get('cursor'))
+            except InvalidCursor:
+                # As the JSON timeline does
+                self.message_user(request, _("Invalid cursor."),
+                                  messages.ERROR)
+                status = 400
+        return TemplateResponse(
+            request, 'admin/django_postmark_utils/timeline.html', dict(
+                self.admin_site.each_context(request),
+                opts=self.model._meta,
+                title=_("Email address timeline"),
+                email_address=email_address,
+                timeline=timeline,
+            ), status=status)
+
+    def get_queryset(self, request):
+        # For the message link, without the message object
+        return annotate_num_of_events(
+            super().get_queryset(request).select_related('message')
+                                         .defer('message__message_obj'))
 
     def resend_emails(self, request, queryset):
         msgs = []
-        for email in queryset:
-            msg = pickle.loads(email.message.message_obj)
+        num_unavailable = 0
+        # Read from the primary database, in case the emails were only just
+        # stored, and with the message objects, which are deferred in the
+        # changelist queryset
+        for email in queryset.using(app_settings.DATABASE)\
+                             .defer(None)\
+                             .select_related('message'):
+            if not email.message.has_message_obj:
+                num_unavailable += 1
+                continue
+            msg = email.message.load_message_obj()
             msg = ResendEmailMessage(msg, email.message.message_id)
             msgs.append(msg)
+        if num_unavailable:
+            messages.warning(request, _(
+                "%(count)d emails weren't resent, as their message bodies "
+                "were removed by the retention policy.") % {
+                    'count': num_unavailable})
         connection = get_connection()
         try:
             connection.send_messages(msgs)
@@ -302,11 +593,11 @@ class EmailAdmin(ReadOnlyModelAdminMixin, admin.ModelAdmin):
     resend_emails.short_description = _("Resend emails")
 
     def num_of_bounces(self, obj):
-        return obj.bounces.count()
+        return obj.num_of_bounces
     num_of_bounces.short_description = _("bounces")
 
     def num_of_deliveries(self, obj):
-        return obj.deliveries.count()
+        return obj.num_of_deliveries
     num_of_deliveries.short_description = _("deliveries")
 
     def message_with_link(self, obj):
@@ -319,6 +610,9 @@ class EmailAdmin(ReadOnlyModelAdminMixin, admin.ModelAdmin):
     message_with_link.short_description = _("message")
 
     def resend_link(self, obj):
+        if not obj.message.has_message_obj:
+            return _("Not available, as the message body wasn't stored, or "
+                     "was removed by the retention policy")
         return format_html(
             '<a href="{}?q={}">{}</a>',
             reverse('admin:django_postmark_utils_email_changelist'),
@@ -329,7 +623,9 @@ class EmailAdmin(ReadOnlyModelAdminMixin, admin.ModelAdmin):
 
 
 @admin.register(Bounce)
-class BounceAdmin(ReadOnlyModelAdminMixin, admin.ModelAdmin):
+class BounceAdmin(EmailLinkAdminMixin, SearchBackendAdminMixin,
+                  KeysetPaginationAdminMixin, ReadOnlyModelAdminMixin,
+                  admin.ModelAdmin):
 
     fields = (
         'email_with_link',
@@ -366,19 +662,23 @@ class BounceAdmin(ReadOnlyModelAdminMixin, admin.ModelAdmin):
         'email__email_id',
         'email__delivery_email_id',
     )
-
-    def email_with_link(self, obj):
-        return format_html(
-            '<a href="{}">{}</a>',
-            reverse('admin:django_postmark_utils_email_change',
-                    args=[str(obj.email.id)]),
-            obj.email,
-        )
-    email_with_link.short_description = _("email")
+    exact_search_fields = {
+        MESSAGE_ID: ('email__email_id',),
+        POSTMARK_ID: ('email__delivery_email_id',),
+        BOUNCE_ID: ('bounce_id',),
+    }
+    text_search_fields = (
+        'subject',
+        'to_emails',
+        'cc_emails',
+        'bcc_emails',
+    )
+    text_search_relation = 'email__message'
 
 
 @admin.register(Delivery)
-class DeliveryAdmin(ReadOnlyModelAdminMixin, admin.ModelAdmin):
+class DeliveryAdmin(EmailLinkAdminMixin, SearchBackendAdminMixin,
+                    ReadOnlyModelAdminMixin, admin.ModelAdmin):
 
     fields = (
         'email_with_link',
@@ -399,12 +699,43 @@ class DeliveryAdmin(ReadOnlyModelAdminMixin, admin.ModelAdmin):
         'email__email_id',
         'email__delivery_email_id',
     )
+    exact_search_fields = {
+        MESSAGE_ID: ('email__email_id',),
+        POSTMARK_ID: ('email__delivery_email_id',),
+    }
+    text_search_fields = (
+        'subject',
+        'to_emails',
+        'cc_emails',
+        'bcc_emails',
+    )
+    text_search_relation = 'email__message'
 
-    def email_with_link(self, obj):
-        return format_html(
-            '<a href="{}">{}</a>',
-            reverse('admin:django_postmark_utils_email_change',
-                    args=[str(obj.email.id)]),
-            obj.email,
-        )
-    email_with_link.short_description = _("email")
+
+@admin.register(Event)
+class EventAdmin(EmailLinkAdminMixin, ReadOnlyModelAdminMixin,
+                 admin.ModelAdmin):
+
+    fields = (
+        'email_with_link',
+        'type',
+        'email_address',
+        'date',
+        'payload',
+    )
+    list_display = (
+        '__str__',
+        'type',
+        'email_address',
+        'date',
+    )
+    list_filter = (
+        'type',
+    )
+    readonly_fields = (
+        'email_with_link',
+        'type',
+        'email_address',
+        'date',
+        'payload',
+    )
@@ -1,4 +1,5 @@
 from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
 
 # Used for linking resent emails to the message.
 #
@@ -7,3 +8,145 @@ from django.conf import settings
 MESSAGE_ID_HEADER_FIELD_NAME = getattr(settings,
                                        'MESSAGE_ID_HEADER_FIELD_NAME',
                                        'X-DjangoPostmarkUtils-Resend-For')
+
+# The secret in the webhook URLs of the default Postmark server (the one whose
+# token the Postmarker email backend uses).
+SECRET = getattr(settings, 'POSTMARK_UTILS_SECRET', None)
+
+# Further Postmark servers webhook notifications are received for, by name,
+# each a dict of its webhook URL "secret", its "token", its Postmark
+# "server_id", and optionally the "read_database" alias its data is read from
+# (by default "POSTMARK_UTILS_READ_DATABASE"), and its own "rate_limit",
+# "burst" and "max_in_flight" webhook receiver limits (by
+# default those of the "POSTMARK_UTILS_RECEIVER_" settings). Notifications
+# received with the default server's secret are stored for the server with
+# their "ServerID", if any.
+SERVERS = getattr(settings, 'POSTMARK_UTILS_SERVERS', {})
+
+# The maximum number of rows written in a single query, when storing webhook
+# events.
+EVENT_BATCH_SIZE = getattr(settings, 'POSTMARK_UTILS_EVENT_BATCH_SIZE', 1000)
+
+# The database alias the app's models are stored in, when using
+# "django_postmark_utils.routers.PostmarkUtilsRouter".
+DATABASE = getattr(settings, 'POSTMARK_UTILS_DATABASE', DEFAULT_DB_ALIAS)
+
+# The database alias (e.g. of a read replica of "DATABASE") used for reads in
+# the admin. Writes, and reads needing the latest data (such as when resending
+# emails), always use "DATABASE".
+READ_DATABASE = getattr(settings, 'POSTMARK_UTILS_READ_DATABASE',
+                        None) or DATABASE
+
+# If emails are stored once the transaction they are sent in is committed,
+# instead of immediately, so that storing them doesn't extend it. Emails sent
+# in a transaction that is rolled back are then never stored, though they were
+# accepted or rejected by Postmark.
+STORE_ON_COMMIT = getattr(settings, 'POSTMARK_UTILS_STORE_ON_COMMIT', False)
+
+# The Django file storage class (as a dotted path) to store serialised message
+# objects in, instead of the database, and the keyword arguments to initialise
+# it with.
+MESSAGE_STORAGE = getattr(settings, 'POSTMARK_UTILS_MESSAGE_STORAGE', None)
+MESSAGE_STORAGE_OPTIONS = getattr(settings,
+                                  'POSTMARK_UTILS_MESSAGE_STORAGE_OPTIONS', {})
+
+# The Django file storage class (as a dotted path) message objects are moved
+# to by the retention policy, when archiving the bodies of old messages, and
+# the keyword arguments to initialise it with.
+COLD_MESSAGE_STORAGE = getattr(settings,
+                               'POSTMARK_UTILS_COLD_MESSAGE_STORAGE', None)
+COLD_MESSAGE_STORAGE_OPTIONS = getattr(
+    settings, 'POSTMARK_UTILS_COLD_MESSAGE_STORAGE_OPTIONS', {})
+
+# The number of rows over which the PostgreSQL planner's estimate is used
+# instead of an exact count, for unfiltered admin changelists of large tables.
+ESTIMATED_COUNT_THRESHOLD = getattr(
+    settings, 'POSTMARK_UTILS_ESTIMATED_COUNT_THRESHOLD', 100000)
+
+# The number of seconds exact counts for admin changelists of large tables are
+# cached for.
+COUNT_CACHE_TIMEOUT = getattr(settings, 'POSTMARK_UTILS_COUNT_CACHE_TIMEOUT',
+                              300)
+
+# The search backend class (as a dotted path) used for admin searches. By
+# default, PostgreSQL trigram indexes or an SQLite FTS5 table are used,
+# depending on the database.
+SEARCH_BACKEND = getattr(settings, 'POSTMARK_UTILS_SEARCH_BACKEND', None)
+
+# The base URL of the Postmark API, used when syncing events from it, and by
+# the "django_postmark_utils.backends.EmailBackend" email backend.
+API_URL = getattr(settings, 'POSTMARK_UTILS_API_URL',
+                  'https://api.postmarkapp.com')
+
+# The sustained number of requests per second each webhook receiver accepts
+# (refilling a token bucket), and the number it accepts in a burst (the size of
+# the bucket, by default the rate). Excess requests get a "429" response, so
+# that Postmark retries them later. "None" for no limit.
+RECEIVER_RATE_LIMIT = getattr(settings, 'POSTMARK_UTILS_RECEIVER_RATE_LIMIT',
+                              None)
+RECEIVER_BURST = getattr(settings, 'POSTMARK_UTILS_RECEIVER_BURST',
+                         None) or RECEIVER_RATE_LIMIT
+
+# The maximum number of requests each webhook receiver handles at once, per
+# process. Excess requests get a "503" response. "None" for no limit.
+RECEIVER_MAX_IN_FLIGHT = getattr(settings,
+                                 'POSTMARK_UTILS_RECEIVER_MAX_IN_FLIGHT', None)
+
+# The number of seconds Postmark is asked to wait before retrying a request
+# rejected for too many requests being in flight.
+RECEIVER_RETRY_AFTER = getattr(settings, 'POSTMARK_UTILS_RECEIVER_RETRY_AFTER',
+                               5)
+
+# The alias of the Django cache the receivers' token buckets and rejection
+# counts are shared across processes through, or "None" to keep them per
+# process.
+RECEIVER_THROTTLE_CACHE = getattr(settings,
+                                  'POSTMARK_UTILS_RECEIVER_THROTTLE_CACHE',
+                                  None)
+
+# The rules deciding how much of each sent message is stored, evaluated in
+# order by the storage policy class (as a dotted path), the first matching rule
+# applying. Each rule is a dict of conditions ("from_email", "tag" and
+# "min_recipients"), the "policy" applied ("full", "headers" or "none"), and
+# optionally the "sample_rate" of matching messages (by a hash of their
+# message ID) which are still stored in full. Messages not matching any rule,
+# and failed sends, are stored in full.
+STORAGE_POLICY = getattr(settings, 'POSTMARK_UTILS_STORAGE_POLICY',
+                         'django_postmark_utils.storage_policy.StoragePolicy')
+STORAGE_RULES = getattr(settings, 'POSTMARK_UTILS_STORAGE_RULES', [])
+
+# The alias of the Django cache the counts of messages stored by each policy
+# are shared across processes through, or "None" to keep them per process.
+STORAGE_POLICY_CACHE = getattr(settings,
+                               'POSTMARK_UTILS_STORAGE_POLICY_CACHE', None)
+
+# The maximum number of times a message is automatically resent, after failing
+# to be sent with a transient error: any error raised while sending (e.g. a
+# network error, or the Postmark API being rate limited or unavailable), or one
+# of the Postmark API error codes of "POSTMARK_UTILS_RETRY_ERROR_CODES" (by
+# default, for maintenance, and having run out of credits). "0" to not resend
+# messages automatically.
+RETRY_MAX_ATTEMPTS = getattr(settings, 'POSTMARK_UTILS_RETRY_MAX_ATTEMPTS', 5)
+RETRY_ERROR_CODES = getattr(settings, 'POSTMARK_UTILS_RETRY_ERROR_CODES',
+                            (100, 405))
+
+# The number of seconds before the first automatic resend of a message, doubled
+# for each further one, up to the maximum. A random jitter of up to half the
+# delay is subtracted from it, so that messages failing together aren't all
+# resent together.
+RETRY_BACKOFF = getattr(settings, 'POSTMARK_UTILS_RETRY_BACKOFF', 60)
+RETRY_MAX_BACKOFF = getattr(settings, 'POSTMARK_UTILS_RETRY_MAX_BACKOFF',
+                            6 * 60 * 60)
+
+# The default and maximum numbers of records returned per page of the change
+# feed.
+CHANGE_FEED_PAGE_SIZE = getattr(settings,
+                                'POSTMARK_UTILS_CHANGE_FEED_PAGE_SIZE', 1000)
+CHANGE_FEED_MAX_PAGE_SIZE = getattr(
+    settings, 'POSTMARK_UTILS_CHANGE_FEED_MAX_PAGE_SIZE', 10000)
+
+# The number of seconds records are held back from the change feed for, after
+# being stored, so that records committed (or replicated) out of order are
+# fed in order, rather than skipped.
+CHANGE_FEED_SETTLE_SECONDS = getattr(
+    settings, 'POSTMARK_UTILS_CHANGE_FEED_SETTLE_SECONDS', 10)
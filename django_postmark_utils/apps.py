@@ -5,6 +5,9 @@ from django.utils.translation import ugettext_lazy as _
 class DjangoPostmarkUtilsConfig(AppConfig):
     name = 'django_postmark_utils'
     verbose_name = _("Django Postmark Utils")
+    # The type of the primary keys of the migrations, whatever the project's
+    # "DEFAULT_AUTO_FIELD" (from Django 3.2)
+    default_auto_field = 'django.db.models.AutoField'
 
     def ready(self):
         from . import signal_handlers  # noqa: F401
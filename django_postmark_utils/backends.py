@@ -1,10 +1,45 @@
+from postmarker.core import DEFAULT_API, PostmarkClient
 from postmarker.django import EmailBackend
 
+from . import app_settings
+
+
+class APIURLPostmarkClient(PostmarkClient):
+    """
+    A Postmark API client for the API at a given URL (e.g. a local stand-in
+    for the Postmark API), instead of the Postmark one.
+    """
+
+    def __init__(self, *args, api_url=None, **kwargs):
+        self.api_url = (api_url or app_settings.API_URL).rstrip('/') + '/'
+        super().__init__(*args, **kwargs)
+
+    def _call(self, method, root, endpoint, *args, **kwargs):
+        # Postmarker has no setting for the API URL, and passes its own as the
+        # root of email API calls (but not e.g. status API ones)
+        if root == DEFAULT_API:
+            root = self.api_url
+        return super()._call(method, root, endpoint, *args, **kwargs)
+
 
 class EmailBackend(EmailBackend):
     """
-    A wrapper that by default quashes exceptions raised while sending messages.
+    A wrapper that by default quashes exceptions raised while sending messages,
+    and sends them to the Postmark API at "api_url" (by default
+    "POSTMARK_UTILS_API_URL").
     """
 
-    def __init__(self, token=None, fail_silently=True, **kwargs):
+    def __init__(self, token=None, fail_silently=True, api_url=None,
+                 **kwargs):
         super().__init__(token=token, fail_silently=fail_silently, **kwargs)
+        self.api_url = api_url
+
+    def open(self):
+        if self.client is None:
+            self.client = APIURLPostmarkClient(
+                server_token=self.server_token,
+                verbosity=self.get_option('VERBOSITY'),
+                api_url=self.api_url,
+            )
+            return True
+        return False
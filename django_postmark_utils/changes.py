@@ -0,0 +1,77 @@
+import base64
+import json
+from collections import namedtuple
+from datetime import timedelta
+
+from dateutil import parser
+from django.db.models import Q
+from django.utils import timezone
+
+from . import app_settings
+from .models import Bounce, Delivery, Email
+
+# The models changes are fed for, by feed name
+FEEDS = {
+    'emails': Email,
+    'bounces': Bounce,
+    'deliveries': Delivery,
+}
+
+Changes = namedtuple('Changes', ('records', 'next_cursor'))
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(feed, created, pk):
+    data = json.dumps([feed, created and created.isoformat(), pk])
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(feed, cursor):
+    """
+    Returns the "(created, id)" of the last record fed, from a cursor of the
+    feed.
+    """
+
+    try:
+        cursor_feed, created, pk = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        if cursor_feed != feed:
+            raise ValueError
+        return (created and parser.parse(created)), int(pk)
+    except (TypeError, ValueError):
+        raise InvalidCursor(cursor)
+
+
+def get_changes(feed, cursor=None, limit=None, using=None):
+    """
+    Returns the records of a feed's model added after the cursor (or from the
+    first one), in the order they were added, as dicts of their fields (with
+    foreign keys as IDs), and the cursor to read the next ones from.
+
+    Each page is read by a single range scan of the "(created, id)" index.
+    Records are only fed once they were stored more than
+    "POSTMARK_UTILS_CHANGE_FEED_SETTLE_SECONDS" ago, so that records whose
+    transactions commit (or are replicated) after records stored later are
+    still fed, rather than skipped.
+    """
+
+    model = FEEDS[feed]
+    using = using or app_settings.READ_DATABASE
+    limit = min(limit or app_settings.CHANGE_FEED_PAGE_SIZE,
+                app_settings.CHANGE_FEED_MAX_PAGE_SIZE)
+    created, last_id = (None, 0) if cursor is None else \
+        decode_cursor(feed, cursor)
+    fields = [field.attname for field in model._meta.concrete_fields]
+    records = model.objects.using(using).filter(
+        created__lt=timezone.now() - timedelta(
+            seconds=app_settings.CHANGE_FEED_SETTLE_SECONDS))
+    if created is not None:
+        records = records.filter(Q(created__gt=created) |
+                                 Q(created=created, id__gt=last_id))
+    records = list(records.order_by('created', 'id').values(*fields)[:limit])
+    if records:
+        created, last_id = records[-1]['created'], records[-1]['id']
+    return Changes(records, encode_cursor(feed, created, last_id))
@@ -0,0 +1,38 @@
+import threading
+from collections import Counter
+
+
+class LocalCounters(object):
+    """
+    Counters kept in process.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def incr(self, name, delta=1):
+        with self.lock:
+            self.counts[name] += delta
+            return self.counts[name]
+
+    def get(self, name):
+        return self.counts[name]
+
+
+class CacheCounters(object):
+    """
+    Counters shared through a Django cache.
+    """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+
+    def incr(self, name, delta=1):
+        key = '{}:{}'.format(self.key, name)
+        self.cache.add(key, 0, None)
+        return self.cache.incr(key, delta)
+
+    def get(self, name):
+        return self.cache.get('{}:{}'.format(self.key, name), 0)
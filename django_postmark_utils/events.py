@@ -0,0 +1,276 @@
+import hashlib
+import json
+import logging
+from collections import namedtuple
+from functools import partial
+
+from dateutil import parser
+from django.db import transaction
+from django.db.models import (Case, CharField, OuterRef, Q, Subquery, Value,
+                              When)
+from django.db.models.functions import Lower
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+
+from . import app_settings
+from .models import Bounce, Delivery, Email, Event
+
+logger = logging.getLogger(__name__)
+
+# Fields of the webhook data not kept in the event payload (in addition to the
+# address and date fields of the record type), either because they are stored
+# in their own columns, or because they can be very large.
+EXCLUDED_PAYLOAD_FIELDS = (
+    'RecordType',
+    'Content',
+)
+
+EventParser = namedtuple('EventParser', [
+    'event_type',
+    'address_field',
+    'date_field',
+    'projection',
+])
+
+# Event parsers, by Postmark webhook record type
+PARSERS = {}
+
+
+def register_parser(record_type, event_type, address_field, date_field,
+                    projection=None):
+    """
+    Registers how to parse webhook data of a Postmark record type.
+
+    The optional projection is called with the parsed events of the record
+    type that were matched to emails (and the database alias they are stored
+    in), to maintain the tables derived from them.
+    """
+
+    PARSERS[record_type] = EventParser(event_type, address_field, date_field,
+                                       projection)
+
+
+# The status changes of emails on being bounced or delivered, to the second
+# status, or to the third if other recipients of the email have been delivered
+# (or bounced)
+BOUNCE_STATUS_CHANGES = (
+    (Email.SUBMITTED, Email.BOUNCED, Email.BOUNCED),
+    (Email.DELIVERED, Email.BOUNCED, Email.PARTIALLY_DELIVERED),
+)
+DELIVERY_STATUS_CHANGES = (
+    (Email.SUBMITTED, Email.DELIVERED, Email.DELIVERED),
+    (Email.BOUNCED, Email.DELIVERED, Email.PARTIALLY_DELIVERED),
+)
+
+
+def get_other_recipients(model, other_model, email_ids, using):
+    """
+    Returns a queryset of the IDs of the emails with records of "model" (e.g.
+    deliveries) for email addresses without records of "other_model" (e.g.
+    bounces).
+    """
+
+    other_addresses = other_model.objects.using(using).filter(
+        email_id=OuterRef('email_id'),
+    ).annotate(address=Lower('email_address')).values('address')
+    return model.objects.using(using).filter(
+        email_id__in=email_ids,
+    ).annotate(address=Lower('email_address')).exclude(
+        address__in=Subquery(other_addresses),
+    ).values('email_id')
+
+
+def change_statuses(events, status_changes, other_recipients, using):
+    """
+    Advances the statuses of the emails of events, in a single conditional
+    update, so that the status changes of concurrent notifications for an
+    email can't be lost: whichever is stored last sees the status set by the
+    other.
+
+    "other_recipients" are the IDs of the emails that have been delivered (or
+    bounced) to other recipients.
+    """
+
+    email_ids = {event.email_id for event, data in events}
+    whens = []
+    for from_status, to_status, partial_status in status_changes:
+        if partial_status != to_status:
+            whens.append(When(
+                Q(status=from_status,
+                  id__in=other_recipients(email_ids, using)),
+                then=Value(partial_status)))
+        whens.append(When(status=from_status, then=Value(to_status)))
+    Email.objects.using(using).filter(
+        id__in=email_ids,
+        status__in=[from_status for from_status, *to_statuses
+                    in status_changes],
+    ).update(
+        status=Case(*whens, output_field=CharField()),
+        status_changed_at=timezone.now(),
+    )
+
+
+def project_bounces(events, using):
+    Bounce.objects.using(using).bulk_create([
+        Bounce(
+            bounce_id=data['ID'],
+            email_id=event.email_id,
+            email_address=event.email_address,
+            date=event.date,
+            type_code=data['TypeCode'],
+            is_inactive=data['Inactive'],
+            can_activate=data['CanActivate'],
+        )
+        for event, data in events
+    ], batch_size=app_settings.EVENT_BATCH_SIZE, ignore_conflicts=True)
+    change_statuses(events, BOUNCE_STATUS_CHANGES,
+                    partial(get_other_recipients, Delivery, Bounce), using)
+
+
+def project_deliveries(events, using):
+    Delivery.objects.using(using).bulk_create([
+        Delivery(
+            email_id=event.email_id,
+            email_address=event.email_address,
+            date=event.date,
+        )
+        for event, data in events
+    ], batch_size=app_settings.EVENT_BATCH_SIZE, ignore_conflicts=True)
+    change_statuses(events, DELIVERY_STATUS_CHANGES,
+                    partial(get_other_recipients, Bounce, Delivery), using)
+
+
+register_parser('Bounce', Event.BOUNCE, 'Email', 'BouncedAt',
+                projection=project_bounces)
+register_parser('Delivery', Event.DELIVERY, 'Recipient', 'DeliveredAt',
+                projection=project_deliveries)
+register_parser('Open', Event.OPEN, 'Recipient', 'ReceivedAt')
+register_parser('Click', Event.CLICK, 'Recipient', 'ReceivedAt')
+register_parser('SpamComplaint', Event.SPAM_COMPLAINT, 'Email', 'BouncedAt')
+register_parser('SubscriptionChange', Event.SUBSCRIPTION_CHANGE, 'Recipient',
+                'ChangedAt')
+
+
+def compact_payload(event_parser, data):
+    excluded_fields = EXCLUDED_PAYLOAD_FIELDS + (event_parser.address_field,
+                                                 event_parser.date_field)
+    return json.dumps(
+        {key: value for key, value in data.items()
+         if key not in excluded_fields},
+        separators=(',', ':'),
+    )
+
+
+def get_idempotency_key(event, data):
+    """
+    Returns a digest of the natural key of an event: the bounce ID of bounces
+    and spam complaints, otherwise its type, Postmark message ID, email
+    address and date (and the link of clicks).
+    """
+
+    if event.type in (Event.BOUNCE, Event.SPAM_COMPLAINT) and 'ID' in data:
+        natural_key = [event.type, data['ID']]
+    else:
+        natural_key = [
+            event.type,
+            data.get('MessageID'),
+            event.email_address.lower(),
+            event.date.astimezone(timezone.utc).isoformat(),
+            data.get('OriginalLink'),
+        ]
+    return hashlib.sha256(json.dumps(natural_key).encode('utf-8')).hexdigest()
+
+
+def get_projections(events, stored_keys):
+    """
+    Returns the events to project, by projection, skipping those already
+    stored (or repeated), and those that weren't matched to emails.
+    """
+
+    projections = {}
+    seen_keys = set(stored_keys)
+    for event_parser, event, data in events:
+        if event.idempotency_key in seen_keys:
+            continue
+        seen_keys.add(event.idempotency_key)
+        if event_parser.projection is None:
+            continue
+        if event.email_id is None:
+            logger.error(_("Email not found for %(type)s notification:\n"
+                           "%(data)s") % {
+                                'type': event.get_type_display().lower(),
+                                'data': data,
+                            })
+            continue
+        projections.setdefault(event_parser.projection, []).append(
+            (event, data))
+    return projections
+
+
+def ingest_events(records, default_record_type=None, using=None):
+    """
+    Appends the events for a batch of Postmark webhook data, and updates the
+    tables projected from them, in the "using" database (by default
+    "POSTMARK_UTILS_DATABASE").
+
+    Events already stored (e.g. as Postmark retries notifications, or when
+    notifications are replayed or synced), or repeated in the batch, are
+    skipped, by their idempotency key, as are their projections, so that
+    they can't change the statuses of emails again.
+
+    Returns the number of events received.
+    """
+
+    using = using or app_settings.DATABASE
+    parsed = []
+    for data in records:
+        record_type = data.get('RecordType', default_record_type)
+        try:
+            event_parser = PARSERS[record_type]
+        except KeyError:
+            logger.error(_("Unknown webhook record type:\n%(data)s") % {
+                'data': data,
+            })
+            continue
+        parsed.append((event_parser, data))
+
+    # Match all the events to their emails in a single query
+    email_ids = dict(
+        Email.objects.using(using).filter(delivery_email_id__in={
+            data.get('MessageID') for event_parser, data in parsed
+        }).values_list('delivery_email_id', 'id')
+    )
+
+    events = []
+    for event_parser, data in parsed:
+        event = Event(
+            type=event_parser.event_type,
+            email_id=email_ids.get(data.get('MessageID')),
+            email_address=data[event_parser.address_field],
+            date=parser.parse(data[event_parser.date_field]),
+            payload=compact_payload(event_parser, data),
+        )
+        event.idempotency_key = get_idempotency_key(event, data)
+        events.append((event_parser, event, data))
+
+    # Without a savepoint when part of a larger transaction (e.g. storing all
+    # the notifications of a request), which is rolled back as a whole
+    with transaction.atomic(using=using, savepoint=False):
+        # Only the events inserted here are projected (the stored keys are
+        # looked up in this transaction, as "bulk_create()" doesn't return
+        # which rows it skipped)
+        stored_keys = set()
+        keys = list({event.idempotency_key
+                     for event_parser, event, data in events})
+        for offset in range(0, len(keys), app_settings.EVENT_BATCH_SIZE):
+            stored_keys.update(Event.objects.using(using).filter(
+                idempotency_key__in=keys[
+                    offset:offset + app_settings.EVENT_BATCH_SIZE],
+            ).values_list('idempotency_key', flat=True))
+        Event.objects.using(using).bulk_create(
+            [event for event_parser, event, data in events],
+            batch_size=app_settings.EVENT_BATCH_SIZE, ignore_conflicts=True)
+        for projection, projected_events in get_projections(
+                events, stored_keys).items():
+            projection(projected_events, using)
+    return len(events)
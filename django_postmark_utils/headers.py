@@ -0,0 +1,87 @@
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+
+from dateutil import parser
+
+from . import app_settings
+
+
+@lru_cache(maxsize=None)
+def get_header_fields(message_id_field_name):
+    """
+    Returns the "MessageHeaders" attributes of the header fields stored, by
+    lowercased header field name.
+    """
+
+    return {
+        'message-id': 'email_id',
+        message_id_field_name.lower(): 'message_id',
+        'date': 'date_string',
+        'subject': 'subject',
+        'from': 'from_email',
+        'to': 'to_emails',
+        'cc': 'cc_emails',
+        'bcc': 'bcc_emails',
+    }
+
+
+def parse_date(date_string):
+    """
+    Parses a "Date" header field, which is in the RFC 5322 format when set by
+    Django, falling back to "dateutil" for other formats.
+    """
+
+    try:
+        date = parsedate_to_datetime(date_string)
+    except (TypeError, ValueError):
+        return parser.parse(date_string)
+    # A "-0000" offset is a UTC date, in a time zone that isn't known
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+
+class MessageHeaders(object):
+    """
+    The header fields of a message that are stored, extracted in a single pass
+    over its headers, without copying them.
+
+    Header fields can also be looked up by name, as from a dictionary (e.g. by
+    storage policies), including those that aren't stored, which are looked
+    up in the message's headers.
+    """
+
+    __slots__ = ('email_id', 'message_id', 'date_string', 'subject',
+                 'from_email', 'to_emails', 'cc_emails', 'bcc_emails',
+                 'message')
+
+    def __init__(self, message):
+        fields = get_header_fields(app_settings.MESSAGE_ID_HEADER_FIELD_NAME)
+        for attname in self.__slots__:
+            setattr(self, attname, None)
+        self.message = message
+        # Later header fields take precedence over earlier ones of the same
+        # name
+        for name, value in message._headers:
+            attname = fields.get(name.lower())
+            if attname is not None:
+                setattr(self, attname, value)
+        if self.message_id is None:
+            self.message_id = self.email_id
+
+    @property
+    def date(self):
+        return parse_date(self.date_string)
+
+    def get(self, name, default=None):
+        attname = get_header_fields(
+            app_settings.MESSAGE_ID_HEADER_FIELD_NAME).get(name.lower())
+        if attname is None:
+            value = None
+            for header_name, header_value in self.message._headers:
+                if header_name.lower() == name.lower():
+                    value = header_value
+        else:
+            value = getattr(self, attname)
+        return default if value is None else value
@@ -0,0 +1,102 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from django_postmark_utils import app_settings
+from django_postmark_utils.models import Message
+from django_postmark_utils.storage import (delete_message_files,
+                                           get_cold_message_storage,
+                                           save_message_obj)
+from django_postmark_utils.storage_policy import FULL
+
+
+class Command(BaseCommand):
+    help = ('Removes (or moves to the cold message storage) the message '
+            'objects of messages stored by Django Postmark Utils that are '
+            'older than `days_ago` (default 30), and whose emails were all '
+            'delivered, without errors or bounces. The messages, emails and '
+            'events are kept, but the messages can no longer be resent.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('days_ago', nargs='?', type=int, default=30)
+        parser.add_argument('--move', action='store_true',
+                            help='Move the message objects to the cold '
+                                 'message storage, instead of removing them')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of messages updated per transaction')
+
+    def get_messages(self, archive_before):
+        # Messages with an email without a delivery (or without emails) are
+        # excluded by the "deliveries__isnull" lookup
+        return Message.objects.filter(created__lt=archive_before,
+                                      storage_policy=FULL,
+                                      message_archived=None)\
+                              .exclude(emails__deliveries__isnull=True)\
+                              .exclude(emails__bounces__isnull=False)\
+                              .exclude(~Q(emails__sending_error=''))\
+                              .exclude(emails__delivery_error_code__gt=0)
+
+    def handle(self, *args, **options):
+        cold_storage = None
+        if options['move']:
+            cold_storage = get_cold_message_storage()
+            if cold_storage is None:
+                raise CommandError('No cold message storage configured')
+        archive_before = timezone.now() - timedelta(days=options['days_ago'])
+        messages = self.get_messages(archive_before).order_by('id')
+        num_archived = 0
+        last_id = 0
+        while True:
+            ids = list(messages.filter(id__gt=last_id)
+                               .values_list('id', flat=True)
+                       [:options['chunk_size']])
+            if not ids:
+                break
+            last_id = ids[-1]
+            num_archived += self.archive(ids, cold_storage)
+        verb = 'moved' if options['move'] else 'removed'
+        self.stdout.write(self.style.SUCCESS(
+            'Message objects of {} messages {}'.format(num_archived, verb)))
+
+    def archive(self, ids, cold_storage):
+        """
+        Archives the message objects of a chunk of messages, in a transaction,
+        then deletes the message files no longer used by any message.
+        """
+
+        now = timezone.now()
+        chunk = Message.objects.filter(id__in=ids, message_archived=None)
+        message_files = {}
+        if cold_storage is not None:
+            # Copied before the transaction, so that it isn't held open while
+            # writing to the cold storage
+            for message in chunk.only('id', 'message_id', 'message_obj',
+                                      'message_file', 'storage_policy',
+                                      'message_archived'):
+                with message.open_message_obj() as f:
+                    message_files[message.id] = save_message_obj(
+                        f.read(), storage=cold_storage)
+        with transaction.atomic(using=app_settings.DATABASE):
+            old_message_files = set(chunk.exclude(message_file='')
+                                         .values_list('message_file',
+                                                      flat=True))
+            if cold_storage is None:
+                num_archived = chunk.update(message_obj=b'', message_file='',
+                                            message_archived=now)
+            else:
+                num_archived = 0
+                for pk, message_file in message_files.items():
+                    num_archived += chunk.filter(id=pk).update(
+                        message_obj=b'', message_file=message_file,
+                        message_archived=now)
+        # Message files are keyed by their content, so only delete those no
+        # longer used by any message
+        old_message_files -= set(
+            Message.objects.filter(message_file__in=old_message_files,
+                                   message_archived=None)
+                           .values_list('message_file', flat=True))
+        delete_message_files(old_message_files)
+        return num_archived
@@ -0,0 +1,93 @@
+import os
+import pickle
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from django_postmark_utils import app_settings
+from django_postmark_utils.models import Message, MessageMetadata
+from django_postmark_utils.storage_policy import FULL
+
+
+def decode_chunk(rows):
+    """
+    Decodes the Postmark tag and metadata from a chunk of
+    `(id, message_obj)` rows.
+
+    Runs in a worker process, so it must not touch the database.
+    """
+
+    decoded = []
+    for pk, message_obj in rows:
+        try:
+            msg = pickle.loads(message_obj)
+        except Exception:
+            continue
+        tag = getattr(msg, 'tag', None) or ''
+        metadata = getattr(msg, 'metadata', None) or {}
+        if tag or metadata:
+            decoded.append((pk, tag, metadata))
+    return decoded
+
+
+class Command(BaseCommand):
+    help = ('Populates the Postmark tag and metadata of messages stored by '
+            'Django Postmark Utils before they were captured, by decoding the '
+            'stored message objects in parallel chunks.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+
+    def chunks(self, chunk_size):
+        # Messages whose message objects weren't stored, or were removed,
+        # can't be decoded
+        queryset = Message.objects.filter(tag='', metadata__isnull=True,
+                                          storage_policy=FULL)\
+                                  .filter(Q(message_archived=None) |
+                                          ~Q(message_file=''))\
+                                  .order_by('id')
+        last_id = 0
+        while True:
+            rows = []
+            messages = queryset.filter(id__gt=last_id)\
+                               .only('id', 'message_obj', 'message_file',
+                                     'storage_policy', 'message_archived')
+            for message in messages[:chunk_size]:
+                with message.open_message_obj() as f:
+                    rows.append((message.pk, f.read()))
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield rows
+
+    def store(self, decoded):
+        with transaction.atomic(using=app_settings.DATABASE):
+            for pk, tag, metadata in decoded:
+                if tag:
+                    Message.objects.filter(id=pk).update(tag=tag)
+            MessageMetadata.objects.bulk_create([
+                MessageMetadata(message_id=pk, key=key, value=str(value))
+                for pk, tag, metadata in decoded
+                for key, value in metadata.items()
+            ])
+        return len(decoded)
+
+    def handle(self, *args, **options):
+        workers = max(options['workers'] or 1, 1)
+        num_updated = 0
+        # Keep a bounded number of chunks in flight, so that only a few chunks
+        # of message objects are held in memory at any one time.
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for rows in self.chunks(options['chunk_size']):
+                pending.append(executor.submit(decode_chunk, rows))
+                if len(pending) >= workers * 2:
+                    num_updated += self.store(pending.popleft().result())
+            while pending:
+                num_updated += self.store(pending.popleft().result())
+        self.stdout.write(self.style.SUCCESS(
+            '{} messages updated'.format(num_updated)))
@@ -0,0 +1,201 @@
+import queue
+import threading
+import time
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.mail import EmailMessage, get_connection
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer
+from django.db import connections
+from django.test.testcases import QuietWSGIRequestHandler
+from django.urls import NoReverseMatch, reverse
+
+from django_postmark_utils import app_settings
+from django_postmark_utils.models import Bounce, Delivery, Email
+from django_postmark_utils.servers import DEFAULT_SERVER, get_server_registry
+from django_postmark_utils.testing.postmark_stub import PostmarkStubServer
+
+BACKEND = 'django_postmark_utils.backends.EmailBackend'
+
+
+class Command(BaseCommand):
+    help = ('Sends emails through the Django Postmark Utils email backend to '
+            'a local stand-in for the Postmark API, which sends their bounce '
+            'and delivery webhook notifications back to the webhook '
+            'receivers, and reports the emails sent, and notifications '
+            'received, per second, with the emails, bounces and deliveries '
+            'stored. Stores them, so should not be run against a production '
+            'database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--emails', type=int, default=1000,
+                            help='Number of emails to send')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of emails sent per API call')
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help='Number of threads sending emails')
+        parser.add_argument('--latency', type=float, nargs='+', default=[0],
+                            help='Seconds each API call is delayed by (or '
+                                 'the minimum and maximum)')
+        parser.add_argument('--error-rate', type=float, default=0,
+                            help='Share of emails rejected by the API')
+        parser.add_argument('--error-code', type=int, default=406,
+                            help='Postmark API error code of rejected emails')
+        parser.add_argument('--request-error-rate', type=float, default=0,
+                            help='Share of API calls failing with a "503" '
+                                 'response')
+        parser.add_argument('--bounce-rate', type=float, default=0.1,
+                            help='Share of recipients bounced')
+        parser.add_argument('--webhook-delay', type=float, default=0,
+                            help='Seconds after emails are sent that their '
+                                 'notifications are sent')
+        parser.add_argument('--overlap', action='store_true',
+                            help='Send notifications while emails are still '
+                                 'being sent (by default, they are held '
+                                 'until all emails are sent, so that they are '
+                                 'not received before their emails are '
+                                 'stored)')
+        parser.add_argument('--webhook-workers', type=int, default=8,
+                            help='Number of threads sending notifications')
+        parser.add_argument('--url',
+                            help='Base URL of the webhook receivers, '
+                                 'including the secret (e.g. '
+                                 'http://localhost:8000/postmark/<secret>/), '
+                                 'instead of serving them in-process')
+        parser.add_argument('--server', default=DEFAULT_SERVER,
+                            help='Name of the Postmark server to send emails '
+                                 'with, and store them for')
+        parser.add_argument('--timeout', type=float, default=300,
+                            help='Seconds to wait for notifications to be '
+                                 'received')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Seed of the errors and bounces injected')
+
+    def handle(self, *args, **options):
+        try:
+            self.server = get_server_registry()[options['server']]
+        except KeyError:
+            raise CommandError('Unknown Postmark server: {}'.format(
+                options['server']))
+        if not 1 <= len(options['latency']) <= 2:
+            raise CommandError('--latency takes one or two values')
+        latency = options['latency'][0] if len(options['latency']) == 1 \
+            else tuple(options['latency'])
+
+        receivers = None
+        url = options['url']
+        if url is None:
+            receivers, url = self.serve_receivers()
+        counts = self.get_counts()
+        try:
+            with PostmarkStubServer(
+                    latency=latency,
+                    request_error_rate=options['request_error_rate'],
+                    error_rate=options['error_rate'],
+                    error_code=options['error_code'],
+                    bounce_rate=options['bounce_rate'],
+                    webhook_url=url,
+                    webhook_delay=options['webhook_delay'],
+                    webhook_workers=options['webhook_workers'],
+                    hold_webhooks=not options['overlap'],
+                    server_id=self.server.server_id,
+                    seed=options['seed']) as api:
+                start = time.monotonic()
+                self.send(api, options['emails'], options['batch_size'],
+                          options['concurrency'])
+                send_duration = time.monotonic() - start
+                api.release_webhooks()
+                received = api.wait_for_webhooks(options['timeout'])
+                self.report(api, options['emails'], send_duration, counts)
+        finally:
+            if receivers is not None:
+                receivers.shutdown()
+                receivers.server_close()
+        if not received:
+            raise CommandError('Timed out waiting for notifications to be '
+                               'received')
+
+    def serve_receivers(self):
+        """
+        Serves the project in a thread, and returns the server, and the base
+        URL of its webhook receivers.
+        """
+
+        try:
+            path = reverse('bounce-receiver',
+                           kwargs={'secret': self.server.secret})
+        except NoReverseMatch:
+            raise CommandError('The webhook receivers are not in the URL '
+                               'configuration; pass their URL with --url')
+        server = ThreadedWSGIServer(('127.0.0.1', 0), QuietWSGIRequestHandler,
+                                    allow_reuse_address=False)
+        server.set_app(WSGIHandler())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, 'http://127.0.0.1:{}{}'.format(
+            server.server_port, path[:-len('bounce-receiver/')])
+
+    def get_counts(self):
+        return [model.objects.using(app_settings.DATABASE).count()
+                for model in (Email, Bounce, Delivery)]
+
+    def send(self, api, num_emails, batch_size, concurrency):
+        batches = queue.Queue()
+        for offset in range(0, num_emails, batch_size):
+            batches.put(range(offset, min(offset + batch_size, num_emails)))
+        threads = [threading.Thread(target=self.sender, args=(api, batches))
+                   for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def sender(self, api, batches):
+        try:
+            with get_connection(BACKEND, token=self.server.token,
+                                api_url=api.url,
+                                fail_silently=True) as connection:
+                while True:
+                    try:
+                        batch = batches.get_nowait()
+                    except queue.Empty:
+                        return
+                    connection.send_messages([EmailMessage(
+                        'Benchmark email {}'.format(num),
+                        'Benchmark email {}'.format(num),
+                        'sender@example.com',
+                        ['recipient{}@example.com'.format(num)],
+                    ) for num in batch])
+        finally:
+            connections.close_all()
+
+    def report(self, api, num_emails, send_duration, counts):
+        accepted = sum(1 for response in api.sent
+                       if response['ErrorCode'] == 0)
+        num_webhooks = sum(api.webhook_statuses.values())
+        webhook_errors = sum(
+            count for status, count in api.webhook_statuses.items()
+            if not isinstance(status, int) or status >= 400)
+        rejected = len(api.sent) - accepted
+        # Emails in failed API calls don't get a response
+        failed = num_emails - len(api.sent)
+        self.stdout.write('Emails: {} ({} accepted, {} rejected, {} in failed '
+                          'API calls)'.format(num_emails, accepted, rejected,
+                                              failed))
+        self.stdout.write('Sending: {:.2f}s, {:.1f} emails/s'.format(
+            send_duration, num_emails / send_duration))
+        if num_webhooks:
+            webhook_duration = api.last_webhook_at - api.first_webhook_at
+            self.stdout.write('Notifications: {:.2f}s, {:.1f}/s'.format(
+                webhook_duration,
+                num_webhooks / webhook_duration if webhook_duration else 0))
+        self.stdout.write('Notification responses: {}'.format(', '.join(
+            '{}: {}'.format(status, count)
+            for status, count in sorted(api.webhook_statuses.items(),
+                                        key=str))))
+        self.stdout.write('Stored: {} emails, {} bounces, {} '
+                          'deliveries'.format(*(
+                              count - initial for count, initial in
+                              zip(self.get_counts(), counts))))
+        num_errors = rejected + failed + webhook_errors
+        style = self.style.ERROR if num_errors else self.style.SUCCESS
+        self.stdout.write(style('{} errors'.format(num_errors)))
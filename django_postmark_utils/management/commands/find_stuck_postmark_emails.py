@@ -0,0 +1,70 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from django_postmark_utils import app_settings
+from django_postmark_utils.models import Email
+
+
+class Command(BaseCommand):
+    help = ('Lists the emails stored by Django Postmark Utils whose status '
+            '(by default "submitted", i.e. neither delivered nor bounced) '
+            "hasn't changed for a number of minutes (default 60), oldest "
+            'first, using the index on the status.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('minutes_ago', nargs='?', type=int, default=60)
+        parser.add_argument('--status', default=Email.SUBMITTED,
+                            choices=[status for status, name in
+                                     Email.STATUS_CHOICES])
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Maximum number of emails listed')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of emails read per query')
+
+    def get_emails(self, status, changed_before, limit, chunk_size):
+        """
+        Yields the "(id, email_id, delivery_email_id, status_changed_at)" rows
+        of the emails, seeking through the index in chunks.
+        """
+
+        emails = Email.objects.using(app_settings.READ_DATABASE)\
+                              .filter(status=status)\
+                              .order_by('status_changed_at', 'id')\
+                              .values_list('id', 'email_id',
+                                           'delivery_email_id',
+                                           'status_changed_at')
+        num_emails = 0
+        last_changed_at, last_id = changed_before, None
+        while limit is None or num_emails < limit:
+            if last_id is None:
+                chunk = emails.filter(status_changed_at__lt=changed_before)
+            else:
+                chunk = emails.filter(
+                    status_changed_at__gte=last_changed_at,
+                    status_changed_at__lt=changed_before,
+                ).exclude(status_changed_at=last_changed_at, id__lte=last_id)
+            size = chunk_size if limit is None else min(chunk_size,
+                                                        limit - num_emails)
+            rows = list(chunk[:size])
+            if not rows:
+                return
+            yield from rows
+            num_emails += len(rows)
+            last_id, last_changed_at = rows[-1][0], rows[-1][3]
+
+    def handle(self, *args, **options):
+        changed_before = timezone.now() - timedelta(
+            minutes=options['minutes_ago'])
+        num_emails = 0
+        for pk, email_id, delivery_email_id, status_changed_at in \
+                self.get_emails(options['status'], changed_before,
+                                options['limit'], options['chunk_size']):
+            self.stdout.write('\t'.join((
+                str(pk), email_id, delivery_email_id or '',
+                status_changed_at.isoformat())))
+            num_emails += 1
+        self.stdout.write(self.style.SUCCESS(
+            '{} {} emails unchanged since {}'.format(
+                num_emails, options['status'], changed_before.isoformat())))
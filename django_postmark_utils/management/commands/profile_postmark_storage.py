@@ -0,0 +1,112 @@
+import gc
+import statistics
+import time
+import tracemalloc
+import uuid
+
+from django.core.mail import EmailMessage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router
+
+from django_postmark_utils.models import Message
+from django_postmark_utils.signal_handlers import store_emails
+
+
+class Command(BaseCommand):
+    help = ('Stores batches of emails as the Postmarker email backend\'s '
+            'signal handlers do, and reports the CPU time and database '
+            'queries (and optionally the peak memory allocated) per message, '
+            'for new messages, and for messages already stored (as when an '
+            'email is stored by both signal handlers). Stores them, so should '
+            'not be run against a production database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batches', type=int, default=5,
+                            help='Number of batches stored (the medians are '
+                                 'reported)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of emails per batch')
+        parser.add_argument('--recipients', type=int, default=2,
+                            help='Number of recipients per email')
+        parser.add_argument('--trace-memory', action='store_true',
+                            help='Also report the peak memory allocated '
+                                 '(which slows storing the emails, so '
+                                 'inflates the CPU time reported)')
+
+    def handle(self, *args, **options):
+        if options['batches'] < 1 or options['batch_size'] < 1:
+            raise CommandError('--batches and --batch-size must be positive')
+        self.connection = connections[router.db_for_write(Message)]
+        results = {'new': [], 'stored': []}
+        for batch in range(options['batches']):
+            messages = self.get_messages(batch, options['batch_size'],
+                                         options['recipients'])
+            results['new'].append(self.profile([
+                (message, {'response': self.get_response()})
+                for message in messages
+            ], options['trace_memory']))
+            results['stored'].append(self.profile([
+                (message, {'exception_str': 'Connection reset'})
+                for message in messages
+            ], options['trace_memory']))
+        for label, key in (('New messages', 'new'),
+                           ('Already stored', 'stored')):
+            cpu, queries, memory = (
+                statistics.median(values) / options['batch_size']
+                for values in zip(*results[key]))
+            line = '{}: {:.1f} us CPU, {:.2f} queries'.format(
+                label, cpu * 1e6, queries)
+            if options['trace_memory']:
+                line += ', {:.2f} KiB peak allocated'.format(memory / 1024)
+            self.stdout.write(line + ', per message')
+
+    def get_messages(self, batch, batch_size, num_recipients):
+        messages = []
+        for num in range(batch_size):
+            message = EmailMessage(
+                'Profiled email {} {}'.format(batch, num),
+                'Profiled email body ' * 50,
+                'Sender <sender@example.com>',
+                ['recipient{}-{}@example.com'.format(num, recipient)
+                 for recipient in range(num_recipients)],
+            ).message()
+            message.tag = 'profile'
+            message.metadata = {'batch': batch}
+            messages.append(message)
+        return messages
+
+    def get_response(self):
+        return {
+            'MessageID': str(uuid.uuid4()),
+            'ErrorCode': 0,
+            'Message': 'OK',
+            'SubmittedAt': '2020-01-01T10:00:00-05:00',
+        }
+
+    def profile(self, emails, trace_memory):
+        """
+        Returns the CPU time, the number of queries, and the peak memory
+        allocated (if traced, otherwise "0"), of storing a batch of emails.
+        """
+
+        queries = []
+
+        def count_queries(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        gc.collect()
+        memory = 0
+        if trace_memory:
+            tracemalloc.start()
+        try:
+            with self.connection.execute_wrapper(count_queries):
+                start = time.process_time()
+                store_emails(emails)
+                cpu = time.process_time() - start
+            if trace_memory:
+                memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+        return cpu, len(queries), memory
@@ -4,6 +4,7 @@ from django.core.management.base import BaseCommand
 from django.utils import timezone
 
 from django_postmark_utils.models import Message
+from django_postmark_utils.storage import delete_message_files, get_cold_message_storage
 
 
 class Command(BaseCommand):
@@ -15,6 +16,21 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         delete_before = timezone.now() - timedelta(days=options['days_ago'])
-        num_objects_deleted, object_list = Message.objects.filter(created__lt=delete_before).delete()
+        messages = Message.objects.filter(created__lt=delete_before)
+        message_files = set(messages.filter(message_archived=None).exclude(message_file='')
+                                    .values_list('message_file', flat=True))
+        cold_message_files = set(messages.exclude(message_archived=None).exclude(message_file='')
+                                         .values_list('message_file', flat=True))
+        num_objects_deleted, object_list = messages.delete()
+        # Message files are keyed by their content, so only delete those no
+        # longer used by any message
+        message_files -= set(Message.objects.filter(message_file__in=message_files, message_archived=None)
+                                            .values_list('message_file', flat=True))
+        delete_message_files(message_files)
+        cold_message_files -= set(Message.objects.filter(message_file__in=cold_message_files)
+                                                 .exclude(message_archived=None)
+                                                 .values_list('message_file', flat=True))
+        if get_cold_message_storage() is not None:
+            delete_message_files(cold_message_files, storage=get_cold_message_storage())
         messages_deleted = object_list.get('django_postmark_utils.Message', 0)
         self.stdout.write(self.style.SUCCESS('{} messages deleted'.format(messages_deleted)))
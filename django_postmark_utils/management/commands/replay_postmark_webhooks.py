@@ -0,0 +1,213 @@
+import json
+import queue
+import random
+import threading
+import time
+from collections import Counter
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from django_postmark_utils import app_settings
+from django_postmark_utils.models import Email
+from django_postmark_utils.servers import DEFAULT_SERVER, get_server_registry
+
+RECEIVERS = {
+    'Bounce': 'bounce-receiver',
+    'Delivery': 'delivery-receiver',
+}
+
+
+def get_record_type(payload):
+    if 'RecordType' in payload:
+        return payload['RecordType']
+    return 'Bounce' if 'BouncedAt' in payload else 'Delivery'
+
+
+def percentile(sorted_values, fraction):
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class Command(BaseCommand):
+    help = ('Fires bounce and delivery webhook notifications at the webhook '
+            'receivers, read from an NDJSON capture or synthesised from '
+            'stored emails, and reports throughput, latencies, errors and '
+            'database queries. Stores the notifications, so should not be run '
+            'against a production database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--input',
+                            help='NDJSON file of webhook notifications')
+        parser.add_argument('--synthesise', type=int, default=0,
+                            help='Number of notifications to synthesise from '
+                                 'stored emails')
+        parser.add_argument('--bounce-ratio', type=float, default=0.1,
+                            help='Share of synthesised notifications which '
+                                 'are bounces')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Notifications per second (default '
+                                 'unlimited)')
+        parser.add_argument('--concurrency', type=int, default=4)
+        parser.add_argument('--url',
+                            help='Base URL of the webhook receivers, '
+                                 'including the secret (e.g. '
+                                 'http://localhost:8000/postmark/<secret>/), '
+                                 'to send over HTTP instead of in-process')
+        parser.add_argument('--server', default=DEFAULT_SERVER,
+                            help='Name of the Postmark server whose emails '
+                                 'to synthesise notifications for, and whose '
+                                 'receivers to send them to in-process')
+
+    def handle(self, *args, **options):
+        try:
+            self.server = get_server_registry()[options['server']]
+        except KeyError:
+            raise CommandError('Unknown Postmark server: {}'.format(
+                options['server']))
+        payloads = []
+        if options['input']:
+            with open(options['input']) as f:
+                payloads.extend(json.loads(line) for line in f if line.strip())
+        if options['synthesise']:
+            payloads.extend(self.synthesise(options['synthesise'],
+                                            options['bounce_ratio']))
+        if not payloads:
+            raise CommandError('No notifications to send')
+
+        self.url = options['url']
+        self.latencies = []
+        self.statuses = Counter()
+        self.num_queries = 0
+        self.lock = threading.Lock()
+        interval = 1 / options['rate'] if options['rate'] else 0
+        start = time.monotonic()
+        tasks = queue.Queue()
+        for num, payload in enumerate(payloads):
+            tasks.put((start + num * interval, payload))
+        threads = [threading.Thread(target=self.worker, args=(tasks,))
+                   for _ in range(options['concurrency'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.monotonic() - start
+        self.report(len(payloads), duration)
+
+    def synthesise(self, num, bounce_ratio):
+        emails = list(Email.objects.using(app_settings.DATABASE)
+                                   .exclude(delivery_email_id=None)
+                                   .values_list('delivery_email_id',
+                                                'message__to_emails')
+                                   .order_by('-id')[:num])
+        if not emails:
+            raise CommandError('No stored emails to synthesise '
+                               'notifications for')
+        now = timezone.now().isoformat()
+        for _ in range(num):
+            email_id, to_emails = random.choice(emails)
+            recipient = to_emails.split(',')[0].strip()
+            if random.random() < bounce_ratio:
+                yield {
+                    'RecordType': 'Bounce',
+                    'ID': random.getrandbits(62),
+                    'Type': 'HardBounce',
+                    'TypeCode': 1,
+                    'MessageID': email_id,
+                    'Email': recipient,
+                    'BouncedAt': now,
+                    'Inactive': False,
+                    'CanActivate': True,
+                }
+            else:
+                yield {
+                    'RecordType': 'Delivery',
+                    'MessageID': email_id,
+                    'Recipient': recipient,
+                    'DeliveredAt': now,
+                }
+
+    def worker(self, tasks):
+        if self.url:
+            session = requests.Session()
+        else:
+            client = Client()
+        try:
+            while True:
+                try:
+                    send_at, payload = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                delay = send_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                receiver = RECEIVERS.get(get_record_type(payload),
+                                         'event-receiver')
+                body = json.dumps(payload)
+                sent_at = time.monotonic()
+                if self.url:
+                    try:
+                        status = session.post(
+                            self.url.rstrip('/') + '/' + receiver + '/',
+                            data=body, timeout=30,
+                            headers={'Content-Type': 'application/json'},
+                        ).status_code
+                    except requests.RequestException as e:
+                        status = type(e).__name__
+                    num_queries = 0
+                else:
+                    connection = connections[app_settings.DATABASE]
+                    with CaptureQueriesContext(connection) as context:
+                        # The test client raises the receivers' exceptions
+                        try:
+                            status = client.post(
+                                reverse(receiver, kwargs={
+                                    'secret': self.server.secret,
+                                }),
+                                body, content_type='application/json',
+                            ).status_code
+                        except Exception as e:
+                            status = type(e).__name__
+                    num_queries = len(context.captured_queries)
+                latency = time.monotonic() - sent_at
+                with self.lock:
+                    self.latencies.append(latency)
+                    self.statuses[status] += 1
+                    self.num_queries += num_queries
+        finally:
+            if self.url:
+                session.close()
+            else:
+                connections.close_all()
+
+    def report(self, num, duration):
+        latencies = sorted(self.latencies)
+        num_errors = sum(count for status, count in self.statuses.items()
+                         if not isinstance(status, int) or status >= 400)
+        self.stdout.write('Notifications: {}'.format(num))
+        self.stdout.write('Duration: {:.2f}s'.format(duration))
+        self.stdout.write('Throughput: {:.1f}/s'.format(num / duration))
+        if latencies:
+            self.stdout.write(
+                'Latency: p50 {:.1f}ms, p95 {:.1f}ms, p99 {:.1f}ms, '
+                'max {:.1f}ms'.format(*(1000 * value for value in (
+                    percentile(latencies, 0.5),
+                    percentile(latencies, 0.95),
+                    percentile(latencies, 0.99),
+                    latencies[-1],
+                ))))
+        # Notifications not sent (e.g. if a worker failed) are errors too
+        num_errors += num - len(latencies)
+        self.stdout.write('Responses: {}'.format(', '.join(
+            '{}: {}'.format(status, count)
+            for status, count in sorted(self.statuses.items(), key=str))))
+        if not self.url:
+            self.stdout.write('Database queries per notification: '
+                              '{:.1f}'.format(self.num_queries / num))
+        style = self.style.ERROR if num_errors else self.style.SUCCESS
+        self.stdout.write(style('{} errors'.format(num_errors)))
@@ -0,0 +1,107 @@
+import logging
+import time
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from postmarker.exceptions import PostmarkerException
+
+from django_postmark_utils import app_settings
+from django_postmark_utils.models import Message
+from django_postmark_utils.retries import get_next_attempt_at
+from django_postmark_utils.utils import ResendEmailMessage
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Resends the messages stored by Django Postmark Utils whose '
+            'emails failed to be sent with a transient error, once they are '
+            'due, with exponential backoff. Several workers can be run at '
+            'once, as each claims the messages it resends.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of messages claimed, and sent in a '
+                                 'single Postmark API call (at most 500)')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Keep polling for messages due to be resent '
+                                 'every this many seconds, instead of exiting '
+                                 'once there are none')
+
+    def claim(self, batch_size):
+        """
+        Claims a batch of the messages due to be resent, by scheduling their
+        next attempt, so that they aren't claimed again (by this or any other
+        worker) unless resending them fails.
+
+        The messages are locked while being claimed, skipping those locked by
+        other workers, on databases supporting it.
+        """
+
+        now = timezone.now()
+        with transaction.atomic(using=app_settings.DATABASE):
+            messages = Message.objects.select_for_update(skip_locked=True)\
+                                      .filter(next_attempt_at__lte=now)\
+                                      .order_by('next_attempt_at')\
+                                      .only('id', 'retry_attempts',
+                                            'next_attempt_at')
+            messages = list(messages[:batch_size])
+            for message in messages:
+                message.retry_attempts += 1
+                message.next_attempt_at = get_next_attempt_at(
+                    message.retry_attempts, now)
+            Message.objects.bulk_update(
+                messages, ['retry_attempts', 'next_attempt_at'])
+        return [message.id for message in messages]
+
+    def resend(self, connection, ids):
+        msgs = []
+        unavailable = []
+        for message in Message.objects.filter(id__in=ids)\
+                                      .only('id', 'message_id', 'message_obj',
+                                            'message_file', 'storage_policy',
+                                            'message_archived'):
+            if not message.has_message_obj:
+                unavailable.append(message.id)
+                continue
+            msgs.append(ResendEmailMessage(message.load_message_obj(),
+                                           message.message_id,
+                                           connection=connection))
+        if unavailable:
+            Message.objects.filter(id__in=unavailable)\
+                           .update(next_attempt_at=None)
+        # The emails are stored by the signal handlers, which schedule the
+        # next attempt, or stop resending the messages
+        try:
+            num_sent = connection.send_messages(msgs) or 0
+        except PostmarkerException as e:
+            # Raised for emails rejected by Postmark, which were stored by the
+            # "post_send" signal handler
+            logger.warning("Emails rejected by Postmark when resent: %s", e)
+            num_sent = 0
+        except Exception:
+            logger.exception("Error encountered while trying to resend "
+                             "emails")
+            num_sent = 0
+        return len(msgs), num_sent
+
+    def handle(self, *args, **options):
+        batch_size = max(1, min(options['batch_size'], 500))
+        num_resent = num_sent = 0
+        # The connection (and its HTTP session) is reused for all the batches
+        with get_connection() as connection:
+            while True:
+                ids = self.claim(batch_size)
+                if ids:
+                    resent, sent = self.resend(connection, ids)
+                    num_resent += resent
+                    num_sent += sent
+                elif options['interval'] is None:
+                    break
+                else:
+                    time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS(
+            '{} messages resent ({} without errors)'.format(num_resent,
+                                                            num_sent)))
@@ -0,0 +1,220 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import pytz
+import requests
+from dateutil import parser as date_parser
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+
+from django_postmark_utils import app_settings
+from django_postmark_utils.events import ingest_events
+from django_postmark_utils.models import Bounce, Delivery, Email, SyncCursor
+from django_postmark_utils.servers import DEFAULT_SERVER, get_server_registry
+
+# The maximum number of results the Postmark API returns per request, and the
+# maximum offset plus count it accepts
+MAX_PAGE_SIZE = 500
+MAX_RESULTS = 10000
+
+# The time zone the Postmark API interprets dates in
+API_TIMEZONE = pytz.timezone('US/Eastern')
+
+CURSOR_NAME = 'events'
+
+
+def format_api_date(date):
+    return date.astimezone(API_TIMEZONE).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+class Command(BaseCommand):
+    help = ('Fetches bounces and deliveries missed by the webhook receivers '
+            'from the Postmark API, for a time window (by default, since the '
+            'last sync, or the last day).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='from_date', type=date_parser.parse,
+                            help='Start of the time window to sync')
+        parser.add_argument('--to', dest='to_date', type=date_parser.parse,
+                            help='End of the time window to sync')
+        parser.add_argument('--window', type=int, default=60,
+                            help='Minutes of events to sync at a time, after '
+                                 'which the sync cursor is saved')
+        parser.add_argument('--delivery-overlap', type=int, default=60,
+                            help='Minutes before the last sync to check the '
+                                 'emails sent in for deliveries again (when '
+                                 'syncing since the last sync), as emails '
+                                 'can be delivered after the sync that '
+                                 'fetched them')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Number of concurrent API requests')
+        parser.add_argument('--api-url', default=app_settings.API_URL)
+        parser.add_argument('--server', default=DEFAULT_SERVER,
+                            help='Name of the Postmark server to sync the '
+                                 'events of')
+        parser.add_argument('--token',
+                            help='Postmark server token (defaults to the '
+                                 "server's token, which for the default "
+                                 'server is the Postmarker email backend '
+                                 'token)')
+
+    def handle(self, *args, **options):
+        try:
+            server = get_server_registry()[options['server']]
+        except KeyError:
+            raise CommandError('Unknown Postmark server: {}'.format(
+                options['server']))
+        self.using = app_settings.DATABASE
+        token = options['token'] or server.token
+        if not token:
+            raise CommandError('No Postmark server token configured')
+        self.api_url = options['api_url'].rstrip('/')
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'X-Postmark-Server-Token': token,
+        })
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=options['workers'])
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        now = timezone.now()
+        cursor = SyncCursor.objects.using(self.using)\
+                                   .filter(name=CURSOR_NAME).first()
+        position = cursor.position if cursor else None
+        start = options['from_date'] or position or now - timedelta(days=1)
+        end = options['to_date'] or now
+        if timezone.is_naive(start):
+            start = timezone.make_aware(start)
+        if timezone.is_naive(end):
+            end = timezone.make_aware(end)
+
+        # Deliveries are fetched for the emails sent in each window, so those
+        # sent shortly before the last sync are checked again
+        overlap_start = start
+        if options['from_date'] is None and position is not None:
+            overlap_start = start - timedelta(
+                minutes=options['delivery_overlap'])
+
+        num_bounces = num_deliveries = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            self.executor = executor
+            window_start = overlap_start
+            while window_start < start:
+                window_end = min(
+                    window_start + timedelta(minutes=options['window']),
+                    start)
+                num_deliveries += self.sync_deliveries(window_start,
+                                                       window_end)
+                window_start = window_end
+            while window_start < end:
+                window_end = min(
+                    window_start + timedelta(minutes=options['window']), end)
+                num_bounces += self.sync_bounces(window_start, window_end)
+                num_deliveries += self.sync_deliveries(window_start,
+                                                       window_end)
+                # Only advance the cursor over windows contiguous with it, so
+                # that backfills don't move it back, or skip a gap
+                if position is None or window_start <= position < window_end:
+                    SyncCursor.objects.using(self.using).update_or_create(
+                        name=CURSOR_NAME, defaults={'position': window_end})
+                    position = window_end
+                window_start = window_end
+        self.session.close()
+        self.stdout.write(self.style.SUCCESS(
+            '{} bounces and {} deliveries synced'.format(num_bounces,
+                                                         num_deliveries)))
+
+    def get(self, path, **params):
+        response = self.session.get(self.api_url + path, params=params,
+                                    timeout=30)
+        response.raise_for_status()
+        return response.json()
+
+    def fetch_pages(self, path, key, start, end, **filters):
+        """
+        Yields the pages of results of a Postmark API list for a time window,
+        fetching all but the first page concurrently.
+
+        Windows with more results than the API can page through are split.
+        """
+
+        params = dict(filters, fromdate=format_api_date(start),
+                      todate=format_api_date(end), count=MAX_PAGE_SIZE)
+        first_page = self.get(path, offset=0, **params)
+        if (first_page['TotalCount'] > MAX_RESULTS and
+                end - start > timedelta(seconds=1)):
+            middle = start + (end - start) / 2
+            yield from self.fetch_pages(path, key, start, middle, **filters)
+            yield from self.fetch_pages(path, key, middle, end, **filters)
+            return
+        yield first_page[key]
+        offsets = range(MAX_PAGE_SIZE,
+                        min(first_page['TotalCount'], MAX_RESULTS),
+                        MAX_PAGE_SIZE)
+        for page in self.executor.map(
+                lambda offset: self.get(path, offset=offset, **params),
+                offsets):
+            yield page[key]
+
+    def sync_bounces(self, start, end):
+        num_bounces = 0
+        for bounces in self.fetch_pages('/bounces', 'Bounces', start, end):
+            # Only store bounces of stored emails, which haven't been stored
+            email_ids = set(
+                Email.objects.using(self.using).filter(delivery_email_id__in=[
+                    bounce['MessageID'] for bounce in bounces
+                ]).values_list('delivery_email_id', flat=True))
+            existing_ids = set(
+                Bounce.objects.using(self.using).filter(
+                    bounce_id__in=[bounce['ID'] for bounce in bounces])
+                .values_list('bounce_id', flat=True))
+            num_bounces += ingest_events([
+                bounce for bounce in bounces
+                if bounce['MessageID'] in email_ids and
+                bounce['ID'] not in existing_ids
+            ], default_record_type='Bounce', using=self.using)
+        return num_bounces
+
+    def get_delivery_records(self, email_id):
+        details = self.get('/messages/outbound/{}/details'.format(email_id))
+        return [{
+            'RecordType': 'Delivery',
+            'MessageID': email_id,
+            'Recipient': event['Recipient'],
+            'DeliveredAt': event['ReceivedAt'],
+            'Details': event.get('Details'),
+        } for event in details.get('MessageEvents', [])
+          if event['Type'] == 'Delivered']
+
+    def sync_deliveries(self, start, end):
+        num_deliveries = 0
+        for messages in self.fetch_pages('/messages/outbound', 'Messages',
+                                         start, end, status='sent'):
+            # Only fetch the details of stored emails with fewer deliveries
+            # than recipients
+            num_of_recipients = {message['MessageID']: len(
+                message.get('Recipients') or [None]) for message in messages}
+            email_ids = [
+                email_id for email_id, num_of_deliveries in
+                Email.objects.using(self.using).filter(
+                    delivery_email_id__in=num_of_recipients)
+                .annotate(num_of_deliveries=Count('deliveries'))
+                .values_list('delivery_email_id', 'num_of_deliveries')
+                if num_of_deliveries < num_of_recipients[email_id]
+            ]
+            records = [record for email_records in
+                       self.executor.map(self.get_delivery_records, email_ids)
+                       for record in email_records]
+            existing = set(
+                Delivery.objects.using(self.using)
+                                .filter(email__delivery_email_id__in=email_ids)
+                .values_list('email__delivery_email_id', 'email_address'))
+            num_deliveries += ingest_events([
+                record for record in records
+                if (record['MessageID'], record['Recipient']) not in existing
+            ], using=self.using)
+        return num_deliveries
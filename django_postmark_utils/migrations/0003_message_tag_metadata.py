@@ -0,0 +1,40 @@
+# Generated by Django 2.2.28 on 2026-10-19 18:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_postmark_utils', '0002_message_created'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='tag',
+            field=models.CharField(blank=True, db_index=True, help_text='The Postmark tag of the email', max_length=255, verbose_name='Tag'),
+        ),
+        migrations.CreateModel(
+            name='MessageMetadata',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='The metadata key', max_length=255, verbose_name='Key')),
+                ('value', models.CharField(blank=True, help_text='The metadata value', max_length=255, verbose_name='Value')),
+                ('message', models.ForeignKey(help_text='The message the metadata is for', on_delete=django.db.models.deletion.CASCADE, related_name='metadata', to='django_postmark_utils.Message', verbose_name='Message')),
+            ],
+            options={
+                'verbose_name': 'message metadata',
+                'verbose_name_plural': 'message metadata',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='messagemetadata',
+            index=models.Index(fields=['key', 'value'], name='django_post_key_80c325_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='messagemetadata',
+            unique_together={('message', 'key')},
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-19 18:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_postmark_utils', '0003_message_tag_metadata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Event',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.PositiveSmallIntegerField(choices=[(1, 'Bounce'), (2, 'Delivery'), (3, 'Open'), (4, 'Click'), (5, 'Spam complaint'), (6, 'Subscription change')], help_text='The type of the event', verbose_name='Type')),
+                ('email_address', models.CharField(help_text='The email address the event is for', max_length=255, verbose_name='Email address')),
+                ('date', models.DateTimeField(help_text='When the event happened', verbose_name='Date')),
+                ('payload', models.TextField(blank=True, help_text='The webhook data, in compact JSON format, without the fields stored separately and any full content dumps', verbose_name='Payload')),
+                ('email', models.ForeignKey(blank=True, help_text='The email the event is for, if it was found', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='events', to='django_postmark_utils.Email', verbose_name='Email')),
+            ],
+            options={
+                'verbose_name': 'event',
+                'verbose_name_plural': 'events',
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['type', 'date'], name='django_post_type_d36885_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['email', 'type'], name='django_post_email_i_1d746b_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-19 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_postmark_utils', '0004_event'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='message_file',
+            field=models.CharField(blank=True, help_text='The key the message object is kept under in the message storage, if not kept in the database', max_length=255, verbose_name='Message file'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='message_size',
+            field=models.PositiveIntegerField(blank=True, help_text='The size of the message object, in bytes', null=True, verbose_name='Message size'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='message_obj',
+            field=models.BinaryField(blank=True, default=b'', help_text='Serialisation of the originally-sent "email.message.Message" (or a subclass) object, in pickle format, if not kept in the message storage', verbose_name='Message object'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-19 18:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_postmark_utils', '0005_message_storage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bounce',
+            index=models.Index(fields=['date', 'id'], name='django_post_date_d2acfb_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(fields=['date', 'id'], name='django_post_date_315d54_idx'),
+        ),
+    ]
@@ -0,0 +1,78 @@
+from django.conf import settings
+from django.db import migrations
+
+FTS_TABLE = 'django_postmark_utils_message_fts'
+MESSAGE_TABLE = 'django_postmark_utils_message'
+TRIGRAM_INDEXED_FIELDS = (
+    'subject',
+    'to_emails',
+    'cc_emails',
+    'bcc_emails',
+)
+
+
+def create_search_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        # Creating the extension needs elevated privileges, and building the
+        # indexes of a large table takes a while, so they're opt-in (see the
+        # README for creating them manually)
+        if not getattr(settings, 'POSTMARK_UTILS_TRIGRAM_INDEXES', False):
+            return
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension "
+                           "WHERE extname = 'pg_trgm'")
+            if cursor.fetchone() is None:
+                cursor.execute('CREATE EXTENSION pg_trgm')
+        # Matches the "UPPER(...) LIKE UPPER(...)" lookups used by Django for
+        # "icontains", and doesn't lock the table against writes
+        for field in TRIGRAM_INDEXED_FIELDS:
+            schema_editor.execute(
+                'CREATE INDEX CONCURRENTLY IF NOT EXISTS {table}_{field}_trgm '
+                'ON {table} '
+                'USING gin (UPPER("{field}"::text) gin_trgm_ops)'.format(
+                    table=MESSAGE_TABLE, field=field))
+    elif vendor == 'sqlite':
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute('PRAGMA compile_options')
+            if 'ENABLE_FTS5' not in {row[0] for row in cursor.fetchall()}:
+                return
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE {} USING fts5(subject, recipients)'.format(
+                FTS_TABLE))
+        schema_editor.execute(
+            "INSERT INTO {fts_table} (rowid, subject, recipients) "
+            "SELECT id, subject, to_emails || ' ' || cc_emails || ' ' || "
+            "bcc_emails FROM {table}".format(fts_table=FTS_TABLE,
+                                             table=MESSAGE_TABLE))
+        schema_editor.execute(
+            'CREATE TRIGGER {fts_table}_delete AFTER DELETE ON {table} '
+            'BEGIN DELETE FROM {fts_table} WHERE rowid = old.id; END'.format(
+                fts_table=FTS_TABLE, table=MESSAGE_TABLE))
+
+
+def drop_search_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        for field in TRIGRAM_INDEXED_FIELDS:
+            schema_editor.execute(
+                'DROP INDEX CONCURRENTLY IF EXISTS {}_{}_trgm'.format(
+                    MESSAGE_TABLE, field))
+    elif vendor == 'sqlite':
+        schema_editor.execute('DROP TRIGGER IF EXISTS {}_delete'.format(
+            FTS_TABLE))
+        schema_editor.execute('DROP TABLE IF EXISTS {}'.format(FTS_TABLE))
+
+
+class Migration(migrations.Migration):
+
+    # Indexes can't be created concurrently in a transaction
+    atomic = False
+
+    dependencies = [
+        ('django_postmark_utils', '0006_date_id_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-19 18:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_postmark_utils', '0007_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncCursor',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='The name of what is synced', max_length=255, unique=True, verbose_name='Name')),
+                ('position', models.DateTimeField(help_text='The time up to which everything has been synced', verbose_name='Position')),
+            ],
+            options={
+                'verbose_name': 'sync cursor',
+                'verbose_name_plural': 'sync cursors',
+            },
+        ),
+    ]
@@ -0,0 +1,114 @@
+# Generated by Django 2.2.28 on 2026-10-19 18:18
+
+from email.utils import getaddresses
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+CHUNK_SIZE = 1000
+
+# The indexes of the bounce and delivery email addresses, by model name
+ADDRESS_INDEXES = {
+    'bounce': models.Index(fields=['email_address', 'date', 'id'],
+                           name='django_post_email_a_7d7977_idx'),
+    'delivery': models.Index(fields=['email_address', 'date', 'id'],
+                             name='django_post_email_a_4b19b7_idx'),
+}
+
+# The length of the email address prefix indexed on MySQL, which can't index
+# text columns, and limits keys to 767 bytes (191 4-byte characters)
+MYSQL_PREFIX_LENGTH = 191
+
+
+def create_recipients(apps, schema_editor):
+    Message = apps.get_model('django_postmark_utils', 'Message')
+    Recipient = apps.get_model('django_postmark_utils', 'Recipient')
+    db_alias = schema_editor.connection.alias
+    messages = Message.objects.using(db_alias)\
+                              .only('to_emails', 'cc_emails', 'bcc_emails')\
+                              .order_by('id')
+    last_id = 0
+    while True:
+        chunk = list(messages.filter(id__gt=last_id)[:CHUNK_SIZE])
+        if not chunk:
+            break
+        recipients = {}
+        for message in chunk:
+            for recipient_type, emails in ((1, message.to_emails),
+                                           (2, message.cc_emails),
+                                           (3, message.bcc_emails)):
+                for name, address in getaddresses([emails]):
+                    address = address.strip().lower()[:255]
+                    if address:
+                        recipients[message.id, recipient_type, address] = \
+                            Recipient(message_id=message.id,
+                                      type=recipient_type,
+                                      email_address=address)
+        Recipient.objects.using(db_alias).bulk_create(recipients.values())
+        last_id = chunk[-1].id
+
+
+def create_address_indexes(apps, schema_editor):
+    for model_name, index in ADDRESS_INDEXES.items():
+        model = apps.get_model('django_postmark_utils', model_name)
+        if schema_editor.connection.vendor == 'mysql':
+            quote_name = schema_editor.quote_name
+            schema_editor.execute(
+                'CREATE INDEX {} ON {} ({}({}), {}, {})'.format(
+                    quote_name(index.name), quote_name(model._meta.db_table),
+                    quote_name('email_address'), MYSQL_PREFIX_LENGTH,
+                    quote_name('date'), quote_name('id')))
+        else:
+            schema_editor.add_index(model, index)
+
+
+def drop_address_indexes(apps, schema_editor):
+    for model_name, index in ADDRESS_INDEXES.items():
+        schema_editor.remove_index(
+            apps.get_model('django_postmark_utils', model_name), index)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_postmark_utils', '0008_synccursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Recipient',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.PositiveSmallIntegerField(choices=[(1, 'To'), (2, 'Cc'), (3, 'Bcc')], help_text='The header field the recipient is in', verbose_name='Type')),
+                ('email_address', models.CharField(help_text='The email address of the recipient, in lower case', max_length=255, verbose_name='Email address')),
+            ],
+            options={
+                'verbose_name': 'recipient',
+                'verbose_name_plural': 'recipients',
+            },
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(create_address_indexes,
+                                     drop_address_indexes),
+            ],
+            state_operations=[
+                migrations.AddIndex(model_name=model_name, index=index)
+                for model_name, index in ADDRESS_INDEXES.items()
+            ],
+        ),
+        migrations.AddField(
+            model_name='recipient',
+            name='message',
+            field=models.ForeignKey(help_text='The message the recipient is for', on_delete=django.db.models.deletion.CASCADE, related_name='recipients', to='django_postmark_utils.Message', verbose_name='Message'),
+        ),
+        migrations.AddIndex(
+            model_name='recipient',
+            index=models.Index(fields=['email_address', 'message'], name='django_post_email_a_092e36_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='recipient',
+            unique_together={('message', 'type', 'email_address')},
+        ),
+        migrations.RunPython(create_recipients, migrations.RunPython.noop),
+    ]
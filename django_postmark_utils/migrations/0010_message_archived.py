@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 18:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_postmark_utils', '0009_recipient_address_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='message_archived',
+            field=models.DateTimeField(blank=True, help_text='When the message object was moved to the cold message storage (if there is a message file), or removed, by the retention policy', null=True, verbose_name='Message archived'),
+        ),
+    ]
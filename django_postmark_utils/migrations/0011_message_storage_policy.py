@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 18:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_postmark_utils', '0010_message_archived'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='storage_policy',
+            field=models.CharField(choices=[('full', 'Full'), ('headers', 'Headers only'), ('none', 'None')], default='full', help_text='How much of the message was stored when it was sent: the message object and headers, only the headers, or neither', max_length=7, verbose_name='Storage policy'),
+        ),
+    ]
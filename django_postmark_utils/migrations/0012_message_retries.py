@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-19 18:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_postmark_utils', '0011_message_storage_policy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, help_text='When the message is next to be automatically resent, if sending it failed with a transient error', null=True, verbose_name='Next attempt at'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='retry_attempts',
+            field=models.PositiveIntegerField(default=0, help_text='The number of times the message has been automatically resent, after failing to be sent', verbose_name='Retry attempts'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['next_attempt_at'], name='django_post_next_at_1f0283_idx'),
+        ),
+    ]
@@ -0,0 +1,106 @@
+# Generated by Django 2.2.28 on 2026-10-19 18:32
+
+from django.db import migrations, models
+from django.db.models import F, Max, OuterRef, Q, Subquery
+from django.db.models.functions import Lower
+import django.utils.timezone
+
+CHUNK_SIZE = 1000
+
+
+def get_other_recipients(model, other_model, email_ids, db_alias):
+    """
+    Returns a queryset of the IDs of the emails with records of "model" (e.g.
+    deliveries) for email addresses without records of "other_model" (e.g.
+    bounces), as when statuses are changed on receiving notifications.
+    """
+
+    other_addresses = other_model.objects.using(db_alias).filter(
+        email_id=OuterRef('email_id'),
+    ).annotate(address=Lower('email_address')).values('address')
+    return model.objects.using(db_alias).filter(
+        email_id__in=email_ids,
+    ).annotate(address=Lower('email_address')).exclude(
+        address__in=Subquery(other_addresses),
+    ).values('email_id')
+
+
+def set_statuses(apps, schema_editor):
+    """
+    Sets the statuses of existing emails from their errors, bounces and
+    deliveries, and when they were last changed to their dates.
+    """
+
+    Bounce = apps.get_model('django_postmark_utils', 'Bounce')
+    Delivery = apps.get_model('django_postmark_utils', 'Delivery')
+    Email = apps.get_model('django_postmark_utils', 'Email')
+    db_alias = schema_editor.connection.alias
+    emails = Email.objects.using(db_alias)
+    failed = ~Q(sending_error='') | Q(delivery_error_code__gt=0) | \
+        Q(delivery_error_code__lt=0)
+    last_id = 0
+    while True:
+        ids = list(emails.filter(id__gt=last_id)
+                         .order_by('id')
+                         .values_list('id', flat=True)[:CHUNK_SIZE])
+        if not ids:
+            break
+        chunk = emails.filter(id__gt=last_id, id__lte=ids[-1])
+        last_id = ids[-1]
+        chunk.update(status_changed_at=F('date'))
+        chunk.filter(failed).update(status='failed')
+        chunk = chunk.exclude(failed)
+        delivered = Delivery.objects.using(db_alias)\
+                                    .filter(email_id__in=ids)\
+                                    .values('email_id')
+        bounced = Bounce.objects.using(db_alias)\
+                                .filter(email_id__in=ids)\
+                                .values('email_id')
+        chunk.filter(id__in=delivered).exclude(id__in=bounced)\
+             .update(status='delivered')
+        chunk.filter(id__in=bounced).exclude(id__in=delivered)\
+             .update(status='bounced')
+        # Partially delivered if delivered to some recipients and bounced for
+        # others, otherwise (if delivered to, and bounced for, the same
+        # recipients) whichever happened last
+        both = chunk.filter(id__in=delivered).filter(id__in=bounced)
+        both.filter(Q(id__in=get_other_recipients(Delivery, Bounce, ids,
+                                                  db_alias)) |
+                    Q(id__in=get_other_recipients(Bounce, Delivery, ids,
+                                                  db_alias)))\
+            .update(status='partially_delivered')
+        last_dates = both.exclude(status='partially_delivered').annotate(
+            last_delivered=Max('deliveries__date'),
+            last_bounced=Max('bounces__date'),
+        ).values_list('id', 'last_delivered', 'last_bounced')
+        statuses = {'delivered': [], 'bounced': []}
+        for email_id, last_delivered, last_bounced in last_dates:
+            statuses['delivered' if last_delivered > last_bounced
+                     else 'bounced'].append(email_id)
+        for status, status_ids in statuses.items():
+            emails.filter(id__in=status_ids).update(status=status)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_postmark_utils', '0012_message_retries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='status',
+            field=models.CharField(choices=[('failed', 'Failed'), ('submitted', 'Submitted'), ('delivered', 'Delivered'), ('bounced', 'Bounced'), ('partially_delivered', 'Partially delivered')], default='submitted', help_text='If sending the email failed, or else if it was delivered, bounced or both, as notified by Postmark', max_length=19, verbose_name='Status'),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='status_changed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='When the status was last changed', verbose_name='Status changed at'),
+        ),
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(fields=['status', 'status_changed_at', 'id'], name='django_post_status_7d5783_idx'),
+        ),
+        migrations.RunPython(set_statuses, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 18:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_postmark_utils', '0013_email_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='idempotency_key',
+            field=models.CharField(blank=True, help_text='A digest of the natural key of the event (its bounce ID, or its type, Postmark message ID, email address and date), so that notifications received more than once (e.g. when retried by Postmark) are only stored once', max_length=64, null=True, unique=True, verbose_name='Idempotency key'),
+        ),
+    ]
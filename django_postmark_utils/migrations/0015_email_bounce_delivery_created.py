@@ -0,0 +1,44 @@
+# Generated by Django 2.2.28 on 2026-10-19 19:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_postmark_utils', '0014_event_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bounce',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now, help_text='When the bounce was stored', verbose_name='Created'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='delivery',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now, help_text='When the delivery was stored', verbose_name='Created'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now, help_text='When the email was stored', verbose_name='Created'),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='bounce',
+            index=models.Index(fields=['created', 'id'], name='django_post_created_74215b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='delivery',
+            index=models.Index(fields=['created', 'id'], name='django_post_created_4f4585_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(fields=['created', 'id'], name='django_post_created_82754f_idx'),
+        ),
+    ]
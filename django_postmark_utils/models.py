@@ -1,21 +1,87 @@
+import io
+import pickle
+from email.utils import getaddresses
+
+from django.core.exceptions import ImproperlyConfigured
 from django.db import models
+from django.utils import timezone
 from django.utils.functional import lazy
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
+from .storage import get_cold_message_storage, get_message_storage
+from .storage_policy import FULL, HEADERS, NONE
+
 mark_safe_lazy = lazy(mark_safe, str)
 
 
+class MessageObjectUnavailable(Exception):
+    """
+    Raised when reading a message object removed by the retention policy.
+    """
+
+
 class Message(models.Model):
     """
     Email message content.
     """
 
+    STORAGE_POLICY_CHOICES = (
+        (FULL, _("Full")),
+        (HEADERS, _("Headers only")),
+        (NONE, _("None")),
+    )
+
     message_obj = models.BinaryField(
         _('Message object'),
+        blank=True,
+        default=b'',
         help_text=_('Serialisation of the originally-sent '
                     '"email.message.Message" (or a subclass) object, in '
-                    'pickle format')
+                    'pickle format, if not kept in the message storage')
+    )
+    message_file = models.CharField(
+        _("Message file"),
+        max_length=255,
+        blank=True,
+        help_text=_("The key the message object is kept under in the message "
+                    "storage, if not kept in the database")
+    )
+    message_size = models.PositiveIntegerField(
+        _("Message size"),
+        null=True,
+        blank=True,
+        help_text=_("The size of the message object, in bytes")
+    )
+    storage_policy = models.CharField(
+        _("Storage policy"),
+        max_length=7,
+        choices=STORAGE_POLICY_CHOICES,
+        default=FULL,
+        help_text=_("How much of the message was stored when it was sent: "
+                    "the message object and headers, only the headers, or "
+                    "neither")
+    )
+    message_archived = models.DateTimeField(
+        _("Message archived"),
+        null=True,
+        blank=True,
+        help_text=_("When the message object was moved to the cold message "
+                    "storage (if there is a message file), or removed, by the "
+                    "retention policy")
+    )
+    retry_attempts = models.PositiveIntegerField(
+        _("Retry attempts"),
+        default=0,
+        help_text=_("The number of times the message has been automatically "
+                    "resent, after failing to be sent")
+    )
+    next_attempt_at = models.DateTimeField(
+        _("Next attempt at"),
+        null=True,
+        blank=True,
+        help_text=_("When the message is next to be automatically resent, if "
+                    "sending it failed with a transient error")
     )
     message_id = models.CharField(
         _("Message ID"),
@@ -55,11 +121,159 @@ class Message(models.Model):
         help_text=_("The 'Bcc' field of the email, with email addresses "
                     "separated by commas")
     )
+    tag = models.CharField(
+        _("Tag"),
+        max_length=255,
+        blank=True,
+        db_index=True,
+        help_text=_("The Postmark tag of the email")
+    )
     created = models.DateTimeField(auto_now_add=True, db_index=True)
 
     class Meta:
         verbose_name = _("message")
         verbose_name_plural = _("messages")
+        indexes = [
+            models.Index(fields=['next_attempt_at']),
+        ]
+
+    @property
+    def has_message_obj(self):
+        """
+        If the message object was stored, and hasn't been removed by the
+        retention policy, so the message can be downloaded and resent.
+        """
+
+        return self.storage_policy == FULL and (
+            self.message_archived is None or bool(self.message_file))
+
+    def open_message_obj(self):
+        """
+        Returns a file object for reading the message object, from the
+        (cold) message storage or the database.
+        """
+
+        if not self.has_message_obj:
+            raise MessageObjectUnavailable(self.message_id)
+        if self.message_archived is not None:
+            cold_storage = get_cold_message_storage()
+            if cold_storage is None:
+                raise ImproperlyConfigured(
+                    'The message object of message {} is archived, but '
+                    'POSTMARK_UTILS_COLD_MESSAGE_STORAGE is not '
+                    'configured.'.format(self.message_id))
+            return cold_storage.open(self.message_file, 'rb')
+        if self.message_file:
+            return get_message_storage().open(self.message_file, 'rb')
+        return io.BytesIO(self.message_obj)
+
+    def load_message_obj(self):
+        """
+        Deserialises the message object, reading it from the file it is kept
+        in, if stored in a message storage.
+        """
+
+        with self.open_message_obj() as f:
+            return pickle.load(f)
+
+
+class MessageMetadata(models.Model):
+    """
+    Email message Postmark metadata, as key-value pairs.
+    """
+
+    message = models.ForeignKey(
+        'Message',
+        verbose_name=_("Message"),
+        on_delete=models.CASCADE,
+        related_name='metadata',
+        help_text=_("The message the metadata is for")
+    )
+    key = models.CharField(
+        _("Key"),
+        max_length=255,
+        help_text=_("The metadata key")
+    )
+    value = models.CharField(
+        _("Value"),
+        max_length=255,
+        blank=True,
+        help_text=_("The metadata value")
+    )
+
+    class Meta:
+        verbose_name = _("message metadata")
+        verbose_name_plural = _("message metadata")
+        unique_together = ('message', 'key')
+        indexes = [
+            models.Index(fields=['key', 'value']),
+        ]
+
+    def __str__(self):
+        return '{}: {}'.format(self.key, self.value)
+
+
+class Recipient(models.Model):
+    """
+    Email message recipient, for looking up messages by email address.
+    """
+
+    TO = 1
+    CC = 2
+    BCC = 3
+    TYPE_CHOICES = (
+        (TO, _("To")),
+        (CC, _("Cc")),
+        (BCC, _("Bcc")),
+    )
+
+    message = models.ForeignKey(
+        'Message',
+        verbose_name=_("Message"),
+        on_delete=models.CASCADE,
+        related_name='recipients',
+        help_text=_("The message the recipient is for")
+    )
+    type = models.PositiveSmallIntegerField(
+        _("Type"),
+        choices=TYPE_CHOICES,
+        help_text=_("The header field the recipient is in")
+    )
+    email_address = models.CharField(
+        _("Email address"),
+        max_length=255,
+        help_text=_("The email address of the recipient, in lower case")
+    )
+
+    class Meta:
+        verbose_name = _("recipient")
+        verbose_name_plural = _("recipients")
+        unique_together = ('message', 'type', 'email_address')
+        indexes = [
+            models.Index(fields=['email_address', 'message']),
+        ]
+
+    def __str__(self):
+        return self.email_address
+
+    @classmethod
+    def for_message(cls, message):
+        """
+        Returns the (unsaved) recipients of a message, parsed from its "To",
+        "Cc" and "Bcc" header fields.
+        """
+
+        recipients = {}
+        for recipient_type, emails in ((cls.TO, message.to_emails),
+                                       (cls.CC, message.cc_emails),
+                                       (cls.BCC, message.bcc_emails)):
+            for name, address in getaddresses([emails]):
+                address = address.strip().lower()[:255]
+                if address:
+                    recipients[recipient_type, address] = cls(
+                        message=message, type=recipient_type,
+                        email_address=address)
+        return list(recipients.values())
 
 
 class Email(models.Model):
@@ -67,6 +281,24 @@ class Email(models.Model):
     Email message metadata.
     """
 
+    # From "submitted", statuses change to "delivered" or "bounced" as the
+    # email is delivered or bounced, and to "partially delivered" once it was
+    # delivered to some recipients and bounced for others (it has a delivery,
+    # or bounce, for an address, lowercased, without the other). Partially
+    # delivered emails keep their status.
+    FAILED = 'failed'
+    SUBMITTED = 'submitted'
+    DELIVERED = 'delivered'
+    BOUNCED = 'bounced'
+    PARTIALLY_DELIVERED = 'partially_delivered'
+    STATUS_CHOICES = (
+        (FAILED, _("Failed")),
+        (SUBMITTED, _("Submitted")),
+        (DELIVERED, _("Delivered")),
+        (BOUNCED, _("Bounced")),
+        (PARTIALLY_DELIVERED, _("Partially delivered")),
+    )
+
     message = models.ForeignKey(
         'Message',
         verbose_name=_("Message"),
@@ -118,11 +350,34 @@ class Email(models.Model):
         blank=True,
         help_text=_("The response message from Postmark")
     )
+    status = models.CharField(
+        _("Status"),
+        max_length=19,
+        choices=STATUS_CHOICES,
+        default=SUBMITTED,
+        help_text=_("If sending the email failed, or else if it was "
+                    "delivered, bounced or both, as notified by Postmark")
+    )
+    status_changed_at = models.DateTimeField(
+        _("Status changed at"),
+        default=timezone.now,
+        help_text=_("When the status was last changed")
+    )
+    created = models.DateTimeField(
+        _("Created"),
+        auto_now_add=True,
+        help_text=_("When the email was stored")
+    )
 
     class Meta:
         verbose_name = _("email")
         verbose_name_plural = _("emails")
         ordering = ['-date']
+        indexes = [
+            models.Index(fields=['date', 'id']),
+            models.Index(fields=['status', 'status_changed_at', 'id']),
+            models.Index(fields=['created', 'id']),
+        ]
 
 
 class Bounce(models.Model):
@@ -163,11 +418,21 @@ class Bounce(models.Model):
         _("Can activate"),
         help_text=_("If the email address can be activated again")
     )
+    created = models.DateTimeField(
+        _("Created"),
+        auto_now_add=True,
+        help_text=_("When the bounce was stored")
+    )
 
     class Meta:
         verbose_name = _("bounce")
         verbose_name_plural = _("bounces")
         ordering = ['-date']
+        indexes = [
+            models.Index(fields=['date', 'id']),
+            models.Index(fields=['email_address', 'date', 'id']),
+            models.Index(fields=['created', 'id']),
+        ]
 
 
 class Delivery(models.Model):
@@ -190,9 +455,119 @@ class Delivery(models.Model):
         _("Date"),
         help_text=_("When the delivery was made")
     )
+    created = models.DateTimeField(
+        _("Created"),
+        auto_now_add=True,
+        help_text=_("When the delivery was stored")
+    )
 
     class Meta:
         verbose_name = _("delivery")
         verbose_name_plural = _("deliveries")
         unique_together = ('email', 'email_address')
         ordering = ['-date']
+        indexes = [
+            models.Index(fields=['email_address', 'date', 'id']),
+            models.Index(fields=['created', 'id']),
+        ]
+
+
+class Event(models.Model):
+    """
+    Email event data, as received in Postmark webhook notifications.
+
+    Events are only ever appended. Bounces and deliveries are additionally
+    projected into their own tables.
+    """
+
+    BOUNCE = 1
+    DELIVERY = 2
+    OPEN = 3
+    CLICK = 4
+    SPAM_COMPLAINT = 5
+    SUBSCRIPTION_CHANGE = 6
+    TYPE_CHOICES = (
+        (BOUNCE, _("Bounce")),
+        (DELIVERY, _("Delivery")),
+        (OPEN, _("Open")),
+        (CLICK, _("Click")),
+        (SPAM_COMPLAINT, _("Spam complaint")),
+        (SUBSCRIPTION_CHANGE, _("Subscription change")),
+    )
+
+    type = models.PositiveSmallIntegerField(
+        _("Type"),
+        choices=TYPE_CHOICES,
+        help_text=_("The type of the event")
+    )
+    email = models.ForeignKey(
+        'Email',
+        verbose_name=_("Email"),
+        on_delete=models.CASCADE,
+        related_name='events',
+        null=True,
+        blank=True,
+        help_text=_("The email the event is for, if it was found")
+    )
+    email_address = models.CharField(
+        _("Email address"),
+        max_length=255,
+        help_text=_("The email address the event is for")
+    )
+    date = models.DateTimeField(
+        _("Date"),
+        help_text=_("When the event happened")
+    )
+    payload = models.TextField(
+        _("Payload"),
+        blank=True,
+        help_text=_("The webhook data, in compact JSON format, without the "
+                    "fields stored separately and any full content dumps")
+    )
+    idempotency_key = models.CharField(
+        _("Idempotency key"),
+        max_length=64,
+        unique=True,
+        null=True,
+        blank=True,
+        help_text=_("A digest of the natural key of the event (its bounce ID, "
+                    "or its type, Postmark message ID, email address and "
+                    "date), so that notifications received more than once "
+                    "(e.g. when retried by Postmark) are only stored once")
+    )
+
+    class Meta:
+        verbose_name = _("event")
+        verbose_name_plural = _("events")
+        ordering = ['-date']
+        indexes = [
+            models.Index(fields=['type', 'date']),
+            models.Index(fields=['email', 'type']),
+        ]
+
+    def __str__(self):
+        return '{} {}'.format(self.get_type_display(), self.email_address)
+
+
+class SyncCursor(models.Model):
+    """
+    How far events have been synced from the Postmark API.
+    """
+
+    name = models.CharField(
+        _("Name"),
+        max_length=255,
+        unique=True,
+        help_text=_("The name of what is synced")
+    )
+    position = models.DateTimeField(
+        _("Position"),
+        help_text=_("The time up to which everything has been synced")
+    )
+
+    class Meta:
+        verbose_name = _("sync cursor")
+        verbose_name_plural = _("sync cursors")
+
+    def __str__(self):
+        return self.name
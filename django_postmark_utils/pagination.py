@@ -0,0 +1,190 @@
+import base64
+import hashlib
+import json
+
+import django
+from dateutil import parser
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ORDER_VAR, PAGE_VAR, ChangeList
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from . import app_settings
+
+CURSOR_VAR = 'cursor'
+EXACT_COUNT_VAR = 'exact_count'
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Avoids counting all the rows of large tables.
+
+    For unfiltered querysets on PostgreSQL, the planner's estimate of the
+    number of rows in the table is used, if it is over
+    "POSTMARK_UTILS_ESTIMATED_COUNT_THRESHOLD". Otherwise, the exact count is
+    cached for "POSTMARK_UTILS_COUNT_CACHE_TIMEOUT" seconds.
+    """
+
+    # If the count is the planner's estimate
+    is_estimate = False
+
+    def __init__(self, *args, exact=False, **kwargs):
+        self.exact = exact
+        super().__init__(*args, **kwargs)
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if self.exact:
+            return queryset.count()
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples::bigint FROM pg_class '
+                               'WHERE relname = %s AND relnamespace = '
+                               'to_regnamespace(current_schema())::oid',
+                               [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] > app_settings.ESTIMATED_COUNT_THRESHOLD:
+                self.is_estimate = True
+                return row[0]
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        cache_key = 'django_postmark_utils:count:{}'.format(
+            hashlib.md5('{}:{}:{}'.format(queryset.db, sql, params)
+                        .encode('utf-8')).hexdigest())
+        count = cache.get(cache_key)
+        if count is None:
+            count = queryset.count()
+            cache.set(cache_key, count, app_settings.COUNT_CACHE_TIMEOUT)
+        return count
+
+
+def encode_cursor(obj):
+    data = json.dumps([obj.date.isoformat(), obj.pk])
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        date_string, pk = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return parser.parse(date_string), int(pk)
+    except (TypeError, ValueError):
+        raise IncorrectLookupParameters
+
+
+class KeysetChangeList(ChangeList):
+    """
+    Pages through the changelist by seeking to the `(date, id)` of the last
+    object on the previous page, instead of using an offset, when using the
+    default (newest first) ordering, so that each page costs the same to load.
+
+    The count may be an estimate, or stale, so it is only displayed, and pages
+    are always limited to "list_per_page" objects.
+    """
+
+    keyset = False
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        lookup_params.pop(EXACT_COUNT_VAR, None)
+        return lookup_params
+
+    @property
+    def page_index(self):
+        """
+        The 0-based index of the page (Django's "page_num" is 1-based from
+        Django 3.2).
+        """
+
+        if django.VERSION >= (3, 2):
+            return self.page_num - 1
+        return self.page_num
+
+    def get_results(self, request):
+        super().get_results(request)
+        self.cursor = request.GET.get(CURSOR_VAR)
+        show_all = self.show_all and self.can_show_all
+        self.keyset = ORDER_VAR not in request.GET and not show_all
+        if not self.keyset:
+            if not show_all and not self.multi_page:
+                # Django returns every object when there's a single page
+                offset = self.page_index * self.list_per_page
+                self.result_list = \
+                    self.queryset[offset:offset + self.list_per_page]
+            return
+        queryset = self.queryset
+        if self.cursor:
+            date, pk = decode_cursor(self.cursor)
+            queryset = queryset.filter(Q(date__lt=date) |
+                                       Q(date=date, pk__lt=pk))
+        elif self.page_index:
+            # Seek from an offset page only once
+            queryset = queryset[self.page_index * self.list_per_page:]
+        self.keyset_queryset = queryset
+
+    @cached_property
+    def keyset_results(self):
+        """
+        Loads the page, and the first object of the next one, if any.
+        """
+
+        return list(self.keyset_queryset[:self.list_per_page + 1])
+
+    # Like Django's, the page is only loaded when displayed (e.g. not when an
+    # action is run)
+    @property
+    def result_list(self):
+        if self.keyset:
+            return self.keyset_results[:self.list_per_page]
+        return self._result_list
+
+    @result_list.setter
+    def result_list(self, result_list):
+        self._result_list = result_list
+
+    @property
+    def next_page_url(self):
+        if not self.keyset or len(self.keyset_results) <= self.list_per_page:
+            return None
+        return self.get_query_string({
+            CURSOR_VAR: encode_cursor(self.result_list[-1]),
+            PAGE_VAR: None,
+        })
+
+    @property
+    def first_page_url(self):
+        return self.get_query_string({CURSOR_VAR: None, PAGE_VAR: None})
+
+    @property
+    def exact_count_url(self):
+        return self.get_query_string({EXACT_COUNT_VAR: '1'})
+
+
+class KeysetPaginationAdminMixin(object):
+    """
+    Uses keyset pagination and estimated counts in the changelist, for models
+    with a "date" field, and a "(date, id)" index.
+    """
+
+    change_list_template = \
+        'admin/django_postmark_utils/keyset_change_list.html'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_paginator(self, request, queryset, per_page, orphans=0,
+                      allow_empty_first_page=True):
+        return self.paginator(queryset, per_page, orphans,
+                              allow_empty_first_page,
+                              exact=EXACT_COUNT_VAR in request.GET)
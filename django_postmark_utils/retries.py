@@ -0,0 +1,44 @@
+import random
+from datetime import timedelta
+
+from django.utils import timezone
+
+from . import app_settings
+
+
+def is_retryable(sending_error, error_code):
+    """
+    If sending an email failed with a transient error, so that its message is
+    to be resent automatically.
+
+    Errors raised while sending (e.g. network errors) are stored without an
+    error code, as the Postmark API wasn't reached, and failed API calls (e.g.
+    with a "503" response) with the error code of the response.
+    """
+
+    if sending_error and error_code in (None, 0):
+        return True
+    return error_code in app_settings.RETRY_ERROR_CODES
+
+
+def get_retry_delay(attempts):
+    """
+    Returns the number of seconds to wait before resending a message that has
+    already been resent "attempts" times, with exponential backoff and jitter.
+    """
+
+    delay = min(app_settings.RETRY_MAX_BACKOFF,
+                app_settings.RETRY_BACKOFF * 2 ** attempts)
+    return delay - random.uniform(0, delay / 2)
+
+
+def get_next_attempt_at(attempts, now=None):
+    """
+    Returns when to resend a message that has already been resent "attempts"
+    times, or "None" if it has been resent the maximum number of times.
+    """
+
+    if attempts >= app_settings.RETRY_MAX_ATTEMPTS:
+        return None
+    now = now or timezone.now()
+    return now + timedelta(seconds=get_retry_delay(attempts))
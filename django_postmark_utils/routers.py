@@ -0,0 +1,37 @@
+from . import app_settings
+
+
+class PostmarkUtilsRouter(object):
+    """
+    Routes the app's models to the "POSTMARK_UTILS_DATABASE" database.
+
+    Reads of objects related to an instance use the database the instance was
+    read from, so that admin pages read from "POSTMARK_UTILS_READ_DATABASE"
+    keep doing so.
+    """
+
+    app_label = 'django_postmark_utils'
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != self.app_label:
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        return app_settings.DATABASE
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != self.app_label:
+            return None
+        return app_settings.DATABASE
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if (obj1._meta.app_label == self.app_label and
+                obj2._meta.app_label == self.app_label):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label != self.app_label:
+            return None
+        return db == app_settings.DATABASE
@@ -0,0 +1,181 @@
+import re
+from functools import reduce
+from operator import and_, or_
+
+from django.contrib.admin.utils import get_fields_from_path
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from . import app_settings
+
+# Patterns of the IDs that can be looked up exactly, using unique indexes
+MESSAGE_ID = 'message_id'
+POSTMARK_ID = 'postmark_id'
+BOUNCE_ID = 'bounce_id'
+ID_PATTERNS = (
+    # The 'Message-ID' header field of an email, or a message ID
+    (MESSAGE_ID, re.compile(r'^<[^<>@\s]+@[^<>@\s]+>$')),
+    # The ID of an email, as set by Postmark
+    (POSTMARK_ID, re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                             r'[0-9a-f]{4}-[0-9a-f]{12}$', re.IGNORECASE)),
+    # The ID of a bounce, as set by Postmark
+    (BOUNCE_ID, re.compile(r'^[0-9]+$')),
+)
+
+# The SQLite FTS5 table indexing message subjects and recipients
+FTS_TABLE = 'django_postmark_utils_message_fts'
+
+
+def get_id_type(search_term):
+    for id_type, pattern in ID_PATTERNS:
+        if pattern.match(search_term):
+            return id_type
+    return None
+
+
+class SearchBackend(object):
+    """
+    Searches the text fields of a model, using a database-specific index.
+
+    The base backend returns "None", so that the admin falls back to its
+    default search.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def search(self, queryset, fields, search_term):
+        return None
+
+    def index_message(self, message):
+        """
+        Called by "store_email" when a message is created.
+        """
+
+        pass
+
+
+class TrigramSearchBackend(SearchBackend):
+    """
+    Matches each word of the search term against any of the fields, as the
+    admin does, but without following relations, so that the PostgreSQL
+    trigram indexes on the fields can be used.
+    """
+
+    def search(self, queryset, fields, search_term):
+        return queryset.filter(reduce(and_, (
+            reduce(or_, (Q(**{field + '__icontains': word})
+                         for field in fields))
+            for word in search_term.split()
+        )))
+
+
+class FTS5SearchBackend(SearchBackend):
+    """
+    Matches the words of the search term (as prefixes) against the SQLite FTS5
+    table of message subjects and recipients, which is kept in sync by
+    "store_email".
+    """
+
+    # Whether the FTS5 table is in each database, by alias, so that databases
+    # without it aren't introspected on each search, and each message stored
+    # (it's created by a migration, so a restart picks it up)
+    fts_tables = {}
+
+    def has_fts_table(self):
+        alias = self.connection.alias
+        if alias not in self.fts_tables:
+            self.fts_tables[alias] = \
+                FTS_TABLE in self.connection.introspection.table_names()
+        return self.fts_tables[alias]
+
+    def search(self, queryset, fields, search_term):
+        if not self.has_fts_table():
+            return None
+        query = ' '.join('"{}"*'.format(word.replace('"', '""'))
+                         for word in search_term.split())
+        return queryset.filter(id__in=RawSQL(
+            'SELECT rowid FROM {} WHERE {} MATCH %s'.format(FTS_TABLE,
+                                                            FTS_TABLE),
+            [query]))
+
+    def index_message(self, message):
+        if not self.has_fts_table():
+            return
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {} (rowid, subject, recipients) '
+                'VALUES (%s, %s, %s)'.format(FTS_TABLE),
+                [message.id, message.subject, ' '.join([
+                    message.to_emails, message.cc_emails, message.bcc_emails,
+                ])])
+
+
+DEFAULT_BACKENDS = {
+    'postgresql': TrigramSearchBackend,
+    'sqlite': FTS5SearchBackend,
+}
+
+
+def get_search_backend(using):
+    connection = connections[using]
+    if app_settings.SEARCH_BACKEND:
+        backend_class = import_string(app_settings.SEARCH_BACKEND)
+    else:
+        backend_class = DEFAULT_BACKENDS.get(connection.vendor, SearchBackend)
+    return backend_class(connection)
+
+
+class SearchBackendAdminMixin(object):
+    """
+    Searches using unique-index equality lookups for exact IDs, and the
+    database's search backend for text, before falling back to the default
+    admin search.
+
+    "exact_search_fields" maps the ID types in "ID_PATTERNS" to the fields to
+    look them up in, and "text_search_fields" lists the fields to search with
+    the search backend, of the model related by "text_search_relation", if
+    set (e.g. the message of an email).
+    """
+
+    exact_search_fields = {}
+    text_search_fields = ()
+    text_search_relation = None
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if search_term:
+            fields = self.exact_search_fields.get(get_id_type(search_term))
+            if fields:
+                # Look up each field separately, so that each lookup can use
+                # its unique index
+                manager = queryset.model._default_manager.db_manager(
+                    queryset.db)
+                ids = set()
+                for field in fields:
+                    ids.update(manager.filter(**{field: search_term})
+                                      .values_list('id', flat=True))
+                return queryset.filter(id__in=ids), False
+            if self.text_search_fields:
+                results = self.get_text_search_results(queryset,
+                                                       search_term)
+                if results is not None:
+                    return results, False
+        return super().get_search_results(request, queryset, search_term)
+
+    def get_text_search_results(self, queryset, search_term):
+        backend = get_search_backend(queryset.db)
+        if self.text_search_relation is None:
+            return backend.search(queryset, self.text_search_fields,
+                                  search_term)
+        related_model = get_fields_from_path(
+            queryset.model, self.text_search_relation)[-1].related_model
+        related = backend.search(
+            related_model._default_manager.db_manager(queryset.db).all(),
+            self.text_search_fields, search_term)
+        if related is None:
+            return None
+        return queryset.filter(**{self.text_search_relation + '__in':
+                                  related.values('id')})
@@ -0,0 +1,144 @@
+from collections import namedtuple
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.crypto import salted_hmac
+
+from . import app_settings
+
+# The name of the server configured by "POSTMARK_UTILS_SECRET" and the
+# Postmarker email backend token (every server's data is stored in
+# "POSTMARK_UTILS_DATABASE", with the sent emails its notifications are matched
+# to)
+DEFAULT_SERVER = 'default'
+
+Server = namedtuple('Server', (
+    'name', 'secret', 'token', 'server_id', 'read_database',
+    'rate_limit', 'burst', 'max_in_flight',
+))
+
+
+def get_secret_digest(secret):
+    """
+    Returns a keyed digest of a webhook URL secret, so that secrets can be
+    looked up in a map, without the lookup time depending on how much of a
+    guessed secret is correct.
+    """
+
+    return salted_hmac('django_postmark_utils.servers', secret).digest()
+
+
+def get_server_id(data):
+    # Bounce webhook data has a "ServerID" field, delivery webhook data a
+    # "ServerId" one
+    server_id = data.get('ServerID', data.get('ServerId'))
+    try:
+        return int(server_id)
+    except (TypeError, ValueError):
+        return None
+
+
+class ServerRegistry(object):
+    """
+    The Postmark servers webhook notifications are received for, looked up
+    by the digest of their webhook URL secret, or by their Postmark server ID.
+    """
+
+    def __init__(self, servers):
+        self.servers = {}
+        self.by_secret_digest = {}
+        self.by_server_id = {}
+        for server in servers:
+            if server.name in self.servers:
+                raise ImproperlyConfigured(
+                    'Duplicate Postmark server: {}'.format(server.name))
+            self.servers[server.name] = server
+            if server.secret:
+                digest = get_secret_digest(server.secret)
+                if digest in self.by_secret_digest:
+                    raise ImproperlyConfigured(
+                        'Postmark servers {} and {} have the same secret'
+                        .format(self.by_secret_digest[digest].name,
+                                server.name))
+                self.by_secret_digest[digest] = server
+            if server.server_id is not None:
+                # Server IDs are numbers, but may be configured as strings
+                try:
+                    server_id = int(server.server_id)
+                except (TypeError, ValueError):
+                    raise ImproperlyConfigured(
+                        'Invalid server ID of Postmark server {}: {!r}'
+                        .format(server.name, server.server_id))
+                if server_id in self.by_server_id:
+                    raise ImproperlyConfigured(
+                        'Postmark servers {} and {} have the same server ID'
+                        .format(self.by_server_id[server_id].name,
+                                server.name))
+                self.by_server_id[server_id] = server
+
+    def __iter__(self):
+        return iter(self.servers.values())
+
+    def __getitem__(self, name):
+        return self.servers[name]
+
+    def get_by_secret(self, secret):
+        """
+        Returns the server with a webhook URL secret, or "None".
+        """
+
+        return self.by_secret_digest.get(get_secret_digest(secret))
+
+    def route(self, server, records):
+        """
+        Groups webhook data received with the secret of a server by the server
+        it is stored for: that server, or for data received with the default
+        server's secret, the server with its "ServerID", if registered.
+        """
+
+        if server.name != DEFAULT_SERVER or not self.by_server_id:
+            return {server: records} if records else {}
+        routes = {}
+        for data in records:
+            routes.setdefault(
+                self.by_server_id.get(get_server_id(data), server), []
+            ).append(data)
+        return routes
+
+
+@lru_cache(maxsize=None)
+def get_server_registry():
+    servers = [Server(
+        name=DEFAULT_SERVER,
+        secret=app_settings.SECRET,
+        token=getattr(settings, 'POSTMARK', {}).get('TOKEN'),
+        server_id=None,
+        read_database=app_settings.READ_DATABASE,
+        rate_limit=app_settings.RECEIVER_RATE_LIMIT,
+        burst=app_settings.RECEIVER_BURST,
+        max_in_flight=app_settings.RECEIVER_MAX_IN_FLIGHT,
+    )]
+    for name, options in app_settings.SERVERS.items():
+        if 'database' in options:
+            raise ImproperlyConfigured(
+                'Postmark server {} has a "database" option, but every '
+                "server's data is stored in POSTMARK_UTILS_DATABASE, with the "
+                'sent emails'.format(name))
+        # The burst defaults to the server's own rate limit, if it has one
+        burst = options.get('burst', None if 'rate_limit' in options
+                            else app_settings.RECEIVER_BURST)
+        servers.append(Server(
+            name=name,
+            secret=options.get('secret'),
+            token=options.get('token'),
+            server_id=options.get('server_id'),
+            read_database=options.get('read_database',
+                                      app_settings.READ_DATABASE),
+            rate_limit=options.get('rate_limit',
+                                   app_settings.RECEIVER_RATE_LIMIT),
+            burst=burst,
+            max_in_flight=options.get('max_in_flight',
+                                      app_settings.RECEIVER_MAX_IN_FLIGHT),
+        ))
+    return ServerRegistry(servers)
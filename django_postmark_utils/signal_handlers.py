@@ -1,37 +1,131 @@
+import logging
 import pickle
 
-from dateutil import parser
+from django.db import IntegrityError, router, transaction
 from django.dispatch import receiver
 from django.utils.encoding import force_text
+from django.utils.translation import ugettext as _
 from postmarker.django.backend import EmailBackend
 from postmarker.django.signals import on_exception, post_send
-from postmarker.exceptions import PostmarkerException
+from postmarker.exceptions import ClientError, PostmarkerException
 
-from . import app_settings
-from .models import Email, Message
+from . import app_settings, backends
+from .headers import MessageHeaders
+from .models import Email, Message, MessageMetadata, Recipient
+from .retries import get_next_attempt_at, is_retryable
+from .search import get_search_backend
+from .storage import get_message_storage, save_message_obj
+from .storage_policy import FULL, HEADERS, NONE, get_storage_policy
 
+logger = logging.getLogger(__name__)
 
-def store_email(message, response={}, exception_str=''):
+
+def serialise_message_obj(message):
+    """
+    Returns the "Message" field values of a serialised message object, saved in
+    the message storage, if configured.
+    """
 
     message_obj = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    message_size = len(message_obj)
+    message_file = ''
+    if get_message_storage() is not None:
+        message_file = save_message_obj(message_obj)
+        message_obj = b''
+    return {
+        'message_obj': message_obj,
+        'message_file': message_file,
+        'message_size': message_size,
+    }
+
+
+def create_or_get(model, defaults, **lookup):
+    """
+    Creates an object known not to exist, without first looking it up, as
+    "get_or_create" does, unless it was created concurrently.
+    """
+
+    try:
+        with transaction.atomic(using=router.db_for_write(model)):
+            return model.objects.create(**lookup, **defaults), True
+    except IntegrityError as e:
+        error = e
+    # Not if the create failed for another reason (e.g. a "NOT NULL"
+    # constraint)
+    try:
+        return model.objects.get(**lookup), False
+    except model.DoesNotExist:
+        raise error
+
+
+def get_message_fields(headers, tag):
+    """
+    Returns the "Message" field values of a message's header fields, and tag.
+    """
+
+    return {
+        'subject': headers.subject or '',
+        'from_email': headers.from_email or '',
+        'to_emails': headers.to_emails or '',
+        'cc_emails': headers.cc_emails or '',
+        'bcc_emails': headers.bcc_emails or '',
+        'tag': tag,
+    }
+
+
+class StoredRecords(object):
+    """
+    The messages, and the IDs of the emails, already stored for a batch of
+    messages, looked up in a query each (per chunk of the batch), rather than
+    per message. Records created by "store_email" are added.
+    """
+
+    chunk_size = 500
 
-    header_data = dict(message._headers)
-    header_email_id = header_data['Message-ID']
-    header_message_id = header_data.get(
-        app_settings.MESSAGE_ID_HEADER_FIELD_NAME, header_email_id)
-    header_date_string = header_data['Date']
-    header_date = parser.parse(header_date_string)
-    header_subject = header_data['Subject']
-    header_from = header_data['From']
-    header_to = header_data['To']
-    header_cc = header_data.get('Cc', '')
-    header_bcc = header_data.get('Bcc', '')
+    def __init__(self, headers):
+        message_ids = list({message_headers.message_id
+                            for message_headers in headers})
+        email_ids = list({message_headers.email_id
+                          for message_headers in headers})
+        self.messages = {}
+        self.email_ids = set()
+        messages = Message.objects.only('id', 'message_id', 'storage_policy',
+                                        'retry_attempts', 'next_attempt_at')
+        for offset in range(0, len(message_ids), self.chunk_size):
+            chunk = message_ids[offset:offset + self.chunk_size]
+            self.messages.update((message.message_id, message) for message
+                                 in messages.filter(message_id__in=chunk))
+        emails = Email.objects.values_list('email_id', flat=True)
+        for offset in range(0, len(email_ids), self.chunk_size):
+            chunk = email_ids[offset:offset + self.chunk_size]
+            self.email_ids.update(emails.filter(email_id__in=chunk))
+
+
+def store_email(message, response={}, exception_str='', headers=None,
+                stored=None):
+    """
+    Stores a message and its email, using the message's header fields, and
+    the records already stored, if already looked up (e.g. for a batch).
+    """
+
+    if headers is None:
+        headers = MessageHeaders(message)
+    if stored is None:
+        stored = StoredRecords([headers])
+
+    # Set on the message by the Postmarker email backend, or by the
+    # "on_exception" signal handler.
+    tag = getattr(message, 'tag', None) or ''
+    metadata = getattr(message, 'metadata', None) or {}
 
     response_submitted_at = response.get('SubmittedAt', None)
     response_email_id = response.get('MessageID', None)
     response_error_code = response.get('ErrorCode', None)
     response_message = response.get('Message', '')
 
+    # Failed sends are always stored in full, for investigating the errors
+    failed = bool(exception_str) or response_error_code not in (None, 0)
+
     # If called by the "post_send" signal handler, retrieve the message if this
     # is a resend, otherwise create a new one.
     #
@@ -41,42 +135,134 @@ def store_email(message, response={}, exception_str=''):
     # the "post_send" signal handler, if a non Postmark API error (e.g. a
     # network error) was encountered while trying to make the API call to send
     # the email.
-    message, created = Message.objects.get_or_create(
-        message_id=header_message_id,
-        defaults={
-            'message_obj': message_obj,
-            'subject': header_subject,
-            'from_email': header_from,
-            'to_emails': header_to,
-            'cc_emails': header_cc,
-            'bcc_emails': header_bcc,
-        },
-    )
+    #
+    # The message object is only serialised (and saved in the message storage,
+    # if configured) if the message is to be created, or it was created
+    # without it, and sending the email failed, and only as much of the
+    # message as the storage policy allows is stored.
+    stored_message = stored.messages.get(headers.message_id)
+    created = False
+    if stored_message is None:
+        storage_policy = get_storage_policy()
+        policy = storage_policy.get_policy(headers.message_id, headers, tag,
+                                           failed)
+        defaults = {'storage_policy': policy}
+        if policy == FULL:
+            defaults.update(serialise_message_obj(message))
+        if policy in (FULL, HEADERS):
+            defaults.update(get_message_fields(headers, tag))
+        stored_message, created = create_or_get(
+            Message, defaults, message_id=headers.message_id)
+        # Not when stored concurrently (e.g. by the other signal handler)
+        if created:
+            storage_policy.count(policy)
+        # The serialised message object isn't kept for the rest of the batch
+        # (it's deferred, so loaded if accessed)
+        del stored_message.message_obj
+        stored.messages[headers.message_id] = stored_message
+    elif failed and stored_message.storage_policy != FULL:
+        # Messages stored without the headers weren't indexed either
+        created = stored_message.storage_policy == NONE
+        header_fields = get_message_fields(headers, tag)
+        Message.objects.filter(id=stored_message.id).update(
+            storage_policy=FULL,
+            **header_fields,
+            **serialise_message_obj(message))
+        stored_message.storage_policy = FULL
+        for name, value in header_fields.items():
+            setattr(stored_message, name, value)
+    if created and stored_message.storage_policy != NONE:
+        get_search_backend(stored_message._state.db)\
+            .index_message(stored_message)
+        Recipient.objects.bulk_create(Recipient.for_message(stored_message))
+        if metadata:
+            MessageMetadata.objects.bulk_create([
+                MessageMetadata(message=stored_message, key=key,
+                                value=str(value))
+                for key, value in metadata.items()
+            ])
 
     # If called by the "post_send" signal handler, create a new email.
     #
-    # If called by the "on_exception" signal handler, retrieve the email if
-    # it was already created in the call by the "post_send" signal handler,
-    # otherwise create a new one. It might not have been created in a call by
-    # the "post_send" signal handler, if a non Postmark API error (e.g. a
-    # network error) was encountered while trying to make the API call to send
-    # the email.
-    Email.objects.get_or_create(
-        email_id=header_email_id,
-        defaults={
-            'message': message,
-            'date': header_date,
+    # If called by the "on_exception" signal handler, skip the email if it was
+    # already created in the call by the "post_send" signal handler, otherwise
+    # create a new one. It might not have been created in a call by the
+    # "post_send" signal handler, if a non Postmark API error (e.g. a network
+    # error) was encountered while trying to make the API call to send the
+    # email.
+    email_created = False
+    if headers.email_id not in stored.email_ids:
+        email, email_created = create_or_get(Email, {
+            'message': stored_message,
+            'date': headers.date,
             'sending_error': exception_str,
             'delivery_submission_date': response_submitted_at,
             'delivery_email_id': response_email_id,
             'delivery_error_code': response_error_code,
             'delivery_message': response_message,
-        },
-    )
+            'status': Email.FAILED if failed else Email.SUBMITTED,
+        }, email_id=headers.email_id)
+        stored.email_ids.add(headers.email_id)
+
+    # Schedule resending the message if sending the email failed with a
+    # transient error, unless it's already scheduled (e.g. when resent by the
+    # "retry_failed_postmark_emails" command), otherwise stop resending it.
+    if email_created:
+        messages = Message.objects.filter(id=stored_message.id)
+        if is_retryable(exception_str, response_error_code):
+            next_attempt_at = get_next_attempt_at(
+                stored_message.retry_attempts)
+            if stored_message.next_attempt_at is None and next_attempt_at:
+                messages.filter(next_attempt_at=None)\
+                        .update(next_attempt_at=next_attempt_at)
+                stored_message.next_attempt_at = next_attempt_at
+        elif stored_message.next_attempt_at is not None:
+            messages.update(next_attempt_at=None)
+            stored_message.next_attempt_at = None
+
+
+def store_emails(emails):
+    """
+    Stores the "(message, kwargs)" pairs passed, using "store_email".
+
+    If so configured, this is deferred until the transaction the emails are
+    being sent in (if any) is committed.
+    """
+
+    def _store_emails():
+        headers = []
+        for message, kwargs in emails:
+            try:
+                headers.append(MessageHeaders(message))
+            except Exception:
+                headers.append(None)
+        # If looking up the records already stored fails, they are looked up
+        # per email instead, so that the error is logged for each
+        try:
+            stored = StoredRecords([message_headers for message_headers
+                                    in headers if message_headers])
+        except Exception:
+            stored = None
+        for (message, kwargs), message_headers in zip(emails, headers):
+            try:
+                store_email(message, headers=message_headers, stored=stored,
+                            **kwargs)
+            except Exception:
+                logger.exception(_("Error encountered while trying to store "
+                                   "email"))
+
+    if app_settings.STORE_ON_COMMIT:
+        transaction.on_commit(_store_emails)
+    else:
+        _store_emails()
 
 
+# The signals are sent by the class of the backend used, so the handlers are
+# connected for both the Postmarker email backend and the one wrapping it
 @receiver(post_send, sender=EmailBackend,
           dispatch_uid='django_postmark_utils_store_emails_on_send')
+@receiver(post_send, sender=backends.EmailBackend,
+          dispatch_uid='django_postmark_utils_backends_on_send')
 def store_emails_on_send(sender, messages=None, response=None, **kwargs):
     """
     Called after emails have been sent to Postmark.
@@ -86,12 +272,14 @@ def store_emails_on_send(sender, messages=None, response=None, **kwargs):
 
     # TODO: check if the messages are sent in order (if their order in
     #       "messages" matches that in "response")
-    for msg, res in zip(messages, response):
-        store_email(msg, response=res)
+    store_emails([(msg, {'response': res})
+                  for msg, res in zip(messages, response)])
 
 
 @receiver(on_exception, sender=EmailBackend,
           dispatch_uid='django_postmark_utils_store_emails_on_exception')
+@receiver(on_exception, sender=backends.EmailBackend,
+          dispatch_uid='django_postmark_utils_backends_on_exception')
 def store_emails_on_exception(sender, raw_messages=None, exception=None,
                               **kwargs):
     """
@@ -106,14 +294,22 @@ def store_emails_on_exception(sender, raw_messages=None, exception=None,
     # Email data for these is also stored in the "post_send" signal handler,
     # using different email IDs, which makes it difficult to check for, at a
     # later point. We therefore just skip storing it here, and use that stored
-    # in the "post_send" signal handler instead.
-    if not isinstance(exception, PostmarkerException):
+    # in the "post_send" signal handler instead. ClientError is raised for
+    # failed API calls (e.g. with a "503" response), in which case the
+    # "post_send" signal isn't sent, so is stored here, with its error code.
+    if isinstance(exception, ClientError) or \
+            not isinstance(exception, PostmarkerException):
+        kwargs = {'exception_str': str(exception)}
+        if isinstance(exception, ClientError):
+            kwargs['response'] = {'ErrorCode': exception.error_code}
+        emails = []
         for raw_msg in raw_messages:
             msg = raw_msg.message()
-            # If the message has a Postmark tag (as created using
+            # If the message has a Postmark tag or metadata (as created using
             # "postmarker.django.backend.PostmarkEmailMessage" or
             # "postmarker.django.backend.PostmarkEmailMultiAlternatives").
             msg.tag = getattr(raw_msg, 'tag', None)
+            msg.metadata = getattr(raw_msg, 'metadata', None)
             # The Postmarker email backend requires the "Bcc" header field, to
             # construct the data to send in the API call. This is not set in
             # "django.core.mail.EmailMessage.message()", as the default/SMTP
@@ -121,4 +317,5 @@ def store_emails_on_exception(sender, raw_messages=None, exception=None,
             # the "Bcc" header field.
             if raw_msg.bcc:
                 msg['Bcc'] = ', '.join(map(force_text, raw_msg.bcc))
-            store_email(msg, exception_str=str(exception))
+            emails.append((msg, kwargs))
+        store_emails(emails)
@@ -0,0 +1,105 @@
+import hashlib
+import re
+import uuid
+from email.generator import BytesGenerator
+from functools import lru_cache
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.utils.module_loading import import_string
+
+from . import app_settings
+
+NEWLINE = re.compile(r'\r\n|\r|\n')
+
+
+@lru_cache(maxsize=None)
+def get_message_storage():
+    """
+    Returns the file storage message objects are stored in, or "None" if they
+    are stored in the database.
+    """
+
+    if not app_settings.MESSAGE_STORAGE:
+        return None
+    storage_class = import_string(app_settings.MESSAGE_STORAGE)
+    return storage_class(**app_settings.MESSAGE_STORAGE_OPTIONS)
+
+
+@lru_cache(maxsize=None)
+def get_cold_message_storage():
+    """
+    Returns the file storage the message objects of old messages are archived
+    in, or "None" if not configured.
+    """
+
+    if not app_settings.COLD_MESSAGE_STORAGE:
+        return None
+    storage_class = import_string(app_settings.COLD_MESSAGE_STORAGE)
+    return storage_class(**app_settings.COLD_MESSAGE_STORAGE_OPTIONS)
+
+
+def save_message_obj(message_obj, storage=None):
+    """
+    Saves a serialised message object in the message storage (or the given
+    storage), under a key derived from its content, and returns the key.
+    """
+
+    storage = storage or get_message_storage()
+    digest = hashlib.sha256(message_obj).hexdigest()
+    name = 'django_postmark_utils/{}/{}/{}.pickle'.format(
+        digest[:2], digest[2:4], digest)
+    if not storage.exists(name):
+        name = storage.save(name, ContentFile(message_obj))
+    return name
+
+
+def delete_message_files(names, storage=None):
+    """
+    Deletes message objects from the message storage (or the given storage),
+    by their keys.
+    """
+
+    storage = storage or get_message_storage()
+    if storage is None:
+        return
+    for name in names:
+        storage.delete(name)
+
+
+def iter_message_bytes(message, linesep='\n'):
+    """
+    Yields a message object rendered as by "as_bytes()", a MIME part at a
+    time, so that the whole rendered message isn't built in memory.
+    """
+
+    payload = message.get_payload()
+    if not message.is_multipart() or not isinstance(payload, list):
+        fp = BytesIO()
+        BytesGenerator(fp, mangle_from_=False).flatten(
+            message, unixfrom=False, linesep=linesep)
+        yield fp.getvalue()
+        return
+    policy = message.policy.clone(linesep=linesep)
+    # Set when first rendered, if not set explicitly
+    if message.get_boundary() is None:
+        message.set_boundary('==============={}=='.format(uuid.uuid4().int))
+    boundary = message.get_boundary().encode('ascii')
+    newline = linesep.encode('ascii')
+
+    def encode_lines(text):
+        text = linesep.join(NEWLINE.split(text))
+        return text.encode('ascii', 'surrogateescape')
+
+    yield b''.join(policy.fold_binary(name, value)
+                   for name, value in message.raw_items()) + newline
+    if message.preamble is not None:
+        yield encode_lines(message.preamble) + newline
+    yield b'--' + boundary + newline
+    for num, part in enumerate(payload):
+        if num:
+            yield newline + b'--' + boundary + newline
+        yield from iter_message_bytes(part, linesep)
+    yield newline + b'--' + boundary + b'--' + newline
+    if message.epilogue is not None:
+        yield encode_lines(message.epilogue)
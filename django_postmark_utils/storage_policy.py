@@ -0,0 +1,95 @@
+import hashlib
+from email.utils import getaddresses
+from functools import lru_cache
+
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from . import app_settings
+from .counters import CacheCounters, LocalCounters
+
+# How much of a message is stored: the message object and headers, only the
+# headers, or only what's needed for its emails
+FULL = 'full'
+HEADERS = 'headers'
+NONE = 'none'
+POLICIES = (FULL, HEADERS, NONE)
+
+
+def get_sample_fraction(message_id):
+    """
+    Maps a message ID to a fraction in "[0, 1)", the same for every process.
+    """
+
+    digest = hashlib.sha1(message_id.encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) / 0x100000000
+
+
+class StoragePolicy(object):
+    """
+    Decides how much of each sent message to store, using the first matching
+    rule of "POSTMARK_UTILS_STORAGE_RULES", and counts the messages stored by
+    each policy.
+    """
+
+    def __init__(self, rules, counters):
+        self.rules = rules
+        self.counters = counters
+        for rule in rules:
+            if rule.get('policy') not in POLICIES:
+                raise ValueError('Invalid storage policy: {!r}'.format(
+                    rule.get('policy')))
+
+    def matches(self, rule, message_id, from_email, tag, num_of_recipients):
+        if 'from_email' in rule:
+            from_emails = rule['from_email']
+            if isinstance(from_emails, str):
+                from_emails = [from_emails]
+            if from_email not in {email.lower() for email in from_emails}:
+                return False
+        if 'tag' in rule and tag != rule['tag']:
+            return False
+        if num_of_recipients < rule.get('min_recipients', 0):
+            return False
+        # Sampled messages are stored in full
+        return get_sample_fraction(message_id) >= rule.get('sample_rate', 0)
+
+    def get_policy(self, message_id, headers, tag, failed):
+        """
+        Returns the policy to store a message with, from its (headers') message
+        ID, its headers and tag, and if sending it failed.
+        """
+
+        policy = FULL
+        if not failed:
+            from_email = getaddresses([headers.get('From', '')])[0][1].lower()
+            num_of_recipients = len(getaddresses([
+                headers.get(name, '') for name in ('To', 'Cc', 'Bcc')
+                if headers.get(name)]))
+            for rule in self.rules:
+                if self.matches(rule, message_id, from_email, tag,
+                                num_of_recipients):
+                    policy = rule['policy']
+                    break
+        return policy
+
+    def count(self, policy):
+        """
+        Called by "store_email" when a message is created with the policy.
+        """
+
+        self.counters.incr(policy)
+
+    def get_stats(self):
+        return {policy: self.counters.get(policy) for policy in POLICIES}
+
+
+@lru_cache(maxsize=None)
+def get_storage_policy():
+    policy_class = import_string(app_settings.STORAGE_POLICY)
+    if app_settings.STORAGE_POLICY_CACHE:
+        counters = CacheCounters(caches[app_settings.STORAGE_POLICY_CACHE],
+                                 'django_postmark_utils:storage_policy')
+    else:
+        counters = LocalCounters()
+    return policy_class(app_settings.STORAGE_RULES, counters)
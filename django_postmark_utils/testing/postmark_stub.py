@@ -0,0 +1,391 @@
+import itertools
+import json
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from email.utils import getaddresses
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+import pytz
+import requests
+from dateutil import parser
+
+# The time zone the Postmark API interprets dates in
+API_TIMEZONE = pytz.timezone('US/Eastern')
+
+MESSAGE_DETAILS_PATH = re.compile(r'^/messages/outbound/([^/]+)/details$')
+
+# The messages of the Postmark API error codes injected, by error code
+ERROR_MESSAGES = {
+    100: 'Maintenance: the Postmark API is offline.',
+    300: 'Invalid email request',
+    405: 'Not allowed to send: you have run out of credits.',
+    406: 'You tried to send to a recipient that has been marked as '
+         'inactive.',
+}
+
+# The receivers webhook notifications are sent to, by record type
+RECEIVERS = {
+    'Bounce': 'bounce-receiver',
+    'Delivery': 'delivery-receiver',
+}
+
+
+def get_api_now():
+    return datetime.now(API_TIMEZONE).isoformat()
+
+
+class PostmarkStubRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves recorded Postmark API responses, paged and filtered by date as the
+    Postmark API does, and accepts emails sent with the email and batch email
+    APIs.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_page(self, items, date_field, query):
+        # Copied, as webhook notifications are recorded by other threads
+        with self.server.lock:
+            items = list(items)
+        if 'fromdate' in query:
+            from_date = API_TIMEZONE.localize(
+                parser.parse(query['fromdate'][0]))
+            items = [item for item in items
+                     if parser.parse(item[date_field]) >= from_date]
+        if 'todate' in query:
+            to_date = API_TIMEZONE.localize(parser.parse(query['todate'][0]))
+            items = [item for item in items
+                     if parser.parse(item[date_field]) <= to_date]
+        offset = int(query.get('offset', ['0'])[0])
+        count = int(query.get('count', ['500'])[0])
+        return len(items), items[offset:offset + count]
+
+    def do_GET(self):
+        recordings = self.server.recordings
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        self.server.requests.append(self.path)
+        if url.path == '/bounces':
+            total_count, bounces = self.get_page(
+                recordings.get('bounces', []), 'BouncedAt', query)
+            self.send_json({'TotalCount': total_count, 'Bounces': bounces})
+        elif url.path == '/messages/outbound':
+            total_count, messages = self.get_page(
+                recordings.get('messages', []), 'ReceivedAt', query)
+            self.send_json({'TotalCount': total_count, 'Messages': messages})
+        elif MESSAGE_DETAILS_PATH.match(url.path):
+            email_id = MESSAGE_DETAILS_PATH.match(url.path).group(1)
+            try:
+                with self.server.lock:
+                    details = recordings['details'][email_id]
+                    details = dict(details, MessageEvents=list(
+                        details['MessageEvents']))
+                self.send_json(details)
+            except KeyError:
+                self.send_json({'ErrorCode': 701, 'Message': 'Not found'},
+                               status=422)
+        else:
+            self.send_json({'ErrorCode': 404, 'Message': 'Not found'},
+                           status=404)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        self.server.requests.append(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        data = json.loads(self.rfile.read(length).decode('utf-8') or 'null')
+        self.server.wait()
+        if url.path not in ('/email', '/email/batch'):
+            self.send_json({'ErrorCode': 404, 'Message': 'Not found'},
+                           status=404)
+        elif not self.headers.get('X-Postmark-Server-Token'):
+            self.send_json({
+                'ErrorCode': 10,
+                'Message': 'No Account or Server API tokens were supplied in '
+                           'the HTTP headers.',
+            }, status=401)
+        elif self.server.fail_request():
+            self.send_json({'ErrorCode': 100, 'Message': ERROR_MESSAGES[100]},
+                           status=503)
+        elif url.path == '/email':
+            response = self.server.accept(data)
+            self.send_json(response,
+                           status=422 if response['ErrorCode'] else 200)
+        else:
+            self.send_json([self.server.accept(email) for email in data])
+
+
+class PostmarkStubServer(ThreadingMixIn, HTTPServer):
+    """
+    A local stand-in for the Postmark API, serving recorded responses, and
+    accepting sent emails.
+
+    The recordings are a dictionary with "bounces" (as returned by the bounces
+    API), "messages" (as returned by the outbound messages search API) and
+    "details" (outbound message details, by Postmark message ID), e.g. loaded
+    from a JSON file. Accepted emails are added to them, as are their bounces
+    and deliveries.
+
+    Each email API request is delayed by "latency" seconds (or a random number
+    of seconds between the two of a "(min, max)" tuple). A share of requests
+    ("request_error_rate") fail with a "503" response, and a share of emails
+    ("error_rate") are rejected with the "error_code" Postmark API error code.
+
+    With a "webhook_url" (the base URL of the webhook receivers, including the
+    secret), a bounce (for a share of recipients, "bounce_rate") or delivery
+    webhook notification is sent for each recipient of accepted emails,
+    "webhook_delay" seconds after they were accepted, by "webhook_workers"
+    threads. With "hold_webhooks", they are only sent once released.
+
+    Usage:
+
+        with PostmarkStubServer(recordings) as server:
+            call_command('sync_postmark_events', api_url=server.url, ...)
+
+        with PostmarkStubServer(webhook_url=url, bounce_rate=0.1) as server:
+            get_connection(api_url=server.url).send_messages(messages)
+            server.wait_for_webhooks()
+    """
+
+    daemon_threads = True
+
+    def __init__(self, recordings=None, address=('127.0.0.1', 0),
+                 handler_class=PostmarkStubRequestHandler, latency=0,
+                 request_error_rate=0, error_rate=0, error_code=406,
+                 bounce_rate=0, webhook_url=None, webhook_delay=0,
+                 webhook_workers=4, hold_webhooks=False, server_id=None,
+                 seed=None):
+        self.recordings = {} if recordings is None else recordings
+        self.latency = latency
+        self.request_error_rate = request_error_rate
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.bounce_rate = bounce_rate
+        self.webhook_url = webhook_url
+        self.webhook_delay = webhook_delay
+        self.webhook_workers = webhook_workers
+        self.webhooks_released = threading.Event()
+        if not hold_webhooks:
+            self.webhooks_released.set()
+        self.server_id = server_id
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # The paths of the requests received, the responses to the emails
+        # sent, and the statuses of the responses to the webhook notifications
+        # sent, for inspection
+        self.requests = []
+        self.sent = []
+        self.webhook_statuses = Counter()
+        # Webhook notifications, as "(send at, sequence number, receiver,
+        # data)" tuples, in the order they are due
+        self.webhooks = queue.PriorityQueue()
+        self.webhook_sequence = itertools.count()
+        self.webhooks_pending = 0
+        # When the first and last webhook notifications were sent and
+        # responded to ("time.monotonic()" times)
+        self.first_webhook_at = None
+        self.last_webhook_at = None
+        self.webhooks_done = threading.Condition(self.lock)
+        super().__init__(address, handler_class)
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def wait(self):
+        if isinstance(self.latency, (tuple, list)):
+            with self.lock:
+                latency = self.random.uniform(*self.latency)
+        else:
+            latency = self.latency
+        if latency:
+            time.sleep(latency)
+
+    def chance(self, rate):
+        if not rate:
+            return False
+        with self.lock:
+            return self.random.random() < rate
+
+    def fail_request(self):
+        return self.chance(self.request_error_rate)
+
+    def accept(self, email):
+        """
+        Returns the Postmark API response to an email, and for accepted emails,
+        records them and schedules their webhook notifications.
+        """
+
+        recipients = [address for name, address in getaddresses([
+            email.get(field) or '' for field in ('To', 'Cc', 'Bcc')
+        ]) if address]
+        if not recipients:
+            response = {
+                'ErrorCode': 300,
+                'Message': 'Invalid email request: Zero recipients specified',
+            }
+        elif self.chance(self.error_rate):
+            response = {
+                'To': email.get('To'),
+                'ErrorCode': self.error_code,
+                'Message': ERROR_MESSAGES.get(self.error_code, 'Error'),
+            }
+        else:
+            response = {
+                'To': email.get('To'),
+                'SubmittedAt': get_api_now(),
+                'MessageID': str(uuid.uuid4()),
+                'ErrorCode': 0,
+                'Message': 'OK',
+            }
+            with self.lock:
+                self.recordings.setdefault('messages', []).append({
+                    'MessageID': response['MessageID'],
+                    'ReceivedAt': response['SubmittedAt'],
+                    'Recipients': recipients,
+                    'Tag': email.get('Tag'),
+                    'Status': 'Sent',
+                })
+            for recipient in recipients:
+                self.schedule(email, response['MessageID'], recipient)
+        with self.lock:
+            self.sent.append(response)
+        return response
+
+    def schedule(self, email, email_id, recipient):
+        if self.webhook_url is None:
+            return
+        if self.chance(self.bounce_rate):
+            data = {
+                'RecordType': 'Bounce',
+                'ID': uuid.uuid4().int >> 66,
+                'Type': 'HardBounce',
+                'TypeCode': 1,
+                'Name': 'Hard bounce',
+                'Tag': email.get('Tag'),
+                'MessageID': email_id,
+                'ServerID': self.server_id,
+                'Description': 'The server was unable to deliver your '
+                               'message (ex: unknown user, mailbox not '
+                               'found).',
+                'Details': 'Injected bounce',
+                'Email': recipient,
+                'From': email.get('From'),
+                'Inactive': True,
+                'CanActivate': True,
+                'Subject': email.get('Subject'),
+            }
+        else:
+            data = {
+                'RecordType': 'Delivery',
+                'ServerId': self.server_id,
+                'MessageID': email_id,
+                'Recipient': recipient,
+                'Tag': email.get('Tag'),
+                'Details': 'Injected delivery',
+            }
+        with self.lock:
+            self.webhooks_pending += 1
+            self.webhooks.put((time.monotonic() + self.webhook_delay,
+                               next(self.webhook_sequence),
+                               RECEIVERS[data['RecordType']], data))
+
+    def send_webhooks(self):
+        session = requests.Session()
+        self.webhooks_released.wait()
+        try:
+            while True:
+                send_at, sequence, receiver, data = self.webhooks.get()
+                if receiver is None:
+                    return
+                delay = send_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                now = get_api_now()
+                with self.lock:
+                    if data['RecordType'] == 'Bounce':
+                        data['BouncedAt'] = now
+                        self.recordings.setdefault('bounces', []).append(data)
+                    else:
+                        data['DeliveredAt'] = now
+                        self.recordings.setdefault('details', {}).setdefault(
+                            data['MessageID'], {'MessageEvents': []},
+                        )['MessageEvents'].append({
+                            'Type': 'Delivered',
+                            'Recipient': data['Recipient'],
+                            'ReceivedAt': now,
+                            'Details': {},
+                        })
+                    if self.first_webhook_at is None:
+                        self.first_webhook_at = time.monotonic()
+                try:
+                    status = session.post(
+                        self.webhook_url.rstrip('/') + '/' + receiver + '/',
+                        json=data, timeout=30,
+                    ).status_code
+                except requests.RequestException as e:
+                    status = type(e).__name__
+                with self.lock:
+                    self.webhook_statuses[status] += 1
+                    self.last_webhook_at = time.monotonic()
+                    self.webhooks_pending -= 1
+                    self.webhooks_done.notify_all()
+        finally:
+            session.close()
+
+    def release_webhooks(self):
+        """
+        Starts sending held webhook notifications, those already due at once.
+        """
+
+        self.webhooks_released.set()
+
+    def wait_for_webhooks(self, timeout=None):
+        """
+        Waits until the webhook notifications scheduled have been sent, and
+        returns whether they have.
+        """
+
+        with self.lock:
+            return self.webhooks_done.wait_for(
+                lambda: not self.webhooks_pending, timeout)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        self.webhook_threads = []
+        if self.webhook_url is not None:
+            for _ in range(self.webhook_workers):
+                thread = threading.Thread(target=self.send_webhooks,
+                                          daemon=True)
+                thread.start()
+                self.webhook_threads.append(thread)
+        return self
+
+    def __exit__(self, *args):
+        # Notifications still due are dropped
+        self.webhooks_released.set()
+        for _ in self.webhook_threads:
+            self.webhooks.put((float('-inf'), next(self.webhook_sequence),
+                               None, None))
+        for thread in self.webhook_threads:
+            thread.join()
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
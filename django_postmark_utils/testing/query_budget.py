@@ -0,0 +1,151 @@
+import os
+import traceback
+from collections import OrderedDict
+from functools import partial
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.urls import reverse
+
+import django_postmark_utils
+
+PACKAGE_DIR = os.path.dirname(django_postmark_utils.__file__)
+TESTING_DIR = os.path.dirname(__file__)
+
+
+def get_call_site(stack):
+    """
+    Returns the innermost frame of the stack in this app (excluding tests and
+    this module), or else the innermost frame outside the database layer, as
+    "file:line in function".
+    """
+
+    frames = [frame for frame in stack
+              if not frame.filename.startswith(TESTING_DIR)
+              and not frame.filename.endswith('tests.py')]
+    app_frames = [frame for frame in frames
+                  if frame.filename.startswith(PACKAGE_DIR)]
+    if app_frames:
+        frame = app_frames[-1]
+    else:
+        frame = [frame for frame in frames
+                 if os.sep + os.path.join('django', 'db') + os.sep
+                 not in frame.filename][-1]
+    return '{}:{} in {}'.format(os.path.relpath(frame.filename),
+                                frame.lineno, frame.name)
+
+
+class QueryRecorder(object):
+    """
+    Records the queries run on all databases while in use as a context
+    manager, with their call sites.
+    """
+
+    def __init__(self, using=None):
+        self.using = list(using or connections)
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append((sql, get_call_site(traceback.extract_stack())))
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self.wrappers = [connections[alias].execute_wrapper(self)
+                         for alias in self.using]
+        for wrapper in self.wrappers:
+            wrapper.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        for wrapper in reversed(self.wrappers):
+            wrapper.__exit__(exc_type, exc_value, tb)
+
+    def __len__(self):
+        return len(self.queries)
+
+    def report(self):
+        """
+        Returns the queries grouped by call site, most frequent first.
+        """
+
+        call_sites = OrderedDict()
+        for sql, call_site in self.queries:
+            call_sites.setdefault(call_site, []).append(sql)
+        lines = []
+        for call_site, queries in sorted(call_sites.items(),
+                                         key=lambda item: -len(item[1])):
+            lines.append('{} queries from {}'.format(len(queries), call_site))
+            lines.extend('    ' + sql for sql in OrderedDict.fromkeys(queries))
+        return '\n'.join(lines)
+
+
+class QueryBudgetMixin(object):
+    """
+    Test case mixin for asserting that views run a constant number of queries,
+    within a budget, whatever the amount of data.
+
+    "query_budgets" maps view names to the maximum number of queries, and the
+    "seed(size)" method (which test cases must define) is called to add data
+    of each of the "seed_sizes". Each view is requested by the function
+    returned by "get_request(view_name, size)", which returns the response, so
+    that any objects needed for the request can be looked up before the
+    queries are recorded. By default, the view's URL name is requested.
+    """
+
+    query_budgets = {}
+    seed_sizes = (2, 5)
+
+    @classmethod
+    def setUpClass(cls):
+        if not cls.query_budgets:
+            raise ImproperlyConfigured(
+                '{} must set "query_budgets"'.format(cls.__name__))
+        if not callable(getattr(cls, 'seed', None)):
+            raise ImproperlyConfigured(
+                '{} must define "seed(size)"'.format(cls.__name__))
+        if len(cls.seed_sizes) < 2:
+            raise ImproperlyConfigured(
+                '{} must have at least two "seed_sizes"'.format(
+                    cls.__name__))
+        super().setUpClass()
+
+    def get_request(self, view_name, size):
+        return partial(self.client.get, reverse(view_name))
+
+    def record(self, view_name, size):
+        request = self.get_request(view_name, size)
+        # Every view is recorded with cold caches, so that the number of
+        # queries doesn't depend on the views recorded before it
+        cache.clear()
+        ContentType.objects.clear_cache()
+        with QueryRecorder() as recorder:
+            response = request()
+            if getattr(response, 'streaming', False):
+                b''.join(response.streaming_content)
+        self.assertLess(response.status_code, 400, view_name)
+        return recorder
+
+    def test_query_budgets(self):
+        recorders = {}
+        for size in self.seed_sizes:
+            self.seed(size)
+            for view_name in self.query_budgets:
+                recorders.setdefault(view_name, []).append(
+                    self.record(view_name, size))
+        for view_name, budget in self.query_budgets.items():
+            with self.subTest(view=view_name):
+                smallest, *others = recorders[view_name]
+                for size, recorder in zip(self.seed_sizes[1:], others):
+                    self.assertEqual(
+                        len(recorder), len(smallest),
+                        '{} ran {} queries with {} rows:\n{}\n'
+                        'and {} with {}:\n{}'.format(
+                            view_name, len(smallest), self.seed_sizes[0],
+                            smallest.report(), len(recorder), size,
+                            recorder.report()))
+                self.assertLessEqual(
+                    len(smallest), budget,
+                    '{} ran {} queries, over its budget of {}:\n{}'.format(
+                        view_name, len(smallest), budget, smallest.report()))
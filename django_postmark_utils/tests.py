@@ -1,3 +1,1813 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+import tempfile
+import uuid
+from datetime import datetime, timedelta
+from functools import partial
+from importlib import import_module
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.conf.urls import include, url
+from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import PAGE_VAR
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import (EmailMessage, EmailMultiAlternatives,
+                              get_connection)
+from django.core.management import call_command
+from django.db import IntegrityError, connections, transaction
+from django.test import (SimpleTestCase, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from postmarker.django.backend import PostmarkEmailMessage
+from postmarker.django.signals import on_exception, post_send
+from postmarker.exceptions import ClientError
+from postmarker.models.emails import EmailManager
+
+from . import app_settings, backends, throttling
+from .admin import MessageMetadataListFilter, TagListFilter
+from .events import ingest_events
+from .headers import MessageHeaders
+from .models import (Bounce, Delivery, Email, Event, Message,
+                     MessageMetadata, SyncCursor)
+from .pagination import (EstimatedCountPaginator, decode_cursor,
+                         encode_cursor)
+from .retries import is_retryable
+from .routers import PostmarkUtilsRouter
+from .search import FTS5SearchBackend
+from .signal_handlers import (StoredRecords, create_or_get, store_email,
+                              store_emails, store_emails_on_exception)
+from .storage import (get_cold_message_storage, get_message_storage,
+                      iter_message_bytes)
+from .servers import get_server_registry
+from .storage_policy import get_storage_policy
+from .testing.postmark_stub import PostmarkStubServer
+from .testing.query_budget import QueryBudgetMixin
+from .throttling import AdmissionController, CacheFixedWindowLimiter
+
+urlpatterns = [
+    url(r'^admin/', admin.site.urls),
+    url(r'^postmark/', include('django_postmark_utils.urls')),
+]
+
+
+def create_email(num, **kwargs):
+    message = EmailMessage(
+        subject='Subject {}'.format(num),
+        body='Body {}'.format(num),
+        from_email='sender@example.com',
+        to=['recipient{}@example.com'.format(num)],
+    ).message()
+    store_email(message, **kwargs)
+    return message
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AdminMessageObjectQueryTests(TestCase):
+    """
+    Checks that admin list and search pages don't load message objects.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+        for num in range(3):
+            create_email(num, response={
+                'MessageID': 'postmark-id-{}'.format(num),
+                'ErrorCode': 0,
+                'Message': 'OK',
+            })
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def assertMessageObjectNotQueried(self, url, data=None):
+        connection = connections[app_settings.READ_DATABASE]
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        for query in context.captured_queries:
+            self.assertNotIn('message_obj', query['sql'])
+
+    def test_message_changelist(self):
+        self.assertMessageObjectNotQueried(
+            reverse('admin:django_postmark_utils_message_changelist'))
+
+    def test_message_changelist_search(self):
+        self.assertMessageObjectNotQueried(
+            reverse('admin:django_postmark_utils_message_changelist'),
+            {'q': 'recipient1'})
+
+    def test_message_changelist_filters(self):
+        self.assertMessageObjectNotQueried(
+            reverse('admin:django_postmark_utils_message_changelist'),
+            {'num_of_bounces': '0', 'num_of_deliveries': '0'})
+
+    def test_message_change_page(self):
+        message = Message.objects.first()
+        self.assertMessageObjectNotQueried(
+            reverse('admin:django_postmark_utils_message_change',
+                    args=[message.id]))
+
+    def test_email_changelist(self):
+        self.assertMessageObjectNotQueried(
+            reverse('admin:django_postmark_utils_email_changelist'))
+
+    def test_email_changelist_search(self):
+        self.assertMessageObjectNotQueried(
+            reverse('admin:django_postmark_utils_email_changelist'),
+            {'q': 'postmark-id-1'})
+
+    def test_email_change_page(self):
+        email = Message.objects.first().emails.get()
+        self.assertMessageObjectNotQueried(
+            reverse('admin:django_postmark_utils_email_change',
+                    args=[email.id]))
+
+    def test_message_download(self):
+        message = Message.objects.first()
+        response = self.client.get(
+            reverse('admin:django_postmark_utils_message_download',
+                    args=[message.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Subject: ' + message.subject.encode(),
+                      b''.join(response.streaming_content))
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class TagMetadataTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.multiple(app_settings, STORE_ON_COMMIT=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def store(self, num, tag, metadata):
+        message = EmailMessage(
+            subject='Subject {}'.format(num),
+            body='Body {}'.format(num),
+            from_email='sender@example.com',
+            to=['recipient{}@example.com'.format(num)],
+        ).message()
+        message.tag = tag
+        message.metadata = metadata
+        store_email(message)
+
+    def get_choices(self, url, filter_class):
+        cl = self.client.get(url).context['cl']
+        spec, = (spec for spec in cl.filter_specs
+                 if isinstance(spec, filter_class))
+        return [choice['display'] for choice in spec.choices(cl)]
+
+    def get_metadata(self):
+        return set(MessageMetadata.objects.values_list('message__tag', 'key',
+                                                       'value'))
+
+    def test_store(self):
+        self.store(0, 'welcome', {'user': 1})
+        self.assertEqual(self.get_metadata(), {('welcome', 'user', '1')})
+
+    def test_store_on_exception(self):
+        message = PostmarkEmailMessage(
+            'Subject', 'Body', 'sender@example.com', ['recipient@example.com'],
+            tag='welcome')
+        message.metadata = {'user': 'a'}
+        store_emails_on_exception(None, raw_messages=[message],
+                                  exception=ConnectionError('Refused'))
+        self.assertEqual(self.get_metadata(), {('welcome', 'user', 'a')})
+
+    def test_wrapper_backend_signals(self):
+        # The signals are sent with the class of the backend as the sender
+        message = PostmarkEmailMessage(
+            'Subject', 'Body', 'sender@example.com', ['recipient@example.com'],
+            tag='welcome')
+        post_send.send(backends.EmailBackend, messages=[message.message()],
+                       response=[{'MessageID': 'postmark-id',
+                                  'ErrorCode': 0, 'Message': 'OK'}])
+        on_exception.send(backends.EmailBackend, raw_messages=[message],
+                          exception=ClientError('Maintenance',
+                                                error_code=100))
+        sent, failed = Email.objects.order_by('id')
+        self.assertEqual(sent.status, Email.SUBMITTED)
+        self.assertEqual(sent.delivery_email_id, 'postmark-id')
+        # Failed API calls are stored with their error code, and retried
+        self.assertEqual(failed.status, Email.FAILED)
+        self.assertEqual(failed.delivery_error_code, 100)
+        self.assertIn('Maintenance', failed.sending_error)
+        self.assertIsNotNone(failed.message.next_attempt_at)
+
+    def test_backfill(self):
+        for num in range(3):
+            self.store(num, 'welcome', {'user': num})
+        Message.objects.update(tag='')
+        MessageMetadata.objects.all().delete()
+        stdout = io.StringIO()
+        call_command('backfill_postmark_tags', chunk_size=2, workers=1,
+                     stdout=stdout)
+        self.assertIn('3 messages updated', stdout.getvalue())
+        self.assertEqual(self.get_metadata(), {
+            ('welcome', 'user', str(num)) for num in range(3)})
+
+    def test_admin_filter(self):
+        for num in range(3):
+            self.store(num, '', {'user': num % 2})
+        self.store(3, '', {'account': 1})
+        self.client.force_login(get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password'))
+        url = reverse('admin:django_postmark_utils_message_changelist')
+        # Only the keys are listed
+        self.assertEqual(self.get_choices(url, MessageMetadataListFilter),
+                         ['All', 'account', 'user'])
+        for value, count in (('user', 3), ('user=1', 1), ('account=1', 1)):
+            response = self.client.get(url, {'metadata': value})
+            self.assertEqual(response.context['cl'].result_count, count)
+
+    def test_admin_tag_filter(self):
+        for num, tag in enumerate(('welcome', 'welcome', 'newsletter', '')):
+            self.store(num, tag, {})
+        self.client.force_login(get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password'))
+        for model, parameter in (('message', 'tag'),
+                                 ('email', 'message__tag')):
+            url = reverse(
+                'admin:django_postmark_utils_{}_changelist'.format(model))
+            # Only the (distinct) tags are listed
+            self.assertEqual(self.get_choices(url, TagListFilter),
+                             ['All', 'newsletter', 'welcome'])
+            response = self.client.get(url, {parameter: 'welcome'})
+            self.assertEqual(response.context['cl'].result_count, 2)
+        with mock.patch.object(TagListFilter, 'max_tags', 1):
+            self.assertEqual(self.get_choices(url, TagListFilter),
+                             ['All', 'newsletter'])
+
+
+class IngestEventsTests(TestCase):
+
+    bounce = {
+        'RecordType': 'Bounce',
+        'ID': 42,
+        'Type': 'HardBounce',
+        'TypeCode': 1,
+        'MessageID': 'postmark-id-0',
+        'Email': 'recipient0@example.com',
+        'BouncedAt': '2020-01-01T10:30:00-05:00',
+        'Inactive': True,
+        'CanActivate': True,
+        'Content': 'Full content dump',
+    }
+    delivery = {
+        'RecordType': 'Delivery',
+        'MessageID': 'postmark-id-0',
+        'Recipient': 'recipient0@example.com',
+        'DeliveredAt': '2020-01-01T10:00:00-05:00',
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        create_email(0, response={
+            'MessageID': 'postmark-id-0',
+            'ErrorCode': 0,
+            'Message': 'OK',
+        })
+
+    def test_ingest(self):
+        self.assertEqual(ingest_events([self.bounce, self.delivery, {
+            'RecordType': 'Open',
+            'MessageID': 'unknown-postmark-id',
+            'Recipient': 'recipient@example.com',
+            'ReceivedAt': '2020-01-01T11:00:00-05:00',
+        }, {'RecordType': 'Unknown'}]), 3)
+        email = Email.objects.get()
+        self.assertEqual(
+            set(Event.objects.values_list('type', 'email_id')),
+            {(Event.BOUNCE, email.id), (Event.DELIVERY, email.id),
+             (Event.OPEN, None)})
+        payload = json.loads(Event.objects.get(type=Event.BOUNCE).payload)
+        self.assertEqual(payload['ID'], 42)
+        for field in ('RecordType', 'Content', 'Email', 'BouncedAt'):
+            self.assertNotIn(field, payload)
+        self.assertEqual(email.bounces.get().bounce_id, 42)
+        self.assertEqual(email.deliveries.get().email_address,
+                         'recipient0@example.com')
+
+    def test_duplicates(self):
+        ingest_events([self.bounce, self.delivery])
+        # Retried notifications, and the same delivery at an equal date in
+        # another time zone, aren't stored again
+        ingest_events([self.bounce, dict(
+            self.delivery, DeliveredAt='2020-01-01T15:00:00Z')])
+        ingest_events([self.bounce, self.delivery])
+        self.assertEqual(Event.objects.count(), 2)
+        self.assertEqual(Bounce.objects.count(), 1)
+        self.assertEqual(Delivery.objects.count(), 1)
+        # Other events of the email are
+        ingest_events([dict(self.bounce, ID=43), dict(
+            self.delivery, Recipient='other@example.com')])
+        self.assertEqual(Event.objects.count(), 4)
+
+
+class StoreOnCommitTests(TransactionTestCase):
+
+    def get_emails(self):
+        return [(message, {}) for message in (EmailMessage(
+            'Subject', 'Body', 'sender@example.com', ['recipient@example.com'],
+        ).message(),)]
+
+    def test_store_immediately(self):
+        # By default, emails are stored in the transaction they are sent in
+        with transaction.atomic():
+            store_emails(self.get_emails())
+            self.assertEqual(Email.objects.count(), 1)
+
+    @mock.patch.object(app_settings, 'STORE_ON_COMMIT', True)
+    def test_store_on_commit(self):
+        with transaction.atomic():
+            store_emails(self.get_emails())
+            self.assertEqual(Email.objects.count(), 0)
+        self.assertEqual(Email.objects.count(), 1)
+
+        # Emails sent in a transaction that is rolled back aren't stored
+        with self.assertRaises(ValueError), transaction.atomic():
+            store_emails(self.get_emails())
+            raise ValueError
+        self.assertEqual(Email.objects.count(), 1)
+
+
+class RouterTests(SimpleTestCase):
+
+    router = PostmarkUtilsRouter()
+
+    def setUp(self):
+        patcher = mock.patch.multiple(app_settings, DATABASE='postmark')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_routing(self):
+        self.assertEqual(self.router.db_for_read(Message), 'postmark')
+        self.assertEqual(self.router.db_for_write(Message), 'postmark')
+        self.assertIsNone(self.router.db_for_read(get_user_model()))
+        self.assertIsNone(self.router.db_for_write(get_user_model()))
+        # Related objects are read from the database of the instance
+        message = Message()
+        message._state.db = 'replica'
+        self.assertEqual(
+            self.router.db_for_read(Email, instance=message), 'replica')
+        self.assertTrue(self.router.allow_relation(message, Email()))
+        self.assertIsNone(
+            self.router.allow_relation(message, get_user_model()()))
+
+    def test_migrations(self):
+        for db, allowed in (('postmark', True), ('default', False)):
+            self.assertEqual(self.router.allow_migrate(
+                db, 'django_postmark_utils', 'message'), allowed)
+        self.assertIsNone(self.router.allow_migrate('postmark', 'auth'))
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AdminSearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+        cls.messages = [
+            create_email(num, response={
+                'MessageID': '883953f4-6105-42a2-a16a-77a8eac7948{}'.format(
+                    num),
+                'ErrorCode': 0,
+                'Message': 'OK',
+            })
+            for num in range(3)
+        ]
+        for email in Email.objects.all():
+            Bounce.objects.create(
+                email=email, bounce_id=email.id,
+                email_address=email.message.to_emails, date=timezone.now(),
+                type_code=1, is_inactive=False, can_activate=True)
+            Delivery.objects.create(
+                email=email, email_address=email.message.to_emails,
+                date=timezone.now())
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def search(self, model_name, search_term):
+        connection = connections[app_settings.READ_DATABASE]
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(
+                reverse('admin:django_postmark_utils_{}_changelist'.format(
+                    model_name)),
+                {'q': search_term})
+        self.assertEqual(response.status_code, 200)
+        return response, context.captured_queries
+
+    def test_exact_id_search_uses_equality(self):
+        response, queries = self.search(
+            'email', '883953f4-6105-42a2-a16a-77a8eac79481')
+        self.assertEqual(response.context['cl'].result_count, 1)
+        for query in queries:
+            self.assertNotIn(' LIKE ', query['sql'])
+
+    def test_exact_message_id_search(self):
+        response, queries = self.search(
+            'message', self.messages[2]['Message-ID'])
+        self.assertEqual(response.context['cl'].result_count, 1)
+        self.assertEqual(response.context['cl'].result_list[0].subject,
+                         'Subject 2')
+
+    def test_text_search(self):
+        for model_name in ('message', 'email', 'bounce', 'delivery'):
+            with self.subTest(model_name=model_name):
+                response, queries = self.search(model_name,
+                                                'recipient1 subject')
+                self.assertEqual(response.context['cl'].result_count, 1)
+                self.assertTrue(any(' MATCH ' in query['sql']
+                                    for query in queries))
+                for query in queries:
+                    self.assertNotIn(' LIKE ', query['sql'])
+
+    def test_no_fts_table(self):
+        with mock.patch.dict(FTS5SearchBackend.fts_tables,
+                             {'default': False}):
+            response, queries = self.search('message', 'recipient1')
+        self.assertEqual(response.context['cl'].result_count, 1)
+        self.assertTrue(any(' LIKE ' in query['sql'] for query in queries))
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class KeysetPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+        for num in range(5):
+            create_email(num, response={
+                'MessageID': str(uuid.uuid4()), 'ErrorCode': 0,
+                'Message': 'OK'})
+        cls.email_ids = list(Email.objects.order_by('-date', '-id')
+                             .values_list('id', flat=True))
+
+    def setUp(self):
+        caches['default'].clear()
+        self.addCleanup(caches['default'].clear)
+        patcher = mock.patch.object(admin.site._registry[Email],
+                                    'list_per_page', 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.force_login(self.user)
+
+    def get_changelist(self, query_string=''):
+        response = self.client.get(
+            reverse('admin:django_postmark_utils_email_changelist') +
+            query_string)
+        self.assertEqual(response.status_code, 200)
+        return response.context['cl']
+
+    def test_cursor(self):
+        email = Email.objects.get(id=self.email_ids[1])
+        self.assertEqual(decode_cursor(encode_cursor(email)),
+                         (email.date, email.id))
+        with self.assertRaises(IncorrectLookupParameters):
+            decode_cursor('invalid')
+
+    def test_seek(self):
+        response = self.client.get(
+            reverse('admin:django_postmark_utils_email_changelist'))
+        self.assertNotContains(response, 'First page')
+        cl = self.get_changelist()
+        self.assertTrue(cl.keyset)
+        ids = [obj.id for obj in cl.result_list]
+        while cl.next_page_url:
+            cl = self.get_changelist(cl.next_page_url)
+            ids += [obj.id for obj in cl.result_list]
+        self.assertEqual(ids, self.email_ids)
+
+    def test_seek_from_offset(self):
+        # Django's page numbers are 1-based from Django 3.2
+        cl = self.get_changelist()
+        self.assertEqual(cl.page_index, 0)
+        cl = self.get_changelist(
+            cl.get_query_string({PAGE_VAR: cl.page_num + 1}))
+        self.assertEqual(cl.page_index, 1)
+        self.assertEqual([obj.id for obj in cl.result_list],
+                         self.email_ids[2:4])
+        cl = self.get_changelist(cl.next_page_url)
+        self.assertNotIn('p=', cl.next_page_url or '')
+        self.assertEqual([obj.id for obj in cl.result_list],
+                         self.email_ids[4:])
+
+    def test_stale_count(self):
+        Email.objects.filter(id__in=self.email_ids[:3]).delete()
+        self.assertEqual(self.get_changelist().result_count, 2)
+        for num in range(5, 8):
+            create_email(num, response={
+                'MessageID': str(uuid.uuid4()), 'ErrorCode': 0,
+                'Message': 'OK'})
+        # The cached count is displayed, but the page is still limited
+        cl = self.get_changelist()
+        self.assertEqual(cl.result_count, 2)
+        self.assertEqual(len(cl.result_list), 2)
+        self.assertIsNotNone(cl.next_page_url)
+        cl = self.get_changelist('?o=1')
+        self.assertEqual(len(cl.result_list), 2)
+        self.assertEqual(self.get_changelist('?exact_count=1').result_count,
+                         5)
+
+    def test_estimated_count(self):
+        connection = mock.MagicMock(vendor='postgresql')
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = (10 ** 6,)
+        with mock.patch('django_postmark_utils.pagination.connections',
+                        {'default': connection}):
+            paginator = EstimatedCountPaginator(Email.objects.all(), 2)
+            self.assertEqual(paginator.count, 10 ** 6)
+            self.assertTrue(paginator.is_estimate)
+            self.assertIn('relnamespace', cursor.execute.call_args[0][0])
+            # Below the threshold, the count is exact
+            cursor.fetchone.return_value = (3,)
+            paginator = EstimatedCountPaginator(Email.objects.all(), 2)
+            self.assertEqual(paginator.count, 5)
+            self.assertFalse(paginator.is_estimate)
+            # Filtered querysets aren't estimated
+            paginator = EstimatedCountPaginator(
+                Email.objects.filter(id__in=self.email_ids[:2]), 2)
+            self.assertEqual(paginator.count, 2)
+            self.assertEqual(cursor.execute.call_count, 2)
+
+
+class SyncPostmarkEventsTests(TestCase):
+
+    recordings = {
+        'bounces': [{
+            'ID': 42,
+            'Type': 'HardBounce',
+            'TypeCode': 1,
+            'MessageID': 'postmark-id-0',
+            'Email': 'recipient0@example.com',
+            'BouncedAt': '2020-01-01T10:30:00-05:00',
+            'Inactive': True,
+            'CanActivate': True,
+        }, {
+            'ID': 43,
+            'Type': 'HardBounce',
+            'TypeCode': 1,
+            'MessageID': 'unknown-postmark-id',
+            'Email': 'unknown@example.com',
+            'BouncedAt': '2020-01-01T10:30:00-05:00',
+            'Inactive': True,
+            'CanActivate': True,
+        }],
+        'messages': [{
+            'MessageID': 'postmark-id-{}'.format(num),
+            'Recipients': ['recipient{}@example.com'.format(num)],
+            'ReceivedAt': '2020-01-01T10:00:00-05:00',
+        } for num in range(2)],
+        'details': {
+            'postmark-id-0': {
+                'MessageEvents': [],
+            },
+            'postmark-id-1': {
+                'MessageEvents': [{
+                    'Recipient': 'recipient1@example.com',
+                    'Type': 'Delivered',
+                    'ReceivedAt': '2020-01-01T10:01:00-05:00',
+                    'Details': {},
+                }],
+            },
+        },
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        for num in range(2):
+            create_email(num, response={
+                'MessageID': 'postmark-id-{}'.format(num),
+                'ErrorCode': 0,
+                'Message': 'OK',
+            })
+
+    def sync(self, server, from_date='2020-01-01T14:00:00Z',
+             to_date='2020-01-01T17:00:00Z', **options):
+        args = ['--to', to_date]
+        if from_date:
+            args += ['--from', from_date]
+        call_command('sync_postmark_events', *args, api_url=server.url,
+                     token='token', stdout=io.StringIO(), **options)
+
+    def test_sync(self):
+        with PostmarkStubServer(self.recordings) as server:
+            self.sync(server)
+            self.assertEqual(
+                list(Bounce.objects.values_list('bounce_id', flat=True)),
+                [42])
+            self.assertEqual(
+                list(Delivery.objects.values_list('email_address',
+                                                  flat=True)),
+                ['recipient1@example.com'])
+            self.assertEqual(SyncCursor.objects.get().position.hour, 17)
+
+            # Syncing again doesn't store anything twice, or fetch the details
+            # of delivered emails
+            del server.requests[:]
+            self.sync(server)
+            self.assertEqual(Bounce.objects.count(), 1)
+            self.assertEqual(Delivery.objects.count(), 1)
+            self.assertNotIn('/messages/outbound/postmark-id-1/details',
+                             server.requests)
+
+    def test_cursor(self):
+        with PostmarkStubServer(self.recordings) as server:
+            self.sync(server)
+            # Backfills don't move the cursor back
+            self.sync(server, '2019-12-31T00:00:00Z', '2020-01-01T00:00:00Z')
+            self.assertEqual(SyncCursor.objects.get().position.hour, 17)
+            # Or skip a gap after it
+            self.sync(server, '2020-01-01T18:00:00Z', '2020-01-01T19:00:00Z')
+            self.assertEqual(SyncCursor.objects.get().position.hour, 17)
+            # But windows contiguous with it advance it
+            self.sync(server, '2020-01-01T16:00:00Z', '2020-01-01T18:00:00Z')
+            self.assertEqual(SyncCursor.objects.get().position.hour, 18)
+
+    def test_late_delivery(self):
+        events = []
+        recordings = dict(self.recordings, details={
+            'postmark-id-0': {'MessageEvents': []},
+            'postmark-id-1': {'MessageEvents': events},
+        })
+        with PostmarkStubServer(recordings) as server:
+            self.sync(server)
+            self.assertFalse(Delivery.objects.exists())
+            # Delivered after the sync that fetched the email
+            events += self.recordings['details']['postmark-id-1'][
+                'MessageEvents']
+            self.sync(server, None, '2020-01-01T18:00:00Z',
+                      delivery_overlap=60)
+            self.assertFalse(Delivery.objects.exists())
+            self.sync(server, None, '2020-01-01T19:00:00Z',
+                      delivery_overlap=240)
+            self.assertEqual(
+                list(Delivery.objects.values_list('email_address',
+                                                  flat=True)),
+                ['recipient1@example.com'])
+            self.assertEqual(SyncCursor.objects.get().position.hour, 19)
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+)
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    """
+    Checks that the admin pages and webhook receivers run the same number of
+    queries, within their budgets, whatever the number of messages, emails
+    and events.
+    """
+
+    query_budgets = {
+        'message_changelist': 10,
+        'message_changelist_filtered': 10,
+        'message_change': 8,
+        'email_changelist': 6,
+        'email_change': 8,
+        'email_resend': 4,
+        'bounce_changelist': 5,
+        'bounce_change': 6,
+        'delivery_changelist': 5,
+        'delivery_change': 6,
+        'event_changelist': 5,
+        'event_change': 6,
+        'bounce_receiver': 6,
+        'delivery_receiver': 6,
+        'email_timeline': 5,
+        'address_timeline': 3,
+        'change_feed': 1,
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.num = 0
+        self.emails = {}
+
+    def seed(self, size):
+        """
+        Stores "size" messages, each with "size" emails, metadata, bounces,
+        deliveries and events.
+        """
+
+        for _ in range(size):
+            self.num += 1
+            message = create_email(self.num, response={
+                'MessageID': 'postmark-id-{}'.format(self.num),
+                'ErrorCode': 0,
+                'Message': 'OK',
+            })
+            stored_message = Message.objects.get(
+                message_id=message['Message-ID'])
+            MessageMetadata.objects.bulk_create(
+                MessageMetadata(message=stored_message, key=str(num),
+                                value=str(num))
+                for num in range(size))
+            emails = list(stored_message.emails.all()) + [
+                Email.objects.create(
+                    message=stored_message,
+                    email_id='<{}.{}@example.com>'.format(self.num, num),
+                    date=timezone.now(),
+                    delivery_email_id='postmark-id-{}.{}'.format(self.num,
+                                                                 num),
+                )
+                for num in range(1, size)
+            ]
+            for email in emails:
+                Bounce.objects.bulk_create(
+                    Bounce(email=email, bounce_id=email.id * 100 + num,
+                           email_address='recipient@example.com',
+                           date=timezone.now(), type_code=1,
+                           is_inactive=False, can_activate=True)
+                    for num in range(size))
+                Delivery.objects.bulk_create(
+                    Delivery(email=email,
+                             email_address='recipient{}@example.com'.format(
+                                 num),
+                             date=timezone.now())
+                    for num in range(size))
+                Event.objects.bulk_create(
+                    Event(type=Event.DELIVERY, email=email,
+                          email_address='recipient@example.com',
+                          date=timezone.now(), payload='{}')
+                    for num in range(size))
+        self.emails[size] = emails
+
+    def get_request(self, view_name, size):
+        email = self.emails[size][-1]
+        changelist_url = 'admin:django_postmark_utils_{}_changelist'
+        change_url = 'admin:django_postmark_utils_{}_change'
+        if view_name == 'message_changelist_filtered':
+            return partial(
+                self.client.get, reverse(changelist_url.format('message')),
+                {'num_of_bounces': str(size * size), 'metadata': '0=0'})
+        if view_name == 'email_resend':
+            return partial(
+                self.client.post, reverse(changelist_url.format('email')),
+                {'action': 'resend_emails', '_selected_action': [
+                    email.id for email in self.emails[size]]})
+        if view_name == 'email_timeline':
+            return partial(
+                self.client.get,
+                reverse('admin:django_postmark_utils_email_timeline'),
+                {'address': 'recipient@example.com'})
+        if view_name == 'address_timeline':
+            return partial(
+                self.client.get,
+                reverse('address-timeline', kwargs={
+                    'secret': settings.POSTMARK_UTILS_SECRET}),
+                {'address': 'recipient@example.com'})
+        if view_name == 'change_feed':
+            return partial(
+                self.client.get,
+                reverse('change-feed', kwargs={
+                    'secret': settings.POSTMARK_UTILS_SECRET,
+                    'feed': 'deliveries'}))
+        if view_name == 'bounce_receiver':
+            self.num += 1
+            return partial(
+                self.client.post,
+                reverse('bounce-receiver', kwargs={
+                    'secret': settings.POSTMARK_UTILS_SECRET}),
+                json.dumps({
+                    'ID': 1000000 + self.num,
+                    'Type': 'HardBounce',
+                    'TypeCode': 1,
+                    'MessageID': email.delivery_email_id,
+                    'Email': 'new{}@example.com'.format(self.num),
+                    'BouncedAt': '2020-01-01T10:30:00-05:00',
+                    'Inactive': False,
+                    'CanActivate': True,
+                }), content_type='application/json')
+        if view_name == 'delivery_receiver':
+            self.num += 1
+            return partial(
+                self.client.post,
+                reverse('delivery-receiver', kwargs={
+                    'secret': settings.POSTMARK_UTILS_SECRET}),
+                json.dumps({
+                    'MessageID': email.delivery_email_id,
+                    'Recipient': 'new{}@example.com'.format(self.num),
+                    'DeliveredAt': '2020-01-01T10:30:00-05:00',
+                }), content_type='application/json')
+        model_name, view = view_name.split('_')
+        if view == 'changelist':
+            return partial(self.client.get,
+                           reverse(changelist_url.format(model_name)))
+        obj = {
+            'message': email.message,
+            'email': email,
+            'bounce': email.bounces.first(),
+            'delivery': email.deliveries.first(),
+            'event': email.events.first(),
+        }[model_name]
+        return partial(self.client.get,
+                       reverse(change_url.format(model_name), args=[obj.id]))
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class DefaultRequestQueryBudgetTests(QueryBudgetMixin, TestCase):
+    """
+    Checks that views are requested by their URL name by default.
+    """
+
+    query_budgets = {
+        'admin:index': 3,
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def seed(self, size):
+        for num in range(size):
+            create_email(num)
+
+
+class QueryBudgetMixinTests(SimpleTestCase):
+
+    def test_required_attributes(self):
+        class NoBudgets(QueryBudgetMixin, SimpleTestCase):
+
+            def seed(self, size):
+                pass
+
+        class NoSeed(QueryBudgetMixin, SimpleTestCase):
+            query_budgets = {'admin:index': 2}
+
+        for test_case in (NoBudgets, NoSeed):
+            with self.subTest(test_case=test_case.__name__):
+                with self.assertRaises(ImproperlyConfigured):
+                    test_case.setUpClass()
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class ReceiverThrottlingTests(TestCase):
+
+    def post_bounce(self, num):
+        return self.client.post(
+            reverse('bounce-receiver', kwargs={
+                'secret': settings.POSTMARK_UTILS_SECRET}),
+            json.dumps({
+                'ID': num,
+                'Type': 'HardBounce',
+                'TypeCode': 1,
+                'MessageID': 'unknown-postmark-id',
+                'Email': 'recipient@example.com',
+                'BouncedAt': '2020-01-01T10:30:00-05:00',
+                'Inactive': False,
+                'CanActivate': True,
+            }), content_type='application/json')
+
+    def test_rate_limit(self):
+        controller = AdmissionController('bounce', rate=0.01, burst=2)
+        with mock.patch.dict(throttling.controllers,
+                             {('default', 'bounce'): controller}):
+            self.assertEqual(self.post_bounce(1).status_code, 204)
+            self.assertEqual(self.post_bounce(2).status_code, 204)
+            response = self.post_bounce(3)
+            self.assertEqual(response.status_code, 429)
+            self.assertGreater(int(response['Retry-After']), 90)
+            stats = self.client.get(reverse('receiver-stats', kwargs={
+                'secret': settings.POSTMARK_UTILS_SECRET})).json()
+        self.assertEqual(stats['bounce']['rejected_rate'], 1)
+        self.assertLess(stats['bounce']['bucket_level'], 1)
+
+    def test_max_in_flight(self):
+        controller = AdmissionController('bounce', max_in_flight=1)
+        with mock.patch.dict(throttling.controllers,
+                             {('default', 'bounce'): controller}):
+            self.assertIsNone(controller.acquire())
+            response = self.post_bounce(1)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'],
+                             str(app_settings.RECEIVER_RETRY_AFTER))
+            controller.release()
+            self.assertEqual(self.post_bounce(1).status_code, 204)
+            self.assertEqual(controller.in_flight, 0)
+            self.assertEqual(controller.get_stats()['rejected_in_flight'], 1)
+
+    def test_cache_fixed_window_limiter(self):
+        bucket = CacheFixedWindowLimiter(0.01, 2, caches['default'],
+                                         'test-bucket')
+        self.assertEqual(bucket.take(), 0)
+        self.assertEqual(bucket.take(), 0)
+        self.assertGreater(bucket.take(), 0)
+        self.assertEqual(bucket.level, 0)
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AddressTimelineTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+        for num in range(2):
+            create_email(1, response={
+                'MessageID': 'postmark-id-{}'.format(num),
+                'ErrorCode': 0,
+                'Message': 'OK',
+            })
+        ingest_events([{
+            'RecordType': 'Bounce',
+            'ID': 42,
+            'Type': 'HardBounce',
+            'TypeCode': 1,
+            'MessageID': 'postmark-id-0',
+            'Email': 'recipient1@example.com',
+            'BouncedAt': '2100-01-01T10:30:00-05:00',
+            'Inactive': True,
+            'CanActivate': True,
+        }, {
+            'RecordType': 'Delivery',
+            'MessageID': 'postmark-id-1',
+            'Recipient': 'recipient1@example.com',
+            'DeliveredAt': '2100-01-01T10:00:00-05:00',
+        }, {
+            'RecordType': 'Delivery',
+            'MessageID': 'postmark-id-1',
+            'Recipient': 'other@example.com',
+            'DeliveredAt': '2100-01-01T10:00:00-05:00',
+        }])
+
+    def get_timeline(self, **params):
+        response = self.client.get(
+            reverse('address-timeline', kwargs={
+                'secret': settings.POSTMARK_UTILS_SECRET}),
+            dict(params, address='Recipient1@example.com'))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_pages(self):
+        first_page = self.get_timeline(limit=2)
+        self.assertEqual([entry['type'] for entry in first_page['entries']],
+                         ['bounce', 'delivery'])
+        second_page = self.get_timeline(limit=2,
+                                        cursor=first_page['next_cursor'])
+        self.assertEqual([entry['type'] for entry in second_page['entries']],
+                         ['sent', 'sent'])
+        self.assertIsNone(second_page['next_cursor'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(
+            reverse('address-timeline', kwargs={
+                'secret': settings.POSTMARK_UTILS_SECRET}),
+            {'address': 'recipient1@example.com', 'cursor': 'invalid'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_admin_view(self):
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse('admin:django_postmark_utils_email_timeline'),
+            {'address': 'recipient1@example.com'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['timeline'].entries), 4)
+        response = self.client.get(
+            reverse('admin:django_postmark_utils_email_timeline'),
+            {'address': 'recipient1@example.com', 'cursor': 'invalid'})
+        self.assertEqual(response.status_code, 400)
+        self.assertContains(response, 'Invalid cursor.', status_code=400)
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class ArchivePostmarkMessagesTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+        cls.messages = [
+            create_email(num, response={
+                'MessageID': 'postmark-id-{}'.format(num),
+                'ErrorCode': 0,
+                'Message': 'OK',
+            })
+            for num in range(3)
+        ]
+        # Only the first message's email is delivered, without bounces
+        ingest_events([{
+            'RecordType': 'Delivery',
+            'MessageID': 'postmark-id-{}'.format(num),
+            'Recipient': 'recipient{}@example.com'.format(num),
+            'DeliveredAt': '2020-01-01T10:00:00-05:00',
+        } for num in range(2)] + [{
+            'RecordType': 'Bounce',
+            'ID': 42,
+            'Type': 'HardBounce',
+            'TypeCode': 1,
+            'MessageID': 'postmark-id-1',
+            'Email': 'recipient1@example.com',
+            'BouncedAt': '2020-01-01T10:30:00-05:00',
+            'Inactive': True,
+            'CanActivate': True,
+        }])
+
+    def get_stored_message(self, num):
+        return Message.objects.get(message_id=self.messages[num]['Message-ID'])
+
+    def test_remove(self):
+        call_command('archive_postmark_messages', '0', stdout=io.StringIO())
+        message = self.get_stored_message(0)
+        self.assertFalse(message.has_message_obj)
+        self.assertEqual(bytes(message.message_obj), b'')
+        for num in (1, 2):
+            self.assertTrue(self.get_stored_message(num).has_message_obj)
+
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse('admin:django_postmark_utils_message_download',
+                    args=[message.id]))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(
+            reverse('admin:django_postmark_utils_message_change',
+                    args=[message.id]))
+        self.assertContains(response, 'removed by the retention policy')
+
+    def test_move(self):
+        with tempfile.TemporaryDirectory() as location, \
+                mock.patch.multiple(
+                    app_settings,
+                    COLD_MESSAGE_STORAGE='django.core.files.storage.'
+                                         'FileSystemStorage',
+                    COLD_MESSAGE_STORAGE_OPTIONS={'location': location}):
+            get_cold_message_storage.cache_clear()
+            try:
+                call_command('archive_postmark_messages', '0', '--move',
+                             stdout=io.StringIO())
+                message = self.get_stored_message(0)
+                self.assertTrue(message.has_message_obj)
+                self.assertNotEqual(message.message_archived, None)
+                self.assertEqual(message.load_message_obj()['Subject'],
+                                 'Subject 0')
+            finally:
+                get_cold_message_storage.cache_clear()
+        # Archived message objects can't be loaded without the cold storage
+        with self.assertRaises(ImproperlyConfigured):
+            message.load_message_obj()
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class MessageStorageTests(TestCase):
+
+    def setUp(self):
+        location = tempfile.TemporaryDirectory()
+        self.addCleanup(location.cleanup)
+        patcher = mock.patch.multiple(
+            app_settings,
+            MESSAGE_STORAGE='django.core.files.storage.FileSystemStorage',
+            MESSAGE_STORAGE_OPTIONS={'location': location.name},
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        get_message_storage.cache_clear()
+        self.addCleanup(get_message_storage.cache_clear)
+        self.messages = [create_email(num) for num in range(2)]
+
+    def get_stored_message(self, num):
+        return Message.objects.get(message_id=self.messages[num]['Message-ID'])
+
+    def test_store_and_load(self):
+        message = self.get_stored_message(0)
+        self.assertEqual(message.message_obj, b'')
+        self.assertTrue(get_message_storage().exists(message.message_file))
+        self.assertEqual(message.message_size, get_message_storage().size(
+            message.message_file))
+        self.assertEqual(message.load_message_obj()['Subject'], 'Subject 0')
+
+        self.client.force_login(get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password'))
+        response = self.client.get(
+            reverse('admin:django_postmark_utils_message_download',
+                    args=[message.id]))
+        self.assertIn(b'Subject: Subject 0',
+                      b''.join(response.streaming_content))
+
+    def test_iter_message_bytes(self):
+        message = EmailMultiAlternatives(
+            'Subjéct', 'Bödy\nFrom here', 'sender@example.com',
+            ['recipient@example.com'])
+        message.attach_alternative('<p>Bödy</p>', 'text/html')
+        message.attach('file.txt', 'Contents\r\n', 'text/plain')
+        message = message.message()
+        message.preamble = 'Preamble\r\nlines'
+        message.epilogue = 'Epilogue'
+        # The boundaries are set when first rendered
+        chunks = list(iter_message_bytes(message))
+        self.assertGreater(len(chunks), 3)
+        self.assertEqual(b''.join(chunks), message.as_bytes())
+        self.assertEqual(b''.join(iter_message_bytes(self.messages[0])),
+                         self.messages[0].as_bytes())
+
+    def test_purge(self):
+        # Message files are keyed by their content, so can be shared
+        first, second = (self.get_stored_message(num) for num in range(2))
+        Message.objects.filter(id=second.id).update(
+            message_file=first.message_file)
+        Message.objects.filter(id=first.id).update(
+            created=timezone.now() - timedelta(days=2))
+        call_command('purge_postmark_messages', '1', stdout=io.StringIO())
+        self.assertTrue(get_message_storage().exists(first.message_file))
+        Message.objects.filter(id=second.id).update(
+            created=timezone.now() - timedelta(days=2))
+        call_command('purge_postmark_messages', '1', stdout=io.StringIO())
+        self.assertFalse(get_message_storage().exists(first.message_file))
+
+
+class StoragePolicyTests(TestCase):
+
+    rules = [
+        {'tag': 'bulk', 'policy': 'none'},
+        {'from_email': 'Sender@example.com', 'policy': 'headers'},
+    ]
+
+    def setUp(self):
+        patcher = mock.patch.multiple(app_settings, STORAGE_RULES=self.rules)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        get_storage_policy.cache_clear()
+        self.addCleanup(get_storage_policy.cache_clear)
+
+    def send(self, num, tag='', error_code=0):
+        message = EmailMessage(
+            subject='Subject {}'.format(num),
+            body='Body {}'.format(num),
+            from_email='sender@example.com',
+            to=['recipient{}@example.com'.format(num)],
+        ).message()
+        message.tag = tag
+        store_email(message, response={
+            'MessageID': 'postmark-id-{}'.format(num),
+            'ErrorCode': error_code,
+            'Message': 'OK' if not error_code else 'Error',
+        })
+        return Message.objects.get(message_id=message['Message-ID'])
+
+    def test_headers(self):
+        message = self.send(0)
+        self.assertEqual(message.storage_policy, 'headers')
+        self.assertFalse(message.has_message_obj)
+        self.assertEqual(bytes(message.message_obj), b'')
+        self.assertEqual(message.subject, 'Subject 0')
+        self.assertEqual(message.recipients.get().email_address,
+                         'recipient0@example.com')
+
+    def test_none(self):
+        message = self.send(0, tag='bulk')
+        self.assertEqual(message.storage_policy, 'none')
+        self.assertFalse(message.has_message_obj)
+        self.assertEqual(message.subject, '')
+        self.assertFalse(message.recipients.exists())
+        self.assertEqual(message.emails.get().delivery_email_id,
+                         'postmark-id-0')
+
+    def test_failed_sends_stored_in_full(self):
+        message = self.send(0, tag='bulk', error_code=300)
+        self.assertEqual(message.storage_policy, 'full')
+        self.assertTrue(message.has_message_obj)
+        self.assertEqual(message.load_message_obj()['Subject'], 'Subject 0')
+
+    def test_sample_rate(self):
+        rules = [{'tag': 'bulk', 'policy': 'none', 'sample_rate': 0.5}]
+        with mock.patch.multiple(app_settings, STORAGE_RULES=rules):
+            get_storage_policy.cache_clear()
+            policies = [self.send(num, tag='bulk').storage_policy
+                        for num in range(40)]
+        self.assertIn('full', policies)
+        self.assertIn('none', policies)
+
+    def test_stats(self):
+        self.send(0, tag='bulk')
+        self.send(1, tag='bulk')
+        self.send(2)
+        self.send(3, error_code=300)
+        self.assertEqual(get_storage_policy().get_stats(),
+                         {'full': 1, 'headers': 1, 'none': 2})
+
+    def test_stats_only_count_created_messages(self):
+        message = EmailMessage('Subject', 'Body', 'sender@example.com',
+                               ['recipient@example.com']).message()
+        store_email(message)
+        # As if stored concurrently, after looking up the stored records
+        store_email(message, stored=StoredRecords([]))
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(get_storage_policy().get_stats(),
+                         {'full': 0, 'headers': 1, 'none': 0})
+
+
+@override_settings(EMAIL_BACKEND='postmarker.django.EmailBackend')
+class RetryFailedPostmarkEmailsTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.multiple(app_settings, STORE_ON_COMMIT=False,
+                                      RETRY_MAX_ATTEMPTS=2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_stored_message(self, message):
+        return Message.objects.get(message_id=message['Message-ID'])
+
+    def make_due(self, message):
+        Message.objects.filter(message_id=message['Message-ID']).update(
+            next_attempt_at=timezone.now() - timedelta(seconds=1))
+
+    def retry(self, error_code=0):
+        def send_batch(*emails):
+            return [{
+                'ErrorCode': error_code,
+                'Message': 'OK' if not error_code else 'Error',
+                'MessageID': str(uuid.uuid4()),
+                'SubmittedAt': '2020-01-01T10:00:00-05:00',
+            } for email in emails]
+
+        with mock.patch.object(EmailManager, '_send_batch',
+                               side_effect=send_batch) as mock_send_batch:
+            call_command('retry_failed_postmark_emails', stdout=io.StringIO())
+        return mock_send_batch
+
+    def test_scheduling(self):
+        now = timezone.now()
+        message = self.get_stored_message(
+            create_email(0, exception_str='Connection refused'))
+        self.assertEqual(message.retry_attempts, 0)
+        self.assertGreaterEqual(message.next_attempt_at,
+                                now + timedelta(seconds=30))
+        self.assertLessEqual(message.next_attempt_at,
+                             timezone.now() + timedelta(seconds=60))
+        for num, error_code in ((1, 300), (2, 0)):
+            message = self.get_stored_message(create_email(num, response={
+                'MessageID': 'postmark-id-{}'.format(num),
+                'ErrorCode': error_code,
+                'Message': 'Error' if error_code else 'OK',
+            }))
+            self.assertIsNone(message.next_attempt_at)
+        self.assertFalse(self.retry().called)
+
+    def test_is_retryable(self):
+        # Without a response, or with the error code of a failed API call
+        self.assertTrue(is_retryable('Connection refused', None))
+        self.assertTrue(is_retryable('Maintenance', 100))
+        self.assertFalse(is_retryable('Invalid email request', 300))
+        # With the error code of a rejected email
+        self.assertTrue(is_retryable('', 100))
+        self.assertFalse(is_retryable('', 300))
+        self.assertFalse(is_retryable('', 0))
+
+    def test_resend(self):
+        messages = [create_email(num, response={
+            'MessageID': 'postmark-id-{}'.format(num),
+            'ErrorCode': 100,
+            'Message': 'Maintenance',
+        }) for num in range(2)]
+        self.make_due(messages[0])
+        mock_send_batch = self.retry()
+        self.assertEqual(len(mock_send_batch.call_args_list), 1)
+        self.assertEqual(len(mock_send_batch.call_args[0]), 1)
+        message = self.get_stored_message(messages[0])
+        self.assertEqual(message.retry_attempts, 1)
+        self.assertIsNone(message.next_attempt_at)
+        self.assertEqual(message.emails.count(), 2)
+        self.assertIsNotNone(
+            self.get_stored_message(messages[1]).next_attempt_at)
+
+    def test_backoff(self):
+        message = create_email(0, exception_str='Connection refused')
+        for attempt in range(1, 3):
+            self.make_due(message)
+            self.assertTrue(self.retry(error_code=100).called)
+            self.assertEqual(
+                self.get_stored_message(message).retry_attempts, attempt)
+        # The maximum number of attempts has been reached
+        self.assertIsNone(self.get_stored_message(message).next_attempt_at)
+        self.assertEqual(self.get_stored_message(message).emails.count(), 3)
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class MultiServerTests(TestCase):
+
+    servers = {
+        'shop': {
+            'secret': 'shopsecret',
+            'token': 'shop-token',
+            # Normalised to the numbers webhook data has
+            'server_id': '23',
+            'rate_limit': 0.01,
+            'burst': 1,
+        },
+    }
+
+    def setUp(self):
+        patcher = mock.patch.multiple(app_settings, SERVERS=self.servers)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        get_server_registry.cache_clear()
+        self.addCleanup(get_server_registry.cache_clear)
+        patcher = mock.patch.dict(throttling.controllers, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post_delivery(self, secret, **data):
+        return self.client.post(
+            reverse('delivery-receiver', kwargs={'secret': secret}),
+            json.dumps(dict({
+                'MessageID': 'unknown-postmark-id',
+                'Recipient': 'recipient@example.com',
+                'DeliveredAt': '2020-01-01T10:00:00-05:00',
+            }, **data)), content_type='application/json')
+
+    def test_registry(self):
+        registry = get_server_registry()
+        self.assertEqual(registry.get_by_secret('shopsecret').name, 'shop')
+        self.assertEqual(registry.get_by_secret(
+            settings.POSTMARK_UTILS_SECRET).name, 'default')
+        self.assertIsNone(registry.get_by_secret('shopsecre'))
+        with mock.patch.multiple(app_settings, SERVERS=dict(
+                self.servers, other={'secret': 'shopsecret'})):
+            get_server_registry.cache_clear()
+            with self.assertRaises(ImproperlyConfigured):
+                get_server_registry()
+        # Every server's notifications are stored with the sent emails
+        with mock.patch.multiple(app_settings, SERVERS={
+                'shop': dict(self.servers['shop'], database='shop')}):
+            get_server_registry.cache_clear()
+            with self.assertRaises(ImproperlyConfigured):
+                get_server_registry()
+
+    def test_receivers(self):
+        self.assertEqual(self.post_delivery('wrongsecret').status_code, 403)
+        self.assertEqual(self.post_delivery('shopsecret').status_code, 204)
+        # The shop server's receiver limits don't apply to the default
+        # server's notifications
+        self.assertEqual(self.post_delivery('shopsecret').status_code, 429)
+        self.assertEqual(
+            self.post_delivery(settings.POSTMARK_UTILS_SECRET,
+                               Recipient='other@example.com').status_code,
+            204)
+        # Notifications received with the default server's secret are routed
+        # by their server ID
+        self.assertEqual(
+            self.post_delivery(settings.POSTMARK_UTILS_SECRET,
+                               ServerId=23).status_code,
+            429)
+        self.assertEqual(Event.objects.count(), 2)
+        stats = self.client.get(reverse('receiver-stats', kwargs={
+            'secret': 'shopsecret'})).json()
+        self.assertEqual(stats['server'], 'shop')
+        self.assertEqual(stats['delivery']['rejected_rate'], 2)
+
+    def test_routes_stored_atomically(self):
+        with mock.patch('django_postmark_utils.views.ingest_events',
+                        side_effect=[1, ValueError]) as ingest_events:
+            with self.assertRaises(ValueError), \
+                    mock.patch('django.db.transaction.Atomic.__exit__',
+                               autospec=True,
+                               side_effect=transaction.Atomic.__exit__) \
+                    as atomic_exit:
+                self.client.post(
+                    reverse('delivery-receiver', kwargs={
+                        'secret': settings.POSTMARK_UTILS_SECRET}),
+                    json.dumps([{'MessageID': 'id-0', 'ServerId': 23},
+                                {'MessageID': 'id-1'}]),
+                    content_type='application/json')
+        self.assertEqual(ingest_events.call_count, 2)
+        # Both routes were ingested in the same transaction, rolled back
+        self.assertEqual(atomic_exit.call_count, 1)
+        self.assertIs(atomic_exit.call_args[0][1], ValueError)
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class EmailStatusTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+        create_email(0, exception_str='Connection refused')
+        for num in range(1, 5):
+            create_email(num, response={
+                'MessageID': 'postmark-id-{}'.format(num),
+                'ErrorCode': 0,
+                'Message': 'OK',
+            })
+
+    def get_status(self, num):
+        return Email.objects.get(
+            message__subject='Subject {}'.format(num)).status
+
+    def deliver(self, num, recipient=None):
+        ingest_events([{
+            'RecordType': 'Delivery',
+            'MessageID': 'postmark-id-{}'.format(num),
+            'Recipient': recipient or 'recipient{}@example.com'.format(num),
+            'DeliveredAt': '2020-01-01T10:00:00-05:00',
+        }])
+
+    def bounce(self, num, recipient=None):
+        ingest_events([{
+            'RecordType': 'Bounce',
+            'ID': num,
+            'Type': 'HardBounce',
+            'TypeCode': 1,
+            'MessageID': 'postmark-id-{}'.format(num),
+            'Email': recipient or 'recipient{}@example.com'.format(num),
+            'BouncedAt': '2020-01-01T10:30:00-05:00',
+            'Inactive': True,
+            'CanActivate': True,
+        }])
+
+    def test_statuses(self):
+        self.deliver(1)
+        self.bounce(2)
+        self.deliver(3)
+        self.bounce(3, 'Recipient3@example.com')
+        self.bounce(4)
+        self.deliver(4)
+        self.assertEqual(
+            [self.get_status(num) for num in range(5)],
+            ['failed', 'delivered', 'bounced', 'bounced', 'delivered'])
+        # Duplicate notifications don't change the status
+        self.deliver(1)
+        self.assertEqual(self.get_status(1), 'delivered')
+
+    def test_duplicate_delivery_after_bounce(self):
+        self.deliver(1)
+        self.bounce(1)
+        self.assertEqual(self.get_status(1), 'bounced')
+        # A retried (or replayed) notification isn't projected again
+        with self.assertNumQueries(3):
+            self.deliver(1)
+        self.assertEqual(self.get_status(1), 'bounced')
+        self.assertEqual(Delivery.objects.count(), 1)
+
+    def test_partially_delivered(self):
+        # Only when delivered to some recipients, and bounced for others
+        self.deliver(1)
+        self.bounce(1, 'other@example.com')
+        self.bounce(2)
+        self.deliver(2, 'other@example.com')
+        self.assertEqual([self.get_status(num) for num in (1, 2)],
+                         ['partially_delivered', 'partially_delivered'])
+
+    def test_migration(self):
+        set_statuses = import_module('django_postmark_utils.migrations.'
+                                     '0013_email_status').set_statuses
+        # Delivered to, and bounced for, the same recipient
+        self.deliver(1)
+        self.bounce(1)
+        self.bounce(3)
+        Delivery.objects.create(
+            email=Email.objects.get(delivery_email_id='postmark-id-3'),
+            email_address='Recipient3@example.com',
+            date=datetime(2020, 1, 1, 16, tzinfo=timezone.utc))
+        # Delivered to, and bounced for, different recipients
+        self.bounce(2)
+        self.deliver(2, 'other@example.com')
+        Email.objects.exclude(status='failed').update(status='submitted')
+        set_statuses(django_apps, connections['default'].schema_editor())
+        self.assertEqual(
+            [self.get_status(num) for num in range(5)],
+            ['failed', 'bounced', 'partially_delivered', 'delivered',
+             'submitted'])
+
+    def test_find_stuck_emails(self):
+        self.deliver(1)
+        Email.objects.update(
+            status_changed_at=timezone.now() - timedelta(hours=2))
+        stdout = io.StringIO()
+        call_command('find_stuck_postmark_emails', '--chunk-size', '1',
+                     stdout=stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(sorted(line.split('\t')[2] for line in lines[:-1]),
+                         ['postmark-id-2', 'postmark-id-3', 'postmark-id-4'])
+        self.assertIn('3 submitted emails', lines[-1])
+
+        stdout = io.StringIO()
+        call_command('find_stuck_postmark_emails', '180', stdout=stdout)
+        self.assertIn('0 submitted emails', stdout.getvalue())
+
+    def test_admin_filter(self):
+        self.deliver(1)
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse('admin:django_postmark_utils_email_changelist'),
+            {'status__exact': 'delivered'})
+        self.assertContains(response, 'postmark-id-1')
+        self.assertNotContains(response, 'postmark-id-2')
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class ChangeFeedTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for num in range(3):
+            create_email(num, response={
+                'MessageID': 'postmark-id-{}'.format(num),
+                'ErrorCode': 0,
+                'Message': 'OK',
+            })
+        cls.settle()
+
+    @staticmethod
+    def settle():
+        """
+        Moves the records stored within the settle window an hour back, as if
+        stored before it.
+        """
+
+        settled = timezone.now() - timedelta(
+            seconds=app_settings.CHANGE_FEED_SETTLE_SECONDS)
+        for model in (Email, Bounce, Delivery):
+            # Not with "F()", whose results SQLite compares as different
+            # strings
+            for pk, created in model.objects.filter(created__gte=settled)\
+                                            .values_list('id', 'created'):
+                model.objects.filter(id=pk).update(
+                    created=created - timedelta(hours=1))
+
+    def get_changes(self, feed, **params):
+        return self.client.get(
+            reverse('change-feed', kwargs={
+                'secret': settings.POSTMARK_UTILS_SECRET, 'feed': feed}),
+            params, HTTP_ACCEPT_ENCODING='gzip, deflate')
+
+    def get_records(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        content = gzip.decompress(response.content).decode('utf-8')
+        return [json.loads(line) for line in content.splitlines()]
+
+    def test_pages(self):
+        response = self.get_changes('emails', limit=2)
+        records = self.get_records(response)
+        self.assertEqual([record['delivery_email_id'] for record in records],
+                         ['postmark-id-0', 'postmark-id-1'])
+        self.assertEqual(records[0]['status'], 'submitted')
+        self.assertIn('message_id', records[0])
+
+        cursor = response['X-Next-Cursor']
+        response = self.get_changes('emails', cursor=cursor, limit=2)
+        records = self.get_records(response)
+        self.assertEqual([record['delivery_email_id'] for record in records],
+                         ['postmark-id-2'])
+
+        # Records added later are fed from the cursor
+        cursor = response['X-Next-Cursor']
+        response = self.get_changes('emails', cursor=cursor)
+        self.assertEqual(self.get_records(response), [])
+        self.assertEqual(response['X-Next-Cursor'], cursor)
+        create_email(3)
+        # Once settled
+        self.assertEqual(
+            self.get_records(self.get_changes('emails', cursor=cursor)), [])
+        self.settle()
+        records = self.get_records(self.get_changes('emails', cursor=cursor))
+        self.assertEqual(len(records), 1)
+
+    def test_order(self):
+        cursor = self.get_changes('emails')['X-Next-Cursor']
+        create_email(3)
+        create_email(4)
+        self.settle()
+        # Records are fed in the order they were stored, rather than by ID
+        # (e.g. if IDs were allocated out of order)
+        first, second = Email.objects.order_by('-id')[:2]
+        Email.objects.filter(id=first.id).update(created=second.created)
+        Email.objects.filter(id=second.id).update(created=first.created)
+        records = self.get_records(self.get_changes('emails', cursor=cursor))
+        self.assertEqual([record['id'] for record in records],
+                         [first.id, second.id])
+
+    def test_deliveries(self):
+        ingest_events([{
+            'RecordType': 'Delivery',
+            'MessageID': 'postmark-id-1',
+            'Recipient': 'recipient1@example.com',
+            'DeliveredAt': '2020-01-01T10:00:00-05:00',
+        }])
+        self.settle()
+        response = self.client.get(reverse('change-feed', kwargs={
+            'secret': settings.POSTMARK_UTILS_SECRET, 'feed': 'deliveries'}),
+            HTTP_ACCEPT_ENCODING='gzip;q=0, deflate')
+        self.assertNotIn('Content-Encoding', response)
+        record = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(record['email_address'], 'recipient1@example.com')
+        self.assertEqual(record['email_id'], Email.objects.get(
+            delivery_email_id='postmark-id-1').id)
+
+    def test_invalid_cursor(self):
+        cursor = self.get_changes('emails')['X-Next-Cursor']
+        self.assertEqual(
+            self.get_changes('bounces', cursor=cursor).status_code, 400)
+        self.assertEqual(
+            self.get_changes('emails', cursor='invalid').status_code, 400)
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class PostmarkStubEmailAPITests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.multiple(app_settings, STORE_ON_COMMIT=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, server, num):
+        with get_connection('django_postmark_utils.backends.EmailBackend',
+                            api_url=server.url,
+                            fail_silently=True) as connection:
+            connection.send_messages([EmailMessage(
+                'Subject', 'Body', 'sender@example.com',
+                ['recipient{}@example.com'.format(num)])])
+
+    def test_send(self):
+        with PostmarkStubServer() as server:
+            self.send(server, 0)
+        self.assertEqual(server.requests, ['/email/batch'])
+        email = Email.objects.get()
+        self.assertEqual(email.status, Email.SUBMITTED)
+        self.assertEqual(email.delivery_email_id, server.sent[0]['MessageID'])
+        self.assertEqual(server.recordings['messages'][0]['Recipients'],
+                         ['recipient0@example.com'])
+
+    def test_api_url(self):
+        client = backends.APIURLPostmarkClient(
+            server_token='token', api_url='http://127.0.0.1:8000')
+        with mock.patch.object(client.session, 'request') as mock_request:
+            client.call('GET', 'messages/outbound')
+            client.call_status('services/status')
+        self.assertEqual(
+            [call[0][1] for call in mock_request.call_args_list],
+            ['http://127.0.0.1:8000/messages/outbound',
+             'https://status.postmarkapp.com/api/1.0/services/status'])
+        self.assertEqual(mock_request.call_args_list[0][1]['headers'][
+            'X-Postmark-Server-Token'], 'token')
+
+    def test_errors(self):
+        with PostmarkStubServer(error_rate=1) as server:
+            self.send(server, 0)
+        with PostmarkStubServer(request_error_rate=1) as server:
+            self.send(server, 1)
+        rejected, failed = Email.objects.order_by('id')
+        self.assertEqual(rejected.status, Email.FAILED)
+        self.assertEqual(rejected.delivery_error_code, 406)
+        self.assertIsNone(rejected.message.next_attempt_at)
+        # Failed API calls are stored, and retried
+        self.assertEqual(failed.status, Email.FAILED)
+        self.assertEqual(failed.delivery_error_code, 100)
+        self.assertIn('Maintenance', failed.sending_error)
+        self.assertIsNotNone(failed.message.next_attempt_at)
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class BenchmarkPostmarkLoopTests(TransactionTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.multiple(app_settings, STORE_ON_COMMIT=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_benchmark(self):
+        stdout = io.StringIO()
+        call_command('benchmark_postmark_loop', emails=10, batch_size=5,
+                     concurrency=1, webhook_workers=1, bounce_rate=0.5,
+                     seed=0, stdout=stdout)
+        self.assertIn('Stored: 10 emails', stdout.getvalue())
+        self.assertEqual(Bounce.objects.count() + Delivery.objects.count(),
+                         10)
+        self.assertFalse(Email.objects.filter(status=Email.SUBMITTED)
+                                      .exists())
+
+
+class ReplayPostmarkWebhooksTests(TransactionTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.multiple(app_settings, STORE_ON_COMMIT=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        create_email(0, response={'MessageID': 'postmark-id-0',
+                                  'ErrorCode': 0, 'Message': 'OK'})
+
+    def replay(self, concurrency=1):
+        stdout = io.StringIO()
+        call_command('replay_postmark_webhooks', synthesise=5,
+                     bounce_ratio=0, concurrency=concurrency, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_replay(self):
+        output = self.replay()
+        self.assertIn('Responses: 204: 5', output)
+        self.assertIn('0 errors', output)
+        self.assertEqual(Email.objects.get().status, Email.DELIVERED)
+
+    def test_receiver_error(self):
+        with mock.patch('django_postmark_utils.views.ingest_events',
+                        side_effect=ValueError):
+            output = self.replay()
+        self.assertIn('Responses: ValueError: 5', output)
+        self.assertIn('5 errors', output)
+
+    def test_nothing_sent(self):
+        output = self.replay(concurrency=0)
+        self.assertNotIn('Latency', output)
+        self.assertIn('5 errors', output)
+
+
+class StoreEmailsTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.multiple(app_settings, STORE_ON_COMMIT=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_messages(self):
+        return [EmailMessage(
+            subject='Subject {}'.format(num),
+            body='Body {}'.format(num),
+            from_email='sender@example.com',
+            to=['recipient{}@example.com'.format(num)],
+        ).message() for num in range(3)]
+
+    def test_headers(self):
+        message = self.get_messages()[0]
+        message['Date'] = 'Wed, 01 Jan 2020 15:00:00 -0000'
+        headers = MessageHeaders(message)
+        self.assertEqual(headers.email_id, message['Message-ID'])
+        self.assertEqual(headers.message_id, message['Message-ID'])
+        self.assertEqual(headers.date.isoformat(), '2020-01-01T15:00:00+00:00')
+        self.assertEqual(headers.get('to'), 'recipient0@example.com')
+        self.assertEqual(headers.get('Cc', ''), '')
+        # Header fields that aren't stored are looked up in the message
+        message['X-Custom'] = 'value'
+        self.assertEqual(headers.get('x-custom'), 'value')
+        self.assertIsNone(headers.get('X-Other'))
+        message[app_settings.MESSAGE_ID_HEADER_FIELD_NAME] = '<original@host>'
+        self.assertEqual(MessageHeaders(message).message_id, '<original@host>')
+
+    def test_batch_lookups(self):
+        messages = self.get_messages()
+        store_emails([(message, {'exception_str': 'Connection refused'})
+                      for message in messages])
+        self.assertEqual(Email.objects.count(), 3)
+
+        # The messages and emails already stored are looked up in a query
+        # each, and the messages aren't serialised again
+        with mock.patch('django_postmark_utils.signal_handlers.'
+                        'serialise_message_obj') as serialise_message_obj, \
+                self.assertNumQueries(2):
+            store_emails([(message, {'exception_str': 'Connection refused'})
+                          for message in messages])
+        self.assertFalse(serialise_message_obj.called)
+        self.assertEqual(Email.objects.count(), 3)
+
+    def test_errors(self):
+        messages = self.get_messages()
+        with mock.patch('django_postmark_utils.signal_handlers.'
+                        'MessageHeaders', side_effect=[
+                            ValueError('Invalid header'), *map(
+                                MessageHeaders, messages[1:]),
+                            ValueError('Invalid header')]), \
+                self.assertLogs('django_postmark_utils.signal_handlers',
+                                'ERROR') as logs:
+            store_emails([(message, {}) for message in messages])
+        # Only the email whose headers couldn't be extracted isn't stored
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(
+            sorted(Email.objects.values_list('email_id', flat=True)),
+            sorted(message['Message-ID'] for message in messages[1:]))
+
+        # The original error is raised if the object isn't found either
+        with mock.patch.object(Message.objects, 'create',
+                               side_effect=IntegrityError('NOT NULL')), \
+                self.assertRaisesMessage(IntegrityError, 'NOT NULL'):
+            create_or_get(Message, {}, message_id='<missing@host>')
+
+    def test_profile(self):
+        stdout = io.StringIO()
+        call_command('profile_postmark_storage', batches=2, batch_size=3,
+                     trace_memory=True, stdout=stdout)
+        self.assertIn('Already stored: ', stdout.getvalue())
+        self.assertIn('0.67 queries, ', stdout.getvalue())
+        self.assertEqual(Email.objects.count(), 6)
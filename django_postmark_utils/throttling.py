@@ -0,0 +1,178 @@
+import math
+import threading
+import time
+from collections import namedtuple
+
+from django.core.cache import caches
+
+from . import app_settings
+from .counters import CacheCounters, LocalCounters
+
+# The scopes of the webhook receivers, each limited separately
+SCOPES = ('bounce', 'delivery', 'event')
+
+Rejection = namedtuple('Rejection', ('status', 'retry_after'))
+
+
+class TokenBucket(object):
+    """
+    A token bucket of "capacity" tokens, refilled at "rate" tokens per second,
+    kept in process.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """
+        Takes a token, returning "0", or if the bucket is empty, the number of
+        seconds until it won't be.
+        """
+
+        with self.lock:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    @property
+    def level(self):
+        with self.lock:
+            self.refill()
+            return self.tokens
+
+
+class CacheFixedWindowLimiter(object):
+    """
+    A fixed window rate limiter shared through a Django cache, used in place
+    of a token bucket, as the cache API has no atomic compare-and-set.
+
+    Up to "capacity" requests are admitted in each window of "capacity /
+    rate" seconds, counted by atomically incrementing a counter for the
+    current window. Unlike a token bucket, up to twice "capacity" requests can
+    be admitted around the boundary of two windows.
+    """
+
+    def __init__(self, rate, capacity, cache, key):
+        self.rate = rate
+        self.capacity = capacity
+        self.cache = cache
+        self.key = key
+        self.window = capacity / rate
+
+    def get_window_key(self, now):
+        return '{}:{}'.format(self.key, int(now // self.window))
+
+    def take(self):
+        now = time.time()
+        window_key = self.get_window_key(now)
+        self.cache.add(window_key, 0, math.ceil(self.window) + 1)
+        if self.cache.incr(window_key) <= self.capacity:
+            return 0
+        return self.window - now % self.window
+
+    @property
+    def level(self):
+        return max(0, self.capacity -
+                   self.cache.get(self.get_window_key(time.time()), 0))
+
+
+class AdmissionController(object):
+    """
+    Admits requests to a webhook receiver while there are tokens in its bucket
+    (or requests left in its window, if shared through a cache), and fewer
+    than "max_in_flight" requests are being handled by the process, and
+    counts the requests rejected.
+    """
+
+    def __init__(self, scope, rate=None, burst=None, max_in_flight=None,
+                 cache=None):
+        self.scope = scope
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        key = 'django_postmark_utils:throttle:{}'.format(scope)
+        if cache is None:
+            self.counters = LocalCounters()
+        else:
+            self.counters = CacheCounters(cache, key + ':rejected')
+        if rate is None:
+            self.bucket = None
+        elif cache is None:
+            self.bucket = TokenBucket(rate, burst or rate)
+        else:
+            self.bucket = CacheFixedWindowLimiter(rate, burst or rate,
+                                                  cache, key + ':bucket')
+
+    def acquire(self):
+        """
+        Returns "None" if the request is admitted, in which case "release()"
+        must be called once it has been handled, or else a "Rejection".
+        """
+
+        if self.max_in_flight is not None:
+            with self.lock:
+                if self.in_flight >= self.max_in_flight:
+                    rejection = Rejection(503,
+                                          app_settings.RECEIVER_RETRY_AFTER)
+                else:
+                    self.in_flight += 1
+                    rejection = None
+            if rejection:
+                self.counters.incr('in_flight')
+                return rejection
+        if self.bucket is not None:
+            wait = self.bucket.take()
+            if wait:
+                self.release()
+                self.counters.incr('rate')
+                return Rejection(429, max(1, math.ceil(wait)))
+        return None
+
+    def release(self):
+        if self.max_in_flight is not None:
+            with self.lock:
+                self.in_flight -= 1
+
+    def get_stats(self):
+        return {
+            'rate_limit': self.bucket.rate if self.bucket else None,
+            'bucket_capacity': self.bucket.capacity if self.bucket else None,
+            'bucket_level': self.bucket.level if self.bucket else None,
+            'max_in_flight': self.max_in_flight,
+            'in_flight': self.in_flight,
+            'rejected_rate': self.counters.get('rate'),
+            'rejected_in_flight': self.counters.get('in_flight'),
+        }
+
+
+# The admission controllers of each server's receivers, by server name and
+# scope, so that one server's load doesn't limit another's
+controllers = {}
+controllers_lock = threading.Lock()
+
+
+def get_admission_controller(server, scope):
+    key = (server.name, scope)
+    with controllers_lock:
+        if key not in controllers:
+            controllers[key] = AdmissionController(
+                '{}:{}'.format(server.name, scope),
+                rate=server.rate_limit,
+                burst=server.burst,
+                max_in_flight=server.max_in_flight,
+                cache=(caches[app_settings.RECEIVER_THROTTLE_CACHE]
+                       if app_settings.RECEIVER_THROTTLE_CACHE else None),
+            )
+        return controllers[key]
@@ -0,0 +1,151 @@
+import base64
+import json
+from collections import namedtuple
+
+from dateutil import parser
+from django.db.models import Q
+
+from . import app_settings
+from .models import Bounce, Delivery, Email, Recipient
+
+# The sources of timeline entries. Entries with the same date are ordered by
+# source, then by ID (newest first).
+SOURCES = ('email', 'bounce', 'delivery')
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+Timeline = namedtuple('Timeline', ('entries', 'next_cursor'))
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(entry):
+    data = json.dumps([entry['date'].isoformat(), entry['source'],
+                       entry['id']])
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        date_string, source, pk = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        if source not in SOURCES:
+            raise ValueError
+        return parser.parse(date_string), source, int(pk)
+    except (TypeError, ValueError):
+        raise InvalidCursor(cursor)
+
+
+def seek(queryset, source, cursor):
+    """
+    Filters a queryset of a source to the entries after the cursor, in
+    timeline order.
+    """
+
+    if cursor is None:
+        return queryset
+    date, cursor_source, pk = cursor
+    rank, cursor_rank = SOURCES.index(source), SOURCES.index(cursor_source)
+    if rank < cursor_rank:
+        return queryset.filter(date__lte=date)
+    if rank == cursor_rank:
+        return queryset.filter(Q(date__lt=date) | Q(date=date, id__lt=pk))
+    return queryset.filter(date__lt=date)
+
+
+def email_entry(email):
+    is_error = bool(email.sending_error) or email.delivery_error_code not in (
+        None, 0)
+    return {
+        'source': 'email',
+        'type': 'error' if is_error else 'sent',
+        'id': email.id,
+        'date': email.date,
+        'email': email,
+        'details': (email.sending_error or email.delivery_message
+                    if is_error else ''),
+    }
+
+
+def bounce_entry(bounce):
+    return {
+        'source': 'bounce',
+        'type': 'bounce',
+        'id': bounce.id,
+        'date': bounce.date,
+        'email': bounce.email,
+        'details': 'Bounce {} (type code {})'.format(
+            bounce.bounce_id, bounce.type_code),
+    }
+
+
+def delivery_entry(delivery):
+    return {
+        'source': 'delivery',
+        'type': 'delivery',
+        'id': delivery.id,
+        'date': delivery.date,
+        'email': delivery.email,
+        'details': '',
+    }
+
+
+def get_timeline(email_address, cursor=None, limit=DEFAULT_LIMIT,
+                 using=None):
+    """
+    Returns the sends, sending errors, bounces and deliveries of the emails
+    sent to an email address, newest first, and the cursor of the next page
+    (or "None" if it's the last page).
+
+    The email address is matched as given, and in lower case (as recipients
+    are stored). Each source is read using its email address index, seeking
+    to the cursor, and only a page of each is read, so that the cost doesn't
+    depend on the number of entries.
+    """
+
+    using = using or app_settings.READ_DATABASE
+    limit = min(limit, MAX_LIMIT)
+    if cursor is not None:
+        cursor = decode_cursor(cursor)
+    email_address = email_address.strip()
+    email_addresses = {email_address, email_address.lower()}
+    email_fields = ('id', 'email_id', 'date', 'sending_error',
+                    'delivery_email_id', 'delivery_error_code',
+                    'delivery_message', 'message__id', 'message__message_id',
+                    'message__subject')
+
+    emails = Email.objects.using(using).filter(
+        message__in=Recipient.objects.using(using)
+                                     .filter(email_address__in=email_addresses)
+                                     .values('message'))\
+        .select_related('message')\
+        .only(*email_fields)
+    bounces = Bounce.objects.using(using)\
+        .filter(email_address__in=email_addresses)\
+        .select_related('email__message')\
+        .only('id', 'bounce_id', 'date', 'type_code',
+              *('email__' + field for field in email_fields))
+    deliveries = Delivery.objects.using(using)\
+        .filter(email_address__in=email_addresses)\
+        .select_related('email__message')\
+        .only('id', 'date', *('email__' + field for field in email_fields))
+
+    entries = []
+    for source, queryset, make_entry in (
+            ('email', emails, email_entry),
+            ('bounce', bounces, bounce_entry),
+            ('delivery', deliveries, delivery_entry)):
+        queryset = seek(queryset, source, cursor).order_by('-date', '-id')
+        entries.extend(make_entry(obj) for obj in queryset[:limit + 1])
+    entries.sort(key=lambda entry: (entry['date'],
+                                    SOURCES.index(entry['source']),
+                                    entry['id']),
+                 reverse=True)
+    next_cursor = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        next_cursor = encode_cursor(entries[-1])
+    return Timeline(entries, next_cursor)
@@ -1,10 +1,20 @@
 from django.conf.urls import url
 
-from .views import BounceReceiver, DeliveryReceiver
+from .views import (AddressTimeline, BounceReceiver, ChangeFeed,
+                    DeliveryReceiver, EventReceiver, ReceiverStats)
 
 urlpatterns = [
     url(r'^(?P<secret>[a-zA-Z0-9]+)/bounce-receiver/$',
         BounceReceiver.as_view(), name='bounce-receiver'),
     url(r'^(?P<secret>[a-zA-Z0-9]+)/delivery-receiver/$',
         DeliveryReceiver.as_view(), name='delivery-receiver'),
+    url(r'^(?P<secret>[a-zA-Z0-9]+)/event-receiver/$',
+        EventReceiver.as_view(), name='event-receiver'),
+    url(r'^(?P<secret>[a-zA-Z0-9]+)/receiver-stats/$',
+        ReceiverStats.as_view(), name='receiver-stats'),
+    url(r'^(?P<secret>[a-zA-Z0-9]+)/timeline/$',
+        AddressTimeline.as_view(), name='address-timeline'),
+    url(r'^(?P<secret>[a-zA-Z0-9]+)/changes/'
+        r'(?P<feed>emails|bounces|deliveries)/$',
+        ChangeFeed.as_view(), name='change-feed'),
 ]
@@ -1,141 +1,269 @@
 import json
-import logging
 from functools import wraps
 
-from dateutil import parser
-from django.conf import settings
-from django.http import HttpResponse, HttpResponseForbidden
-from django.utils.crypto import constant_time_compare
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.http import (HttpResponse, HttpResponseBadRequest,
+                         HttpResponseForbidden, JsonResponse)
+from django.utils.cache import patch_vary_headers
 from django.utils.decorators import method_decorator
-from django.utils.translation import ugettext as _
+from django.utils.text import compress_string
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 
-from .models import Bounce, Delivery, Email
+from . import app_settings
+from .changes import get_changes
+from .events import ingest_events
+from .servers import get_server_registry
+from .storage_policy import get_storage_policy
+from .throttling import SCOPES, get_admission_controller
+from .timeline import DEFAULT_LIMIT, InvalidCursor, get_timeline
 
-logger = logging.getLogger(__name__)
 
+def accepts_gzip(request):
+    """
+    Returns if the request's "Accept-Encoding" header field accepts gzip
+    (explicitly, or by "*"), with a non-zero quality value.
+    """
+
+    qualities = {}
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, *params = [part.strip() for part in coding.split(';')]
+        quality = 1
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        qualities[name.lower()] = quality
+    return qualities.get('gzip', qualities.get('*', 0)) > 0
+
+
+def url_secret_required(view_func):
+    """
+    Checks that the secret in the URL is that of a registered Postmark server,
+    which is set on the request as "postmark_server".
+    """
 
-def url_secret_required(view_func,
-                        correct_secret=settings.POSTMARK_UTILS_SECRET):
     @wraps(view_func)
     def _check_secret(request, secret, *args, **kwargs):
-        if not constant_time_compare(secret, correct_secret):
+        server = get_server_registry().get_by_secret(secret)
+        if server is None:
             return HttpResponseForbidden()
-        else:
-            return view_func(request, secret, *args, **kwargs)
+        request.postmark_server = server
+        return view_func(request, secret, *args, **kwargs)
     return _check_secret
 
 
 @method_decorator(csrf_exempt, name='dispatch')
 @method_decorator(url_secret_required, name='dispatch')
-class BounceReceiver(View):
+class EventReceiver(View):
+    """
+    Receives webhook notifications from Postmark, of any of the record types
+    registered in "events.PARSERS", as specified here:
+    <https://postmarkapp.com/developer/webhooks/webhooks-overview>
+
+    Accepts either a single notification, or a list of them, which are stored
+    in bulk, in the database of the Postmark server they are for (see
+    "ServerRegistry.route").
+
+    Requests over the rate or in-flight limits of the receiver of any of those
+    servers are rejected with a "Retry-After" header, so that Postmark retries
+    them later.
+    """
 
     http_method_names = ['post']
+    # Used for webhook data without a "RecordType" field
+    default_record_type = None
+    # The scope the receiver's rate and in-flight limits apply to
+    throttle_scope = 'event'
 
     def post(self, request, *args, **kwargs):
-        """
-        Receives bounce notifications from Postmark, as specified here:
-        <https://postmarkapp.com/developer/webhooks/bounce-webhook#bounce-webhook-data>
-
-        Example JSON webhook data:
-        {
-            "ID": 42,
-            "Type": "HardBounce",
-            "TypeCode": 1,
-            "Name": "Hard bounce",
-            "Tag": "Test",
-            "MessageID": "883953f4-6105-42a2-a16a-77a8eac79483",
-            "ServerID": 23,
-            "Description": "The server was unable to deliver your message (ex:
-                            unknown user, mailbox not found).",
-            "Details": "Test bounce details",
-            "Email": "john@example.com",
-            "From": "sender@example.com",
-            "BouncedAt": "2014-08-01T13:28:10.2735393-04:00",
-            "DumpAvailable": true,
-            "Inactive": true,
-            "CanActivate": true,
-            "Subject": "Test subject",
-            "Content": "<Full dump of bounce>",
-        }
-        """
-
-        bounce_data = json.loads(request.body.decode('utf-8'))
-        bounce_id = bounce_data['ID']
-        email_id = bounce_data['MessageID']
-        email_address = bounce_data['Email']
-        bounced_at_string = bounce_data['BouncedAt']
-        bounced_at = parser.parse(bounced_at_string)
-        type_code = bounce_data['TypeCode']
-        inactive = bounce_data['Inactive']
-        can_activate = bounce_data['CanActivate']
-
+        data = json.loads(request.body.decode('utf-8'))
+        if isinstance(data, dict):
+            data = [data]
+        routes = get_server_registry().route(request.postmark_server, data)
+        admitted = []
         try:
-            email = Email.objects.get(delivery_email_id=email_id)
-        except Email.DoesNotExist:
-            logger.error(_("Email not found for bounce notification:\n"
-                           "%(bounce_data)s") % {
-                                'bounce_data': bounce_data,
-                            })
-        else:
-            Bounce.objects.get_or_create(
-                bounce_id=bounce_id,
-                defaults={
-                    'email': email,
-                    'email_address': email_address,
-                    'date': bounced_at,
-                    'type_code': type_code,
-                    'is_inactive': inactive,
-                    'can_activate': can_activate,
-                },
-            )
-
+            for server in routes:
+                admission_controller = get_admission_controller(
+                    server, self.throttle_scope)
+                rejection = admission_controller.acquire()
+                if rejection:
+                    response = HttpResponse(status=rejection.status)
+                    response['Retry-After'] = str(rejection.retry_after)
+                    return response
+                admitted.append(admission_controller)
+            # Store all the notifications, or none of them, before responding
+            with transaction.atomic(using=app_settings.DATABASE,
+                                    savepoint=False):
+                for records in routes.values():
+                    ingest_events(
+                        records, default_record_type=self.default_record_type)
+        finally:
+            for admission_controller in admitted:
+                admission_controller.release()
         return HttpResponse(status=204)
 
 
-@method_decorator(csrf_exempt, name='dispatch')
+class BounceReceiver(EventReceiver):
+    """
+    Receives bounce notifications from Postmark, as specified here:
+    <https://postmarkapp.com/developer/webhooks/bounce-webhook#bounce-webhook-data>
+
+    Example JSON webhook data:
+    {
+        "ID": 42,
+        "Type": "HardBounce",
+        "TypeCode": 1,
+        "Name": "Hard bounce",
+        "Tag": "Test",
+        "MessageID": "883953f4-6105-42a2-a16a-77a8eac79483",
+        "ServerID": 23,
+        "Description": "The server was unable to deliver your message (ex:
+                        unknown user, mailbox not found).",
+        "Details": "Test bounce details",
+        "Email": "john@example.com",
+        "From": "sender@example.com",
+        "BouncedAt": "2014-08-01T13:28:10.2735393-04:00",
+        "DumpAvailable": true,
+        "Inactive": true,
+        "CanActivate": true,
+        "Subject": "Test subject",
+        "Content": "<Full dump of bounce>",
+    }
+    """
+
+    default_record_type = 'Bounce'
+    throttle_scope = 'bounce'
+
+
+class DeliveryReceiver(EventReceiver):
+    """
+    Receives delivery notifications from Postmark, as specified here:
+    <https://postmarkapp.com/developer/webhooks/delivery-webhook#delivery-webhook-data>.
+
+    Example JSON webhook data:
+    {
+        "ServerId": 23,
+        "MessageID": "883953f4-6105-42a2-a16a-77a8eac79483",
+        "Recipient": "john@example.com",
+        "Tag": "welcome-email",
+        "DeliveredAt": "2014-08-01T13:28:10.2735393-04:00",
+        "Details": "Test delivery webhook details"
+    }
+    """
+
+    default_record_type = 'Delivery'
+    throttle_scope = 'delivery'
+
+
 @method_decorator(url_secret_required, name='dispatch')
-class DeliveryReceiver(View):
+class ReceiverStats(View):
+    """
+    Returns the rate and in-flight limits of the webhook receivers of the
+    Postmark server whose secret is in the URL, their current bucket levels
+    and numbers of requests in flight, and the numbers of requests they have
+    rejected, as JSON, along with the numbers of messages stored by each
+    storage policy.
 
-    http_method_names = ['post']
+    Unless "POSTMARK_UTILS_RECEIVER_THROTTLE_CACHE" (or
+    "POSTMARK_UTILS_STORAGE_POLICY_CACHE") is set, these are for the process
+    handling the request only.
+    """
 
-    def post(self, request, *args, **kwargs):
-        """
-        Receives delivery notifications from Postmark, as specified here:
-        <https://postmarkapp.com/developer/webhooks/delivery-webhook#delivery-webhook-data>.
-
-        Example JSON webhook data:
-        {
-            "ServerId": 23,
-            "MessageID": "883953f4-6105-42a2-a16a-77a8eac79483",
-            "Recipient": "john@example.com",
-            "Tag": "welcome-email",
-            "DeliveredAt": "2014-08-01T13:28:10.2735393-04:00",
-            "Details": "Test delivery webhook details"
+    http_method_names = ['get']
+
+    def get(self, request, *args, **kwargs):
+        server = request.postmark_server
+        stats = {
+            scope: get_admission_controller(server, scope).get_stats()
+            for scope in SCOPES
         }
-        """
+        stats['server'] = server.name
+        stats['storage_policy'] = get_storage_policy().get_stats()
+        return JsonResponse(stats)
+
+
+@method_decorator(url_secret_required, name='dispatch')
+class AddressTimeline(View):
+    """
+    Returns the sends, sending errors, bounces and deliveries of the emails
+    sent to the email address in the "address" query parameter, newest first,
+    as JSON.
+
+    Pages of "limit" entries are returned, with the "cursor" of the next page,
+    if there is one. They are read from the (read) database of the Postmark
+    server whose secret is in the URL.
+    """
 
-        delivery_data = json.loads(request.body.decode('utf-8'))
-        email_id = delivery_data['MessageID']
-        recipient = delivery_data['Recipient']
-        delivered_at_string = delivery_data['DeliveredAt']
-        delivered_at = parser.parse(delivered_at_string)
+    http_method_names = ['get']
 
+    def get(self, request, *args, **kwargs):
+        email_address = request.GET.get('address', '').strip()
+        if not email_address:
+            return HttpResponseBadRequest()
+        using = request.postmark_server.read_database
         try:
-            email = Email.objects.get(delivery_email_id=email_id)
-        except Email.DoesNotExist:
-            logger.error(_("Email not found for delivery notification:\n"
-                           "%(delivery_data)s") % {
-                                'delivery_data': delivery_data,
-                            })
-        else:
-            Delivery.objects.get_or_create(
-                email=email,
-                email_address=recipient,
-                defaults={
-                    'date': delivered_at,
-                },
-            )
+            limit = int(request.GET.get('limit', DEFAULT_LIMIT))
+            timeline = get_timeline(email_address,
+                                    cursor=request.GET.get('cursor'),
+                                    limit=max(1, limit), using=using)
+        except (ValueError, InvalidCursor):
+            return HttpResponseBadRequest()
+        return JsonResponse({
+            'address': email_address,
+            'entries': [{
+                'type': entry['type'],
+                'date': entry['date'].isoformat(),
+                'email_id': entry['email'].email_id,
+                'delivery_email_id': entry['email'].delivery_email_id,
+                'message_id': entry['email'].message.message_id,
+                'subject': entry['email'].message.subject,
+                'details': entry['details'],
+            } for entry in timeline.entries],
+            'next_cursor': timeline.next_cursor,
+        })
 
-        return HttpResponse(status=204)
+
+@method_decorator(url_secret_required, name='dispatch')
+class ChangeFeed(View):
+    """
+    Returns the emails, bounces or deliveries (by the feed in the URL) added
+    after the "cursor" query parameter (or from the first one), in the order
+    they were added, as newline-delimited JSON, gzip-compressed if the client
+    accepts it.
+
+    Pages of up to "limit" records are returned, with the cursor of the next
+    page in the "X-Next-Cursor" header (the same cursor, if there were no new
+    records), so that consumers can keep polling from where they left off.
+    They are read from the (read) database of the Postmark server whose secret
+    is in the URL.
+    """
+
+    http_method_names = ['get']
+
+    def get(self, request, *args, **kwargs):
+        try:
+            limit = int(request.GET.get('limit', 0))
+            changes = get_changes(kwargs['feed'],
+                                  cursor=request.GET.get('cursor'),
+                                  limit=max(0, limit),
+                                  using=request.postmark_server.read_database)
+        except ValueError:
+            # Including "changes.InvalidCursor"
+            return HttpResponseBadRequest()
+        content = ''.join(
+            json.dumps(record, cls=DjangoJSONEncoder) + '\n'
+            for record in changes.records).encode('utf-8')
+        response = HttpResponse(content_type='application/x-ndjson')
+        if accepts_gzip(request):
+            content = compress_string(content)
+            response['Content-Encoding'] = 'gzip'
+        response.content = content
+        response['Content-Length'] = str(len(content))
+        response['X-Next-Cursor'] = changes.next_cursor
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
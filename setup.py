@@ -16,15 +16,22 @@ setup(
     url='https://github.com/regulusweb/django-postmark-utils',
     license='MIT License',
     packages=find_packages(),
+    include_package_data=True,
     python_requires='>=3.4',
     install_requires=[
+        'Django>=2.2,<4.0',
         'postmarker>=0.11.3',
         'python-dateutil>=2.0',
+        'pytz',
+        'requests>=2.0',
     ],
     classifiers=[
         'Environment :: Web Environment',
         'Framework :: Django',
-        'Framework :: Django :: 1.11',
+        'Framework :: Django :: 2.2',
+        'Framework :: Django :: 3.0',
+        'Framework :: Django :: 3.1',
+        'Framework :: Django :: 3.2',
         'Intended Audience :: Developers',
         'Intended Audience :: System Administrators',
         'License :: OSI Approved :: MIT License',